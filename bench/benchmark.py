@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+End to end benchmarks of the Sensor.read -> DataLogging.log_sensor_output pipeline, runnable off the Pi.
+
+Readings come from the simulated BME680 driver, and remote writes go to a local fake InfluxDB server, so the numbers
+reflect this program's own overhead (plus any --latency added to each request).
+
+    $ python3 bench/benchmark.py --samples 2000
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import data_logging  # noqa: E402
+import drivers  # noqa: E402
+import sensor as sensor_module  # noqa: E402
+import utils  # noqa: E402
+from aggregation import WindowAggregator  # noqa: E402
+from fake_influx import FakeInfluxServer  # noqa: E402
+
+_SCENARIOS = ['local', 'remote-unbatched', 'remote-batched', 'remote-gzip', 'outage-replay', 'high-rate']
+_HIGH_RATE_WINDOW = 10  # Samples per logged summary.
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter_ns()
+        yield
+        self.stages.setdefault(stage, []).append(time.perf_counter_ns() - start)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _make_sensor():
+    # A config file means the Sensor skips its first time burn-in.
+    config = json.loads(json.dumps(sensor_module._DEFAULT_SENSOR_CONFIG))
+    config['gas']['ambient_background'] = 120000.0
+    with open(sensor_module._CONFIG_FILE_NAME, 'w') as json_file:
+        json.dump(config, fp=json_file)
+    return sensor_module.Sensor(driver=drivers.DRIVER_SIMULATED)
+
+
+def _run(scenario, samples, latency, timer):
+    sensor = _make_sensor()
+    extra = {}
+    with FakeInfluxServer(latency=latency) as server:
+        if scenario == 'local':
+            logger = data_logging.DataLogging()
+        else:
+            batch_size = 1 if scenario == 'remote-unbatched' else 50
+            logger = data_logging.DataLogging(hostname='127.0.0.1', port=server.port, batch_size=batch_size,
+                                              gzip_writes=scenario == 'remote-gzip', replay_rate=0)
+
+        # Only the sampling loop is timed, leaving out the setup and teardown around it.
+        started = time.perf_counter()
+        if scenario == 'high-rate':
+            aggregator = WindowAggregator()
+            for i in range(samples):
+                with timer.time('read'):
+                    aggregator.add(sensor.read())
+                if len(aggregator) >= _HIGH_RATE_WINDOW:
+                    with timer.time('log'):
+                        logger.log_sensor_output(aggregator.emit())
+        elif scenario == 'outage-replay':
+            # Lose the server for the first half, and time how long the backlog takes to go once it's back, while
+            # the second half is still being logged.
+            server.available = False
+            for i in range(samples):
+                if i == samples // 2:
+                    server.available = True
+                    logger._backoff.succeeded()
+                    replay_started = time.perf_counter()
+                    with timer.time('reconnect'):
+                        logger._init_influx_client()
+                with timer.time('read'):
+                    data = sensor.read()
+                with timer.time('log'):
+                    logger.log_sensor_output(data)
+        else:
+            for i in range(samples):
+                with timer.time('read'):
+                    data = sensor.read()
+                with timer.time('log'):
+                    logger.log_sensor_output(data)
+        elapsed = time.perf_counter() - started
+        if scenario == 'outage-replay':
+            while len(logger._spool):
+                time.sleep(0.001)
+            extra['replay_secs'] = time.perf_counter() - replay_started
+
+        logger.shutdown()
+        extra['points_written'] = server.points_written
+        extra['write_requests'] = server.write_requests
+        extra['bytes_received'] = server.bytes_received
+    return elapsed, extra
+
+
+def run_scenario(scenario, samples, latency):
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, 'w') as devnull:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                # Timed pass.
+                timer = StageTimer()
+                elapsed, extra = _run(scenario, samples, latency, timer)
+
+                # Memory pass, kept separate as tracing allocations slows everything down.
+                tracemalloc.start()
+                _run(scenario, samples, latency, StageTimer())
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    return timer, elapsed, peak, extra
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmark the sensor to database pipeline.")
+    argument_parser.add_argument("-n", "--samples", type=int, default=1000,
+                                 help="How many readings to take in each scenario.")
+    argument_parser.add_argument("--latency", type=float, default=0.0,
+                                 help="Seconds of delay the fake database adds to every request.")
+    argument_parser.add_argument("scenarios", nargs='*', default=_SCENARIOS,
+                                 help=f"Which scenarios to run, all of them by default. "
+                                      f"One of: {', '.join(_SCENARIOS)}")
+    parsed_args = argument_parser.parse_args()
+    unknown = set(parsed_args.scenarios) - set(_SCENARIOS)
+    if unknown:
+        argument_parser.error(f'Unknown scenario(s): {", ".join(sorted(unknown))}')
+    utils.verbose = False
+    # The outage scenario fails writes on purpose, which would otherwise be reported.
+    utils.log.setLevel(logging.ERROR)
+
+    for scenario in parsed_args.scenarios:
+        timer, elapsed, peak, extra = run_scenario(scenario, parsed_args.samples, parsed_args.latency)
+        print(f'{scenario}: {parsed_args.samples / elapsed:,.0f} samples/sec, peak traced memory '
+              f'{peak / 1024:,.1f} KiB, {extra["points_written"]} points in {extra["write_requests"]} writes '
+              f'({extra["bytes_received"] / 1024:,.1f} KiB)')
+        for stage, durations in timer.stages.items():
+            print(f'    {stage:<9} p50 {_percentile(durations, 50) / 1000:>10,.1f} us    '
+                  f'p99 {_percentile(durations, 99) / 1000:>10,.1f} us    '
+                  f'mean {statistics.mean(durations) / 1000:>10,.1f} us')
+        if 'replay_secs' in extra:
+            print(f'    backlog of {parsed_args.samples // 2} replayed in {extra["replay_secs"]:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
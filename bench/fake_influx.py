@@ -0,0 +1,141 @@
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeInfluxServer:
+    """
+    A local stand in for an InfluxDB 1.x server, enough for DataLogging to provision, ping and write against.
+
+    Set available to False to simulate an outage, which drops every connection without a response, and latency to
+    add a delay (in seconds) to every request, to simulate a slow network. Set write_status to answer writes of
+    readings with that status (and an error) instead, e.g. 400 for points the server rejects, and add the start of a
+    statement to refused to answer any query starting with it with a 403 (e.g. 'CREATE CONTINUOUS QUERY').
+    """
+
+    def __init__(self, latency=0.0):
+        self.available = True
+        self.latency = latency
+        self.write_status = 204
+        self.refused = []
+        # Every query statement received, in order.
+        self.statements = []
+        self.users = []
+        self.databases = []
+        self.retention_policies = {}
+        self.continuous_queries = {}
+        self.points_written = 0
+        self.write_requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-influx', daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not server.available:
+                    self.close_connection = True
+                    return
+                if server.latency:
+                    time.sleep(server.latency)
+
+                url = urlparse(self.path)
+                if url.path == '/ping':
+                    self._respond(204)
+                elif url.path == '/write' and 'rp' in parse_qs(url.query):
+                    # Anything other than readings, e.g. the dashboard's rollup table.
+                    self._respond(204)
+                elif url.path == '/write' and server.write_status != 204:
+                    self._respond(server.write_status, {'error': f'fake error {server.write_status}'})
+                elif url.path == '/write':
+                    received = len(body)
+                    if self.headers.get('Content-Encoding') == 'gzip':
+                        body = gzip.decompress(body)
+                    with server._lock:
+                        server.write_requests += 1
+                        server.bytes_received += received
+                        server.points_written += len([line for line in body.splitlines() if line.strip()])
+                    self._respond(204)
+                elif url.path == '/query':
+                    params = parse_qs(url.query)
+                    params.update(parse_qs(body.decode('utf-8')))
+                    statement = params.get('q', [''])[0]
+                    if any(statement.strip().upper().startswith(refused) for refused in server.refused):
+                        self._respond(403, {'error': 'fake error, not authorized to execute statement'})
+                    else:
+                        self._respond(200, server.query(statement))
+                else:
+                    self._respond(404)
+
+            def _respond(self, code, payload=None):
+                content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(code)
+                self.send_header('X-Influxdb-Version', '1.8.10-fake')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def query(self, statement):
+        statement = statement.strip()
+        self.statements.append(statement)
+        upper = statement.upper()
+        series = []
+        if upper.startswith('SHOW USERS'):
+            series = [{'columns': ['user', 'admin'], 'values': [[user, False] for user in self.users]}]
+        elif upper.startswith('SHOW DATABASES'):
+            series = [{'name': 'databases', 'columns': ['name'], 'values': [[db] for db in self.databases]}]
+        elif upper.startswith('CREATE USER'):
+            self.users.append(statement.split()[2].strip('"'))
+        elif upper.startswith('CREATE DATABASE'):
+            self.databases.append(statement.split()[2].strip('"'))
+        elif upper.startswith('SHOW RETENTION POLICIES'):
+            series = [{'columns': ['name', 'duration', 'shardGroupDuration', 'replicaN', 'default'],
+                       'values': [[name, duration, '168h0m0s', 1, name == 'autogen']
+                                  for name, duration in self.retention_policies.items()]}]
+        elif upper.startswith('CREATE RETENTION POLICY') or upper.startswith('ALTER RETENTION POLICY'):
+            words = statement.split()
+            self.retention_policies[words[3].strip('"')] = words[words.index('DURATION') + 1]
+        elif upper.startswith('SHOW CONTINUOUS QUERIES'):
+            series = [{'name': db, 'columns': ['name', 'query'],
+                       'values': [[name, query] for name, query in self.continuous_queries.items()]}
+                      for db in self.databases]
+        elif upper.startswith('CREATE CONTINUOUS QUERY'):
+            self.continuous_queries[statement.split()[3].strip('"')] = statement
+        result = {'statement_id': 0}
+        if series:
+            result['series'] = series
+        return {'results': [result]}
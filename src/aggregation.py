@@ -0,0 +1,65 @@
+import math
+
+import utils
+
+# Reading attribute, and the name it is stored under in the database.
+_FIELDS = (('temperature', 'temperature'),
+           ('humidity', 'humidity'),
+           ('pressure', 'pressure'),
+           ('gas', 'gas'),
+           ('iaq_index', 'quality'))
+# The stats emitted with each window's reading, always all of them and in this order, so they can be stored as columns.
+STATS = ('samples',) + tuple(f'{field}_{stat}' for _, field in _FIELDS for stat in ('min', 'max', 'stddev'))
+
+
+class WindowAggregator:
+    """
+    Summarises all of the readings taken within a window into a single reading.
+
+    The emitted reading holds the mean of each field, and carries the min/max/stddev of each field, along with the
+    number of samples, as extra stats to be stored beside them.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def __len__(self):
+        return self._count
+
+    def _reset(self):
+        self._count = 0
+        self._started = 0.0
+        self._sensor = utils.DEFAULT_SENSOR_NAME
+        self._calibrating = False
+        # Running mean and sum of squared differences (Welford), so the window is never stored.
+        self._mean = [0.0] * len(_FIELDS)
+        self._m2 = [0.0] * len(_FIELDS)
+        self._min = [math.inf] * len(_FIELDS)
+        self._max = [-math.inf] * len(_FIELDS)
+
+    def add(self, data: utils.DataCapture):
+        if self._count == 0:
+            self._started = data.timestamp
+            self._sensor = data.sensor
+        self._count += 1
+        self._calibrating = self._calibrating or data.calibrating
+        for i, (attribute, _) in enumerate(_FIELDS):
+            value = getattr(data, attribute)
+            delta = value - self._mean[i]
+            self._mean[i] += delta / self._count
+            self._m2[i] += delta * (value - self._mean[i])
+            if value < self._min[i]:
+                self._min[i] = value
+            if value > self._max[i]:
+                self._max[i] = value
+
+    def emit(self) -> utils.DataCapture:
+        stats = {'samples': self._count}
+        for i, (_, field) in enumerate(_FIELDS):
+            stats[f'{field}_min'] = self._min[i]
+            stats[f'{field}_max'] = self._max[i]
+            stats[f'{field}_stddev'] = math.sqrt(self._m2[i] / self._count)
+        summary = utils.DataCapture(*self._mean, timestamp=self._started, sensor=self._sensor,
+                                    calibrating=self._calibrating, stats=stats)
+        self._reset()
+        return summary
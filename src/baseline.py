@@ -0,0 +1,82 @@
+import json
+import os
+import time
+from collections import deque
+
+BURN_IN_MINS = 20
+# How many of the most recent gas readings the baseline is the average of.
+_BASELINE_SAMPLES = 50
+# The fewest readings the baseline can be settled on, for slow polling rates.
+_MIN_BASELINE_SAMPLES = 10
+_CHECKPOINT_SECS = 60
+
+
+class BaselineEstimator:
+    """
+    Works out the ambient background gas resistance from the readings the sensor is already taking, rather than
+    holding everything up for a dedicated burn-in period.
+
+    The estimate is the average of the most recent gas readings, and is usable (if rough) from the very first
+    reading. It has converged once the sensor has been running for the burn-in time and enough readings have been
+    seen. Progress is checkpointed to disk, so a restart picks up where it left off instead of starting again.
+    """
+
+    def __init__(self, path, burn_in_secs=BURN_IN_MINS * 60):
+        self._path = path
+        self._burn_in_secs = burn_in_secs
+        self._recent = deque(maxlen=_BASELINE_SAMPLES)
+        # Seconds of sensor running time seen so far, carried over restarts.
+        self._elapsed = 0.0
+        self._last_update = None
+        self._last_checkpoint = time.monotonic()
+        self._load()
+
+    @property
+    def estimate(self):
+        if not self._recent:
+            return None
+        return sum(self._recent) / len(self._recent)
+
+    @property
+    def converged(self):
+        return self._elapsed >= self._burn_in_secs and len(self._recent) >= _MIN_BASELINE_SAMPLES
+
+    @property
+    def progress(self):
+        return min(self._elapsed / self._burn_in_secs, 1.0) if self._burn_in_secs else 1.0
+
+    def update(self, gas):
+        now = time.monotonic()
+        # Time the process was down doesn't count, as the heater will have cooled off again.
+        if self._last_update is not None:
+            self._elapsed += now - self._last_update
+        self._last_update = now
+        self._recent.append(gas)
+
+        if now - self._last_checkpoint >= _CHECKPOINT_SECS:
+            self.checkpoint()
+
+    def _load(self):
+        if not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path, 'r') as state_file:
+                state = json.load(state_file)
+            self._elapsed = float(state['elapsed'])
+            self._recent.extend(float(gas) for gas in state['recent'])
+        except (OSError, ValueError, KeyError, TypeError):
+            # A damaged checkpoint only costs the progress made, so just start over.
+            self._elapsed = 0.0
+            self._recent.clear()
+
+    def checkpoint(self):
+        # Write then rename, so a crash mid-write never leaves a half written checkpoint.
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump({'elapsed': self._elapsed, 'recent': list(self._recent)}, state_file)
+        os.replace(temp_path, self._path)
+        self._last_checkpoint = time.monotonic()
+
+    def discard(self):
+        if os.path.isfile(self._path):
+            os.remove(self._path)
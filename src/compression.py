@@ -0,0 +1,203 @@
+
+import metrics
+import utils
+
+COMPRESSION_DEADBAND = 'deadband'
+COMPRESSION_SWINGING_DOOR = 'swinging-door'
+COMPRESSION_MODES = [COMPRESSION_DEADBAND, COMPRESSION_SWINGING_DOOR]
+# The longest a field may go without a point, so gaps in a graph only ever mean missing data.
+HEARTBEAT_SECS = 600
+# The reading attributes which are compressed, and how far each may drift before a new value has to be sent.
+DEFAULT_TOLERANCES = {
+    'temperature': 0.05,  # °C
+    'humidity': 0.25,  # %RH
+    'pressure': 0.05,  # hPa
+    'gas': 500.0,  # Ohms
+    'iaq_index': 0.5,
+}
+
+
+class _DeadbandField:
+    """Only keeps a value once it has moved more than the tolerance away from the last value kept."""
+
+    def __init__(self, tolerance):
+        self._tolerance = tolerance
+        self._kept = 0.0
+        self.max_error = 0.0
+
+    def start(self, timestamp, value):
+        self._kept = value
+
+    def update(self, timestamp, value):
+        # Returns whether the previous value, and whether this value, have to be kept.
+        error = abs(value - self._kept)
+        if error > self._tolerance:
+            self._kept = value
+            return False, True
+        self.max_error = max(self.max_error, error)
+        return False, False
+
+    def finish(self):
+        return False
+
+
+class _SwingingDoorField:
+    """
+    Only keeps the values needed to redraw the field as straight lines, none of which is further than the tolerance
+    from the values it replaced.
+
+    From each kept value, the range of slopes which pass within the tolerance of every value since narrows with each
+    new value (the door closing). A value can end the line as long as the line to it is still within that range. Once
+    a value can't, the value before is kept instead, and the door opens again from there.
+    """
+
+    def __init__(self, tolerance):
+        self._tolerance = tolerance
+        self.max_error = 0.0
+        self._anchor = None
+        self._held = None
+        # The values between the anchor and the held value, to measure the error once the line is drawn.
+        self._between = []
+        self._upper = 0.0
+        self._lower = 0.0
+
+    def start(self, timestamp, value):
+        self._anchor = (timestamp, value)
+        self._held = None
+        self._between = []
+
+    def update(self, timestamp, value):
+        # Returns whether the previous value, and whether this value, have to be kept.
+        anchor_time, anchor_value = self._anchor
+        if timestamp <= anchor_time:
+            # No line can be drawn without time passing, so just keep both.
+            kept_held = self._archive_held()
+            self.start(timestamp, value)
+            return kept_held, True
+
+        kept_held = False
+        if self._held is not None and not (self._lower <= (value - anchor_value) / (timestamp - anchor_time) <=
+                                           self._upper):
+            kept_held = self._archive_held()
+            self.start(*self._held)
+            anchor_time, anchor_value = self._anchor
+
+        elapsed = timestamp - anchor_time
+        upper = (value + self._tolerance - anchor_value) / elapsed
+        lower = (value - self._tolerance - anchor_value) / elapsed
+        if self._held is not None:
+            self._between.append(self._held)
+            upper, lower = min(upper, self._upper), max(lower, self._lower)
+        self._held = (timestamp, value)
+        self._upper, self._lower = upper, lower
+        return kept_held, False
+
+    def _archive_held(self):
+        if self._held is None:
+            return False
+        anchor_time, anchor_value = self._anchor
+        held_time, held_value = self._held
+        slope = (held_value - anchor_value) / (held_time - anchor_time)
+        for timestamp, value in self._between:
+            self.max_error = max(self.max_error, abs(value - (anchor_value + (slope * (timestamp - anchor_time)))))
+        return True
+
+    def finish(self):
+        # Returns whether the held value has to be kept to end the line exactly.
+        if not self._archive_held():
+            return False
+        self.start(*self._held)
+        return True
+
+
+_FIELD_TYPES = {COMPRESSION_DEADBAND: _DeadbandField, COMPRESSION_SWINGING_DOOR: _SwingingDoorField}
+
+
+class _SensorState:
+    def __init__(self, mode, tolerances):
+        self.fields = {attribute: _FIELD_TYPES[mode](tolerance) for attribute, tolerance in tolerances.items()}
+        self.previous = None
+        self.heartbeat = 0.0
+        self.readings = 0
+        self.sent = {attribute: 0 for attribute in tolerances}
+
+
+class Compressor:
+    """
+    Drops the values of each field which can be recreated, to within a tolerance, from the values which are kept.
+
+    A reading goes in, and zero or more readings come out, each of which may only hold some of the fields (listed in
+    its fields attribute). Every field is sent at least once per heartbeat, and whenever the calibrating flag changes.
+    """
+
+    def __init__(self, mode=COMPRESSION_DEADBAND, tolerances=None, heartbeat_secs=HEARTBEAT_SECS):
+        self._mode = mode
+        self._tolerances = dict(DEFAULT_TOLERANCES, **(tolerances or {}))
+        self._heartbeat_secs = heartbeat_secs
+        self._sensors = {}
+
+    def process(self, data: utils.DataCapture) -> [utils.DataCapture]:
+        state = self._sensors.get(data.sensor)
+        if state is None:
+            state = self._sensors[data.sensor] = _SensorState(self._mode, self._tolerances)
+        state.readings += 1
+
+        if state.previous is None or data.timestamp - state.heartbeat >= self._heartbeat_secs or \
+                data.calibrating != state.previous.calibrating:
+            points = self._finish(state)
+            for attribute, field in state.fields.items():
+                field.start(data.timestamp, getattr(data, attribute))
+                state.sent[attribute] += 1
+            state.heartbeat = data.timestamp
+            points.append(data)
+        else:
+            keep_previous, keep_current = [], []
+            for attribute, field in state.fields.items():
+                previous, current = field.update(data.timestamp, getattr(data, attribute))
+                if previous:
+                    keep_previous.append(attribute)
+                if current:
+                    keep_current.append(attribute)
+            points = []
+            if keep_previous:
+                points.append(self._partial(state, state.previous, keep_previous))
+            if keep_current:
+                points.append(self._partial(state, data, keep_current))
+
+        state.previous = data
+        if metrics.enabled:
+            self._update_metrics(data.sensor, state)
+        return points
+
+    @staticmethod
+    def _partial(state, data, attributes):
+        for attribute in attributes:
+            state.sent[attribute] += 1
+        return data._replace(fields=frozenset(attributes))
+
+    def _finish(self, state):
+        attributes = [attribute for attribute, field in state.fields.items() if field.finish()]
+        return [self._partial(state, state.previous, attributes)] if attributes else []
+
+    def finish(self) -> [utils.DataCapture]:
+        """Returns whatever is needed to end every field exactly on its latest value, e.g. before shutting down."""
+        points = []
+        for state in self._sensors.values():
+            if state.previous is not None:
+                points.extend(self._finish(state))
+        return points
+
+    @staticmethod
+    def _update_metrics(sensor, state):
+        for attribute, field in state.fields.items():
+            metrics.compression_ratio.set(state.readings / state.sent[attribute], sensor, attribute)
+            metrics.compression_max_error.set(field.max_error, sensor, attribute)
+
+    def summary(self):
+        lines = []
+        for sensor, state in self._sensors.items():
+            for attribute, field in state.fields.items():
+                lines.append(f'[{sensor}] {attribute}: {state.readings} readings sent as {state.sent[attribute]} '
+                             f'({state.readings / max(state.sent[attribute], 1):.1f}x), worst error '
+                             f'{field.max_error:.4g}')
+        return '\n'.join(lines) if lines else 'Compression: nothing compressed yet.'
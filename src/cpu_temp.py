@@ -0,0 +1,105 @@
+import os
+import time
+from array import array
+
+SMOOTHING_WINDOW = 'window'
+SMOOTHING_EWMA = 'ewma'
+_THERMAL_ROOT = '/sys/class/thermal'
+# The names the Pi's kernel has given its CPU thermal zone over the years.
+_CPU_ZONE_TYPES = ('cpu-thermal', 'cpu_thermal')
+
+
+def find_cpu_thermal_zone():
+    """Returns the path of the temperature file for the CPU's thermal zone, or None if there isn't one."""
+    try:
+        zones = sorted(name for name in os.listdir(_THERMAL_ROOT) if name.startswith('thermal_zone'))
+    except OSError:
+        return None
+    for zone in zones:
+        try:
+            with open(os.path.join(_THERMAL_ROOT, zone, 'type'), 'r') as zone_type:
+                if zone_type.read().strip() in _CPU_ZONE_TYPES:
+                    return os.path.join(_THERMAL_ROOT, zone, 'temp')
+        except OSError:
+            continue
+    return None
+
+
+def compensate_temperature(temperature, recent_cpu_avg, rounding_factor):
+    return temperature - ((recent_cpu_avg - temperature) / rounding_factor)
+
+
+class SysfsCpuThermometer:
+    """
+    Reads the CPU temperature straight from its thermal zone file.
+    The file is opened once and re-read from the start each call, rather than walking every sensor on the system.
+    """
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def __call__(self):
+        # Reported in thousandths of a degree.
+        return int(os.pread(self._fd, 16, 0)) / 1000.0
+
+    def close(self):
+        os.close(self._fd)
+
+
+class CpuCompensation:
+    """
+    Offsets the sensor's temperature by how warm the nearby CPU has recently been.
+
+    The recent CPU temperature is either the mean of the last smoothing_strength readings, kept in a fixed-size ring
+    buffer with a running sum, or an exponentially weighted moving average. Either way, each call costs the same no
+    matter how much smoothing is configured, and the time spent in each call is recorded.
+    """
+
+    def __init__(self, reader, smoothing_strength, rounding_factor, mode=SMOOTHING_WINDOW, ewma_alpha=None):
+        self._reader = reader
+        self._rounding_factor = rounding_factor
+        self._mode = mode
+        # Without an explicit alpha, give the EWMA roughly the same memory as the window.
+        self._alpha = ewma_alpha if ewma_alpha is not None else 2.0 / (smoothing_strength + 1)
+        self._ring = array('d', [0.0] * max(smoothing_strength, 1))
+        self._next = 0
+        self._count = 0
+        self._sum = 0.0
+        self.recent_avg = None
+        self.calls = 0
+        self.total_ns = 0
+
+    def _add(self, cpu_temp):
+        if self._mode == SMOOTHING_EWMA:
+            if self.recent_avg is None:
+                self.recent_avg = cpu_temp
+            else:
+                self.recent_avg += self._alpha * (cpu_temp - self.recent_avg)
+            return
+
+        if self._count == len(self._ring):
+            self._sum -= self._ring[self._next]
+        else:
+            self._count += 1
+        self._ring[self._next] = cpu_temp
+        self._sum += cpu_temp
+        self._next += 1
+        if self._next == len(self._ring):
+            self._next = 0
+            # Re-total once per lap, so rounding errors in the running sum can't build up over weeks.
+            self._sum = sum(self._ring)
+        self.recent_avg = self._sum / self._count
+
+    def compensate(self, temperature):
+        started = time.perf_counter_ns()
+        self._add(self._reader())
+        result = compensate_temperature(temperature, self.recent_avg, self._rounding_factor)
+        self.calls += 1
+        self.total_ns += time.perf_counter_ns() - started
+        return result
+
+    def summary(self):
+        if not self.calls:
+            return 'CPU temperature compensation: not called yet.'
+        return f'CPU temperature compensation: {self.calls} calls, ' \
+               f'{self.total_ns / self.calls / 1000:.1f} us per call on average.'
@@ -1,30 +1,156 @@
+import gzip
 import os
 import pickle
+import threading
+import time
 import uuid
-from datetime import datetime
 
 from influxdb import InfluxDBClient
-from requests.exceptions import ConnectionError as ReqConnectionError
+from influxdb.exceptions import InfluxDBClientError
+from requests.exceptions import ConnectionError as ReqConnectionError, Timeout as ReqTimeout
 
+import metrics
 import utils
+from line_protocol import GZIP_WRITE_HEADERS, LineEncoder, UdpTransport, PRECISION_MS, PRECISION_NS, WRITE_HEADERS
+from reconnect import ReconnectBackoff
+from replay import BacklogReplayer, REPLAY_BATCH_SIZE, REPLAY_RATE
+from rollups import backfill_rollups, provision_rollups
+from ring_store import RingStore, store_path
+from sample_batch import SampleBatch
+from spool import Spool
 
-_DB_FAILED_WRITES = 'failed_db_writes.dbp'
+# Written by older versions, migrated into the spool on start up.
+_DB_FAILED_WRITES_LEGACY = 'failed_db_writes.dbp'
+DB_FAILED_WRITES = 'failed_db_writes'
 DB_TABLE = 'AQ_MON'
 DB_USER = DB_TABLE + '_USER'
 DB_PASS = DB_TABLE + '_PASS_secret'
 _DB_TIMEOUT = 3
+# The backlog goes in much larger writes than the live readings, which a slow link can take a while to send.
+_BACKLOG_TIMEOUT = 30
+DB_BATCH_SIZE = 10
+DB_BATCH_MAX_AGE = 300  # Seconds
+_DB_MEASUREMENT = 'AQ'
+# Readings compress well even at the cheapest level, which matters more on a Pi Zero than the last few bytes.
+_GZIP_LEVEL = 1
 _PROG_RUN_ID = uuid.uuid4()
 _HOST_NAME = utils.HOST_NAME
 
 
+class _LegacyCapture:
+    # The mutable reading class older versions pickled, with its defaults for attributes which were never set.
+    timestamp = 0.0
+    calibrating = False
+    sensor = utils.DEFAULT_SENSOR_NAME
+
+    def to_capture(self):
+        return utils.DataCapture(self.temperature, self.humidity, self.pressure, self.gas, self.iaq_index,
+                                 timestamp=self.timestamp, sensor=self.sensor, calibrating=self.calibrating)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == 'utils' and name == 'DataCapture':
+            return _LegacyCapture
+        return super().find_class(module, name)
+
+
+def provision_database(hostname, port, retention=None):
+    """
+    Creates the user and database readings are written with, if they don't exist, and applies the retention. Returns
+    whether the rollups were set up too, as the raw readings can still be written without them.
+    """
+    # Connect to the server
+    utils.log.info(f'Attempting connection to host \'{hostname}:{port}\'')
+    admin = InfluxDBClient(host=hostname, port=port, timeout=_DB_TIMEOUT)
+    try:
+        # Check for the user existence
+        user_found = False
+        for user in admin.get_list_users():
+            if user['user'] == DB_USER:
+                user_found = True
+        if not user_found:
+            utils.v_print('Influx user not found, creating...')
+            admin.create_user(username=DB_USER, password=DB_PASS)
+        else:
+            utils.v_print('Identified Influx User...')
+
+        # Check for the database existence
+        db_found = False
+        for db in admin.get_list_database():
+            if db['name'] == DB_TABLE:
+                db_found = True
+        if not db_found:
+            utils.v_print('Influx table not found, creating...')
+            admin.create_database(dbname=DB_TABLE)
+        else:
+            utils.v_print('Identified Influx Collection...')
+
+        # Applying database permissions to the user
+        if (not user_found) or (not db_found):
+            admin.grant_privilege(privilege='ALL', database=DB_TABLE, username=DB_USER)
+
+        # Apply the retention policies, and keep the rollups the dashboard reads longer ranges from.
+        try:
+            provision_rollups(admin, DB_TABLE, _DB_MEASUREMENT, retention)
+        except InfluxDBClientError as err:
+            # e.g. missing permissions, or a policy which can't be changed to the duration given.
+            utils.log.error(f'Failed to set up the retention policies and rollups, only the raw readings will be kept. '
+                            f'{err}')
+            return False
+        return True
+    finally:
+        admin.close()
+
+
+def _refused(err: InfluxDBClientError):
+    # A 4xx response, so the server was reached, and refused the write itself.
+    return err.code is not None and 400 <= err.code < 500
+
+
 class DataLogging:
     _local = True
     _hostname = ''
     _port = 8086
     _influx = None
     _connection_ok = False
+    _provisioned = False
+    _rollups = False
+    _backoff = None
+    _batch_size = DB_BATCH_SIZE
+    _batch_max_age = DB_BATCH_MAX_AGE
+    _batch_started = 0.0
+    _spool = None
+    _history_capacity = 0
+    _gzip = False
+    _udp = None
+    _compressor = None
+    _retention = None
+    _replayer = None
+    _backlog_influx = None
+
+    def __init__(self, hostname='', port=8086, batch_size=DB_BATCH_SIZE, batch_max_age=DB_BATCH_MAX_AGE,
+                 history_capacity=0, gzip_writes=False, udp_port=None, compressor=None,
+                 retention=None, provision=True, replay_batch_size=REPLAY_BATCH_SIZE, replay_rate=REPLAY_RATE,
+                 echo_every=1):
+        # Points waiting to be sent to the server in a single write.
+        self._batch = SampleBatch()
+        self._batch_size = batch_size
+        self._batch_max_age = batch_max_age
+        self._backoff = ReconnectBackoff()
+        # The on-device history of each sensor, opened the first time it has a reading. Readings can be recorded from
+        # the sampling loop and the writer thread at once, so only one of them may open a sensor's store.
+        self._history = {}
+        self._history_lock = threading.Lock()
+        self._history_capacity = history_capacity
+        self._compressor = compressor
+        self._retention = retention
+        # A gateway provisions the database itself, so nodes writing through one have nothing to do.
+        self._provisioned = not provision
+        # Every echo_every'th reading is logged, or none for 0.
+        self._echo_every = echo_every
+        self._readings = 0
 
-    def __init__(self, hostname='', port=8086):
         # Check for localhost
         if hostname != '':
             # Running remotely:
@@ -36,146 +162,278 @@ class DataLogging:
                 hostname = hostname[8:]
             self._hostname = hostname
             self._port = port
+            self._gzip = gzip_writes
+            if udp_port is not None:
+                # The UDP listener has its own precision setting, which defaults to nanoseconds.
+                self._udp = UdpTransport(hostname, udp_port)
+            self._encoder = LineEncoder(_DB_MEASUREMENT, {'runID': _PROG_RUN_ID, 'hostname': _HOST_NAME},
+                                        precision=PRECISION_MS if self._udp is None else PRECISION_NS)
+            # The backlog is sent from its own thread, so it needs its own encoder (and connection).
+            self._backlog_encoder = LineEncoder(_DB_MEASUREMENT, {'runID': _PROG_RUN_ID, 'hostname': _HOST_NAME})
 
         # Attempt the connection to see if properties exist, and create them if not.
         if not self._local:
+            self._spool = Spool(DB_FAILED_WRITES)
+            metrics.spool_depth.set_function(lambda: len(self._spool))
+            self._migrate_legacy_backups()
+            self._replayer = BacklogReplayer(self._spool, self._send_backlog, lambda: self._connection_ok,
+                                             self._rollup_backlog if provision else None,
+                                             batch_size=replay_batch_size, rate=replay_rate)
             self._init_influx_client()
 
     def _init_influx_client(self):
+        # Only the ping is repeated on a reconnect, provisioning is done once per process.
+        if not self._backoff.allows_attempt():
+            return
+        if metrics.enabled:
+            metrics.reconnect_attempts.inc()
         try:
-            utils.validate_can_write_file(_DB_FAILED_WRITES)
-            # Connect to the server
-            print(f'Attempting connection to host \'{self._hostname}:{self._port}\'')
-            self._influx = InfluxDBClient(host=self._hostname, port=self._port, timeout=_DB_TIMEOUT)
-
-            # Check for the user existence
-            user_found = False
-            for user in self._influx.get_list_users():
-                if user['user'] == DB_USER:
-                    user_found = True
-            if not user_found:
-                utils.v_print('Influx user not found, creating...')
-                self._influx.create_user(username=DB_USER, password=DB_PASS)
-            else:
-                utils.v_print('Identified Influx User...')
-
-            # Check for the database existence
-            db_found = False
-            for db in self._influx.get_list_database():
-                if db['name'] == DB_TABLE:
-                    db_found = True
-            if not db_found:
-                utils.v_print('Influx table not found, creating...')
-                self._influx.create_database(dbname=DB_TABLE)
-            else:
-                utils.v_print('Identified Influx Collection...')
-
-            # Applying database permissions to the user
-            if (not user_found) or (not db_found):
-                self._influx.grant_privilege(privilege='ALL', database=DB_TABLE, username=DB_USER)
-
-            # Check for a retention policy
-            # TODO Implement some sort of retention policy.
-            pass
-
-            # Reset the connection with appropriate user data.
-            self._influx.close()
+            if not self._provisioned:
+                self._provision()
             self._connect()
 
-        except ReqConnectionError:
+        except (ReqConnectionError, ReqTimeout):
+            self._connection_ok = False
+            delay = self._backoff.failed()
+            utils.log.warning(f'Failed to connect, reverting to local backup until connection can be initialised. '
+                              f'Retrying in {delay:.0f} seconds.', extra=utils.rate_limited('connect'))
+            return
+        except InfluxDBClientError as err:
+            # The server was reached, but refused to set up the database, e.g. for want of permissions.
             self._connection_ok = False
-            print('Failed to connect, reverting to local backup until connection can be initialised.')
+            delay = self._backoff.failed()
+            utils.log.error(f'Failed to set up the database, reverting to local backup until it can be. Retrying in '
+                            f'{delay:.0f} seconds. {err}', extra=utils.rate_limited('provision'))
+            return
+
+        # Anything buffered while the connection was down can go now, ahead of the older backlog.
+        self.flush()
+        # Only closed once a write has got through too, as a server which can be pinged but not written to (e.g. with
+        # a full disk) should be backed off from just the same.
+        if self._connection_ok:
+            self._backoff.succeeded()
+            self._replayer.resume()
+
+    def _provision(self):
+        self._rollups = provision_database(self._hostname, self._port, self._retention)
+        self._provisioned = True
 
     def _connect(self):
-        self._influx = InfluxDBClient(host=self._hostname,
-                                      port=self._port,
-                                      username=DB_USER,
-                                      password=DB_PASS,
-                                      database=DB_TABLE,
-                                      timeout=_DB_TIMEOUT)
+        # The client is kept for the life of the process, a reconnect only needs to ping through it.
+        if self._influx is None:
+            self._influx = InfluxDBClient(host=self._hostname,
+                                          port=self._port,
+                                          username=DB_USER,
+                                          password=DB_PASS,
+                                          database=DB_TABLE,
+                                          timeout=_DB_TIMEOUT)
         # Update the status of the db connection.
         if self._influx.ping():
             self._connection_ok = True
-            print(f'Connection to {self._hostname}:{self._port} successful.')
-            self._check_repost_unsent_values()
+            utils.log.info(f'Connection to {self._hostname}:{self._port} successful.')
         else:
             raise ReqConnectionError('Unable to ping the database.')
 
+    def _record_history(self, data: utils.DataCapture):
+        if not self._history_capacity:
+            return
+        history = self._history.get(data.sensor)
+        if history is None:
+            with self._history_lock:
+                history = self._history.get(data.sensor)
+                if history is None:
+                    history = self._history[data.sensor] = RingStore(store_path(data.sensor),
+                                                                     capacity=self._history_capacity)
+        started = time.perf_counter()
+        history.append([data])
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'history')
+
     def log_sensor_output(self, data: utils.DataCapture):
+        self._record_history(data)
         if not self._local:
-            if self._connection_ok:
-                self._write_remote(data)
+            if self._compressor is not None:
+                # Only what can't be recreated from the points already sent goes on to the database.
+                points = self._compressor.process(data)
             else:
+                points = [data]
+            if points and not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.extend(points)
+            if not self._connection_ok:
                 self._init_influx_client()
-                if self._connection_ok:
-                    self._check_repost_unsent_values()
-                    self._write_remote(data)
-                else:
-                    self._write_local(data)
-        print(data)
-
-    def _check_repost_unsent_values(self):
-        if not utils.validate_file_exists(_DB_FAILED_WRITES):
+            if self._batch_is_due():
+                self.flush()
+        self._echo(data)
+
+    def _echo(self, data):
+        self._readings += 1
+        if self._echo_every and self._readings % self._echo_every == 0:
+            # Only formatted (which isn't cheap) when it is actually going to be logged.
+            utils.log.info('%s', data)
+
+    def spool_sensor_output(self, data: utils.DataCapture):
+        # Skip the network entirely, straight to the local backup.
+        self._record_history(data)
+        if not self._local:
+            self._write_locals([data])
+
+    def flush_if_due(self):
+        if self._batch and self._batch_is_due():
+            self.flush()
+
+    def _batch_is_due(self):
+        return len(self._batch) >= self._batch_size or \
+            time.monotonic() - self._batch_started >= self._batch_max_age
+
+    def flush(self):
+        if not self._batch:
             return
-        utils.v_print('Had values which were not successfully sent.')
-        all_sent_ok = True
-        for data in self._load_locals():
-            if self._connection_ok:
-                utils.v_print(f"ReSending dropped data: {data}")
-                self._write_remote(data)
-            else:
-                all_sent_ok = False
-                self._write_local(data)
-        if all_sent_ok:
-            print('Successfully pushed, all previously failed db writes, to server.')
-            os.remove(_DB_FAILED_WRITES)
+        batch, self._batch = self._batch, SampleBatch()
+        if self._connection_ok:
+            self._write_remote(batch)
+        else:
+            self._write_locals(batch)
+
+    def _write_remote(self, batch: SampleBatch):
+        if not self._send(batch):
+            # Keep the failed batch together as one unit in the local backup.
+            self._write_locals(batch)
 
-    def _write_remote(self, data: utils.DataCapture):
+    def _send(self, batch: SampleBatch):
+        started = time.perf_counter()
         try:
-            self._influx.write_points([
-                {
-                    "time": f'{datetime.fromtimestamp(data.timestamp).strftime("%Y-%m-%dT%T.%f")[:-3]}Z',
-                    "measurement": "AQ",
-                    "tags": {
-                        "runID": _PROG_RUN_ID,
-                        "hostname": _HOST_NAME
-                    },
-                    "fields": {
-                        "temperature": data.temperature,
-                        "humidity": data.humidity,
-                        "pressure": data.pressure,
-                        "gas": data.gas,
-                        "quality": data.iaq_index
-                    }
-                }
-            ])
+            body = self._encoder.encode(batch)
+            if self._udp is not None:
+                # Nothing comes back over UDP, so only a local network error can be noticed here.
+                self._udp.send(body)
+            else:
+                self._post(self._influx, body, self._encoder.precision)
+            if metrics.enabled:
+                metrics.stage_seconds.observe(time.perf_counter() - started, 'write')
+                metrics.points_written.inc(amount=len(batch))
+            return True
+        except InfluxDBClientError as err:
+            if not _refused(err):
+                return self._send_failed(err)
+            # The connection is fine, so the backoff is left alone.
+            return self._rejected(batch, err)
         except Exception as err:
-            utils.v_print(err)
-            self._influx.close()
-            self._connection_ok = False
-            self._write_local(data)
+            return self._send_failed(err)
 
-    def _write_local(self, data: utils.DataCapture):
-        self._write_locals([data])
+    def _send_failed(self, err):
+        utils.log.warning(f'Failed to write to influxDB, {err}', extra=utils.rate_limited('write'))
+        if metrics.enabled:
+            metrics.write_failures.inc()
+        self._influx.close()
+        self._connection_ok = False
+        self._backoff.failed()
+        return False
 
     @staticmethod
-    def _write_locals(data: [utils.DataCapture]):
-        with open(_DB_FAILED_WRITES, 'ab') as db_backups:
-            for val in data:
-                pickle.dump(val, db_backups)
+    def _rejected(batch, err):
+        # Whether the batch has been dealt with, which it has once dropped.
+        if metrics.enabled:
+            metrics.write_failures.inc()
+        if err.code != 400:
+            # e.g. unauthorised, or the database is missing, which could be put right, so the batch is kept.
+            utils.log.warning(f'influxDB refused a write, {err}', extra=utils.rate_limited('write-refused'))
+            return False
+        # The readings themselves were rejected (e.g. a field's type conflicts), which sending them again won't change.
+        utils.log.error(f'influxDB rejected a batch of {len(batch)} readings, dropping it. {err}',
+                        extra=utils.rate_limited('write-rejected'))
+        if metrics.enabled:
+            metrics.points_dropped.inc(amount=len(batch))
+        return True
 
-    @staticmethod
-    def _load_locals() -> [utils.DataCapture]:
-        backups = []
-        with open(_DB_FAILED_WRITES, 'rb') as db_backups:
+    def _post(self, influx, body, precision):
+        headers = WRITE_HEADERS
+        if self._gzip:
+            body = gzip.compress(body, compresslevel=_GZIP_LEVEL)
+            headers = GZIP_WRITE_HEADERS
+        influx.request(url='write', method='POST', data=body, headers=headers,
+                       params={'db': DB_TABLE, 'precision': precision}, expected_response_code=204)
+
+    def _send_backlog(self, batch: SampleBatch):
+        # Called from the replay thread. The backlog always goes over HTTP, as it can only be removed from the local
+        # backup once the write is confirmed.
+        if self._backlog_influx is None:
+            self._backlog_influx = InfluxDBClient(host=self._hostname, port=self._port, username=DB_USER,
+                                                  password=DB_PASS, database=DB_TABLE, timeout=_BACKLOG_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            self._post(self._backlog_influx, self._backlog_encoder.encode(batch), self._backlog_encoder.precision)
+        except InfluxDBClientError as err:
+            if _refused(err):
+                # Dropped, rather than holding up the rest of the backlog behind it.
+                return self._rejected(batch, err)
+            utils.log.warning(f'Failed to send the backlog to influxDB, {err}', extra=utils.rate_limited('replay'))
+            if metrics.enabled:
+                metrics.write_failures.inc()
+            return False
+        except Exception as err:
+            utils.log.warning(f'Failed to send the backlog to influxDB, {err}', extra=utils.rate_limited('replay'))
+            if metrics.enabled:
+                metrics.write_failures.inc()
+            return False
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'replay')
+        return True
+
+    def _rollup_backlog(self, start, end):
+        # Called from the replay thread, once it has caught up, as the backlog is too old for the continuous queries.
+        if not self._rollups:
+            return
+        try:
+            backfill_rollups(self._backlog_influx, DB_TABLE, _DB_MEASUREMENT, start, end, host=_HOST_NAME)
+        except Exception as err:
+            utils.log.warning(f'Failed to roll up the backlog sent to influxDB, so it is missing from the rollups. '
+                              f'{err}')
+            return
+        utils.v_print('Rolled up the backlog sent to influxDB.')
+
+    def _write_locals(self, data):
+        started = time.perf_counter()
+        self._spool.append(data)
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'spool')
+            metrics.points_spooled.inc(amount=len(data))
+        if self._connection_ok:
+            # e.g. spilled by the writer thread, rather than spooled for a lost connection.
+            self._replayer.resume()
+
+    def _migrate_legacy_backups(self):
+        if not utils.validate_file_exists(_DB_FAILED_WRITES_LEGACY):
+            return
+        utils.v_print(f'Moving backups from {_DB_FAILED_WRITES_LEGACY} into {DB_FAILED_WRITES}...')
+        chunk = []
+        with open(_DB_FAILED_WRITES_LEGACY, 'rb') as db_backups:
+            unpickler = _LegacyUnpickler(db_backups)
             while True:
                 try:
-                    backups.append(pickle.load(db_backups))
+                    chunk.append(unpickler.load().to_capture())
                 except EOFError:
                     break
-        return backups
+                if len(chunk) >= self._batch_size:
+                    self._write_locals(chunk)
+                    chunk = []
+        self._write_locals(chunk)
+        os.remove(_DB_FAILED_WRITES_LEGACY)
 
     def shutdown(self):
         if not self._local:
+            if self._compressor is not None:
+                # End every compressed field on its latest value.
+                self._batch.extend(self._compressor.finish())
+                utils.v_print(self._compressor.summary())
+            self.flush()
+            # Whatever the replay hasn't sent yet stays in the local backup for next time.
+            self._replayer.stop(timeout=_DB_TIMEOUT * 2)
             if self._connection_ok:
                 self._influx.close()
+            if self._backlog_influx is not None:
+                self._backlog_influx.close()
+            if self._udp is not None:
+                self._udp.close()
+        for history in self._history.values():
+            history.close()
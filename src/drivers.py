@@ -0,0 +1,150 @@
+import csv
+import math
+import random
+
+import psutil
+
+import cpu_temp
+
+DRIVER_BME680 = 'bme680'
+DRIVER_SIMULATED = 'simulated'
+DRIVER_REPLAY = 'replay'
+DRIVERS = [DRIVER_BME680, DRIVER_SIMULATED, DRIVER_REPLAY]
+_SIMULATED_SEED = 680
+# How far the simulated CPU runs above the room, and the rounding factor its heat reaches the sensor by (the default
+# sensor config's), so compensating the simulated readings gives back the room's temperature.
+_SIMULATED_CPU_WARMTH = 20.0
+_SIMULATED_ROUNDING_FACTOR = 0.7
+
+
+def create_driver(name=DRIVER_BME680, i2c_addr=None, replay_file=None, i2c_bus=1, seed=_SIMULATED_SEED,
+                  rounding_factor=_SIMULATED_ROUNDING_FACTOR):
+    """
+    Creates the object which readings are taken from.
+    Anything returned here behaves like a bme680.BME680, so the Sensor doesn't need to know which one it has.
+    """
+    if name == DRIVER_SIMULATED:
+        return SimulatedBME680(seed=seed, rounding_factor=rounding_factor)
+    if name == DRIVER_REPLAY:
+        return ReplayBME680(replay_file)
+    # Only needs the I2C bus when the real thing is asked for.
+    import bme680
+    import smbus
+    return bme680.BME680(bme680.I2C_ADDR_PRIMARY if i2c_addr is None else i2c_addr, i2c_device=smbus.SMBus(i2c_bus))
+
+
+def create_cpu_reader(name, driver):
+    """Returns a function giving the current CPU temperature, used to compensate the sensor's temperature."""
+    if name != DRIVER_BME680:
+        return driver.cpu_temperature
+    zone = cpu_temp.find_cpu_thermal_zone()
+    if zone is not None:
+        return cpu_temp.SysfsCpuThermometer(zone)
+    # Somewhere without the usual sysfs layout, so take the slow but portable route.
+    return lambda: psutil.sensors_temperatures()['cpu_thermal'][0][1]
+
+
+class _FieldData:
+    temperature = 0.0
+    pressure = 0.0
+    humidity = 0.0
+    gas_resistance = 0.0
+    heat_stable = False
+
+
+class _NoOpSettings:
+    # Mirrors the bme680.BME680 configuration calls, none of which mean anything off the real sensor.
+    def set_gas_status(self, value):
+        pass
+
+    def set_pressure_oversample(self, value):
+        pass
+
+    def set_temperature_oversample(self, value):
+        pass
+
+    def set_temp_offset(self, value):
+        pass
+
+    def set_filter(self, value):
+        pass
+
+    def set_humidity_oversample(self, value):
+        pass
+
+    def set_gas_heater_temperature(self, value, nb_profile=0):
+        pass
+
+    def set_gas_heater_duration(self, value, nb_profile=0):
+        pass
+
+    def select_gas_heater_profile(self, value):
+        pass
+
+
+class SimulatedBME680(_NoOpSettings):
+    """
+    A deterministic stand in for the BME680, producing slowly drifting values with a little noise.
+    Every not_ready_every'th call reports the data as not ready yet, to exercise the sensor's wait loop.
+
+    The CPU runs a little warmer than the room, and the temperature read is the room's warmed by the CPU by as much as
+    compensating with rounding_factor takes off again, as it would be with a well chosen factor on a real Pi.
+    """
+
+    def __init__(self, seed=_SIMULATED_SEED, not_ready_every=0, rounding_factor=_SIMULATED_ROUNDING_FACTOR):
+        self.data = _FieldData()
+        self._random = random.Random(seed)
+        self._not_ready_every = not_ready_every
+        self._rounding_factor = rounding_factor
+        self._calls = 0
+        self._cpu_temperature = 21.0 + _SIMULATED_CPU_WARMTH
+
+    def get_sensor_data(self):
+        self._calls += 1
+        if self._not_ready_every and self._calls % self._not_ready_every == 0:
+            return False
+        # One slow cycle per 1000 readings, so values move but stay in a plausible range.
+        phase = math.sin((2 * math.pi * self._calls) / 1000)
+        ambient = 21.0 + (2.0 * phase) + self._random.gauss(0, 0.05)
+        self._cpu_temperature = ambient + _SIMULATED_CPU_WARMTH + (2.0 * math.sin((2 * math.pi * self._calls) / 250))
+        # The reading that compensate_temperature turns back into the ambient temperature.
+        factor = self._rounding_factor
+        self.data.temperature = ((factor * ambient) + self._cpu_temperature) / (factor + 1)
+        self.data.pressure = 1013.25 + (1.5 * phase) + self._random.gauss(0, 0.02)
+        self.data.humidity = 42.0 - (5.0 * phase) + self._random.gauss(0, 0.1)
+        self.data.gas_resistance = 120000.0 + (15000.0 * phase) + self._random.gauss(0, 500)
+        self.data.heat_stable = True
+        return True
+
+    def cpu_temperature(self):
+        return self._cpu_temperature
+
+
+class ReplayBME680(_NoOpSettings):
+    """
+    Plays back readings from a CSV file with temperature, humidity, pressure and gas columns, and optionally a
+    cpu_temperature column. Starts again from the top once the end of the file is reached.
+    """
+
+    def __init__(self, path):
+        self.data = _FieldData()
+        with open(path, 'r', newline='') as replay_file:
+            self._rows = [{key: float(value) for key, value in row.items()} for row in csv.DictReader(replay_file)]
+        if not self._rows:
+            raise ValueError(f'Replay file {path} has no readings in it.')
+        self._next = 0
+        self._cpu_temperature = 0.0
+
+    def get_sensor_data(self):
+        row = self._rows[self._next]
+        self._next = (self._next + 1) % len(self._rows)
+        self.data.temperature = row['temperature']
+        self.data.pressure = row['pressure']
+        self.data.humidity = row['humidity']
+        self.data.gas_resistance = row['gas']
+        self.data.heat_stable = True
+        self._cpu_temperature = row.get('cpu_temperature', self.data.temperature)
+        return True
+
+    def cpu_temperature(self):
+        return self._cpu_temperature
@@ -0,0 +1,335 @@
+import collections
+import gzip
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+import metrics
+import utils
+from data_logging import DB_TABLE, DB_USER, DB_PASS, provision_database
+from line_protocol import GZIP_WRITE_HEADERS, PRECISION_NS, WRITE_HEADERS
+from reconnect import ReconnectBackoff
+from rollups import LATE_READING_NS, backfill_rollups
+from spool import LineSpool
+
+GATEWAY_PORT = 8087
+GATEWAY_SPOOL = 'gateway_spool'
+GATEWAY_BATCH_SIZE = 5000
+GATEWAY_BATCH_MAX_AGE = 10  # Seconds
+_UPSTREAM_TIMEOUT = 10
+_GZIP_LEVEL = 1
+# How many of the latest readings are remembered to spot duplicates, e.g. a batch a node sent again after never
+# seeing the response to the first attempt.
+_DEDUP_WINDOW = 100000
+# The most readings held in memory, beyond which they go straight to the spool.
+_MAX_PENDING = 100000
+_MAX_DATAGRAM = 65535
+_IDLE_CHECK_SECS = 1
+_MEASUREMENT = 'AQ'
+# How long after the last late reading (e.g. from a node's backup) before they are rolled up, so a node catching up is
+# rolled up once, when it has finished, rather than after every batch.
+_ROLLUP_QUIET_SECS = 60
+# Timestamp multipliers, to nanoseconds, for the precisions the influxDB write API accepts.
+_PRECISIONS = {'n': 1, 'ns': 1, 'u': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+
+
+def _normalise(line, scale):
+    # Gives the line back with a nanosecond timestamp, so lines sent with any precision can be compared and batched.
+    line = line.strip()
+    if not line or line.startswith(b'#'):
+        return None
+    # The series ends at the first space which isn't escaped, and the timestamp (if there is one) follows the last.
+    series_end = line.find(b' ')
+    while series_end > 0 and line[series_end - 1] == ord('\\'):
+        series_end = line.find(b' ', series_end + 1)
+    if series_end <= 0:
+        raise ValueError(f'Unable to parse line {line[:100]!r}')
+    head, _, timestamp = line.rpartition(b' ')
+    if len(head) > series_end and timestamp.lstrip(b'-').isdigit():
+        return b'%s %d\n' % (head, int(timestamp) * scale)
+    return b'%s %d\n' % (line, time.time_ns())
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    # Kept alive, so each node holds one connection open rather than making one per batch.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/ping':
+            self._respond(204)
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/write':
+            self._respond(404)
+            return
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        try:
+            self.server.gateway.receive(body, parse_qs(url.query).get('precision', [PRECISION_NS])[0], 'http')
+        except ValueError as err:
+            self._respond(400, str(err).encode('utf-8'))
+            return
+        self._respond(204)
+
+    def _respond(self, code, body=b''):
+        self.send_response(code)
+        # The influxDB client checks for this to tell that it is talking to influxDB.
+        self.send_header('X-Influxdb-Version', 'aq-gateway')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every node write would otherwise fill the console.
+        pass
+
+
+class Gateway:
+    """
+    Collects readings pushed by nodes, over HTTP (the influxDB /write API) or UDP (line protocol datagrams), and
+    forwards them to influxDB in large batches over a single connection.
+
+    Readings which have already been received recently are dropped, so a node sending a batch again doesn't double it
+    up. While influxDB can't be reached batches go to a spool of their own, which is sent on, behind the live
+    readings, once it can be again.
+    """
+
+    def __init__(self, hostname, port=8086, listen_port=GATEWAY_PORT, batch_size=GATEWAY_BATCH_SIZE,
+                 batch_max_age=GATEWAY_BATCH_MAX_AGE, gzip_writes=False, retention=None, listen_address=''):
+        self._hostname = hostname
+        self._port = port
+        self._batch_size = batch_size
+        self._batch_max_age = batch_max_age
+        self._gzip = gzip_writes
+        self._retention = retention
+        self._pending = []
+        self._batch_started = 0.0
+        self._stopping = False
+        # Guards the pending readings and the duplicate check, which every listener thread shares.
+        self._condition = threading.Condition()
+        self._seen = set()
+        self._seen_order = collections.deque()
+        # The oldest and newest late readings sent on, and when the last was, until they are rolled up.
+        self._late = None
+        self._late_at = 0.0
+
+        self._backoff = ReconnectBackoff()
+        self._provisioned = False
+        # Whether the rollups were set up, so late readings can be rolled up.
+        self._rollups = False
+        self._connection_ok = False
+        self._influx = InfluxDBClient(host=hostname, port=port, username=DB_USER, password=DB_PASS,
+                                      database=DB_TABLE, timeout=_UPSTREAM_TIMEOUT)
+        self._spool = LineSpool(GATEWAY_SPOOL)
+        metrics.spool_depth.set_function(lambda: len(self._spool))
+
+        self._http = ThreadingHTTPServer((listen_address, listen_port), _GatewayHandler)
+        self._http.daemon_threads = True
+        self._http.gateway = self
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((listen_address, listen_port))
+        # Wakes up now and then, as closing the socket doesn't interrupt a receive already waiting.
+        self._udp.settimeout(_IDLE_CHECK_SECS)
+        self._threads = [threading.Thread(target=self._http.serve_forever, name='gateway-http', daemon=True),
+                         threading.Thread(target=self._receive_udp, name='gateway-udp', daemon=True),
+                         threading.Thread(target=self._run, name='gateway-forwarder', daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        utils.log.info(f'Gateway listening on port {self._http.server_address[1]}, forwarding to '
+                       f'{self._hostname}:{self._port}.')
+
+    def receive(self, body, precision, transport):
+        """Accepts a body of line protocol from a node, returning how many of its readings were new."""
+        scale = _PRECISIONS.get(precision)
+        if scale is None:
+            raise ValueError(f'Unknown precision \'{precision}\'')
+        lines = [line for line in (_normalise(line, scale) for line in body.splitlines()) if line is not None]
+
+        overflow = []
+        with self._condition:
+            accepted = []
+            for line in lines:
+                key = hash(line)
+                if key in self._seen:
+                    continue
+                self._seen.add(key)
+                self._seen_order.append(key)
+                if len(self._seen_order) > _DEDUP_WINDOW:
+                    self._seen.discard(self._seen_order.popleft())
+                accepted.append(line)
+            if accepted and not self._pending:
+                self._batch_started = time.monotonic()
+            self._pending.extend(accepted)
+            if len(self._pending) > _MAX_PENDING:
+                # Forwarding has fallen behind, so keep the oldest readings on disk rather than in memory.
+                overflow, self._pending = self._pending[:-_MAX_PENDING], self._pending[-_MAX_PENDING:]
+            if self._batch_is_due():
+                self._condition.notify()
+        if overflow:
+            self._spool_lines(overflow)
+        if metrics.enabled:
+            metrics.gateway_points_received.inc(transport, amount=len(lines))
+            metrics.gateway_duplicates.inc(amount=len(lines) - len(accepted))
+        return len(accepted)
+
+    def _receive_udp(self):
+        while not self._stopping:
+            try:
+                datagram = self._udp.recv(_MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                # The socket was closed by shutdown.
+                break
+            try:
+                # Like influxDB's own UDP listener, datagrams are taken to be in nanoseconds.
+                self.receive(datagram, PRECISION_NS, 'udp')
+            except ValueError as err:
+                utils.log.warning(f'Dropped a datagram which was not line protocol, {err}',
+                                  extra=utils.rate_limited('datagram'))
+
+    def _batch_is_due(self):
+        return len(self._pending) >= self._batch_size or \
+            (self._pending and time.monotonic() - self._batch_started >= self._batch_max_age)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopping and not self._batch_is_due():
+                    self._condition.wait(timeout=_IDLE_CHECK_SECS)
+                if self._stopping and not self._pending:
+                    break
+                batch = []
+                if self._stopping or self._batch_is_due():
+                    batch, self._pending = self._pending[:self._batch_size], self._pending[self._batch_size:]
+            if batch:
+                self._forward(batch)
+            elif not self._stopping and len(self._spool) and self._connected():
+                # Only caught up on while there is nothing live to send.
+                self._replay()
+            elif not self._stopping and self._late is not None and \
+                    time.monotonic() - self._late_at >= _ROLLUP_QUIET_SECS and self._connected():
+                self._rollup_late()
+
+    def _connected(self):
+        if self._connection_ok:
+            return True
+        if not self._backoff.allows_attempt():
+            return False
+        if metrics.enabled:
+            metrics.reconnect_attempts.inc()
+        try:
+            if not self._provisioned:
+                self._rollups = provision_database(self._hostname, self._port, self._retention)
+                self._provisioned = True
+            self._influx.ping()
+        except Exception as err:
+            delay = self._backoff.failed()
+            utils.log.warning(f'Failed to connect to {self._hostname}:{self._port}, spooling readings until it can be. '
+                              f'Retrying in {delay:.0f} seconds. {err}', extra=utils.rate_limited('connect'))
+            return False
+        self._connection_ok = True
+        self._backoff.succeeded()
+        utils.log.info(f'Connection to {self._hostname}:{self._port} successful.')
+        return True
+
+    def _forward(self, batch):
+        if not self._connected() or not self._send(batch):
+            self._spool_lines(batch)
+
+    def _replay(self):
+        lines = self._spool.peek(self._batch_size)
+        if lines and self._send(lines):
+            self._spool.commit(lines)
+            if metrics.enabled:
+                metrics.points_replayed.inc(amount=len(lines))
+            utils.v_print(f'Sent {len(lines)} spooled readings, {len(self._spool)} still to send.')
+
+    def _send(self, lines):
+        started = time.perf_counter()
+        body = b''.join(lines)
+        headers = WRITE_HEADERS
+        if self._gzip:
+            body = gzip.compress(body, compresslevel=_GZIP_LEVEL)
+            headers = GZIP_WRITE_HEADERS
+        try:
+            self._influx.request(url='write', method='POST', data=body, headers=headers,
+                                 params={'db': DB_TABLE, 'precision': PRECISION_NS}, expected_response_code=204)
+        except InfluxDBClientError as err:
+            if err.code != 400:
+                return self._send_failed(err)
+            # The readings themselves were rejected, which sending them again won't change.
+            utils.log.error(f'influxDB rejected a batch of {len(lines)} readings, dropping it. {err}')
+            if metrics.enabled:
+                metrics.points_dropped.inc(amount=len(lines))
+            return True
+        except Exception as err:
+            return self._send_failed(err)
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'write')
+            metrics.points_written.inc(amount=len(lines))
+        self._note_late(lines)
+        return True
+
+    def _note_late(self, lines):
+        if not self._rollups:
+            return
+        # Every line has a nanosecond timestamp at the end, once normalised.
+        cutoff = time.time_ns() - LATE_READING_NS
+        late = [timestamp for timestamp in (int(line[line.rfind(b' ') + 1:]) for line in lines) if timestamp < cutoff]
+        if not late:
+            return
+        oldest, newest = min(late), max(late)
+        if self._late is not None:
+            oldest, newest = min(oldest, self._late[0]), max(newest, self._late[1])
+        self._late = (oldest, newest)
+        self._late_at = time.monotonic()
+
+    def _rollup_late(self):
+        # Too late for the continuous queries to have taken in, so they'd be missing from the rollups.
+        span, self._late = self._late, None
+        try:
+            backfill_rollups(self._influx, DB_TABLE, _MEASUREMENT, *span)
+        except Exception as err:
+            utils.log.warning(f'Failed to roll up the late readings sent to influxDB, so they are missing from the '
+                              f'rollups. {err}')
+            return
+        utils.v_print('Rolled up the late readings sent to influxDB.')
+
+    def _send_failed(self, err):
+        utils.log.warning(f'Failed to write to influxDB, {err}', extra=utils.rate_limited('write'))
+        if metrics.enabled:
+            metrics.write_failures.inc()
+        self._connection_ok = False
+        self._backoff.failed()
+        return False
+
+    def _spool_lines(self, lines):
+        started = time.perf_counter()
+        self._spool.append(lines)
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'spool')
+            metrics.points_spooled.inc(amount=len(lines))
+
+    def shutdown(self):
+        # Stop taking new readings, then forward (or spool) everything already taken.
+        self._http.shutdown()
+        self._http.server_close()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._threads[1].join()
+        self._udp.close()
+        self._threads[2].join()
+        self._influx.close()
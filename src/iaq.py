@@ -0,0 +1,60 @@
+import numpy as np
+
+import cpu_temp
+import sensor
+
+
+def iaq_index(humidity, gas, humidity_baseline, gas_baseline, quality_weighting):
+    """
+    Column-wise version of sensor.calculate_iaq_index.
+    Takes arrays of humidity and gas readings and returns an array of quality scores, identical to the scalar ones.
+    """
+    humidity = np.asarray(humidity, dtype=np.float64)
+    gas = np.asarray(gas, dtype=np.float64)
+    humidity_weight = quality_weighting * 100
+
+    # Same operations in the same order as the scalar path, so the results match exactly.
+    humidity_offset = humidity - humidity_baseline
+    hum_score = np.where(humidity_offset > 0,
+                         (100 - humidity_baseline - humidity_offset) / (100 - humidity_baseline),
+                         (humidity_baseline + humidity_offset) / humidity_baseline)
+    hum_score *= humidity_weight
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gas_score = np.where(gas - gas_baseline > 0,
+                             (gas / gas_baseline) * (100 - humidity_weight),
+                             100 - humidity_weight)
+
+    return hum_score + gas_score
+
+
+def compensate_temperature(temperature, cpu_temperature, smoothing_strength, rounding_factor, history=None):
+    """
+    Column-wise version of cpu_temp.CpuCompensation, in its (default) window mode.
+
+    Each reading is offset by the mean of the CPU temperatures over the same window the Sensor would have used.
+    To process a long series in chunks, pass the CPU temperatures from the end of the previous chunk as history.
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    cpu_temperature = np.asarray(cpu_temperature, dtype=np.float64)
+    window = max(smoothing_strength, 1)
+    if history is not None and len(history):
+        history = np.asarray(history, dtype=np.float64)[-window:]
+    else:
+        history = np.empty(0, dtype=np.float64)
+
+    # Rolling mean over a window which grows up to smoothing_strength, from a running sum.
+    series = np.concatenate((history, cpu_temperature))
+    totals = np.concatenate(([0.0], np.cumsum(series)))
+    ends = np.arange(len(history), len(series)) + 1
+    starts = np.maximum(ends - window, 0)
+    recent_avg = (totals[ends] - totals[starts]) / (ends - starts)
+
+    return cpu_temp.compensate_temperature(temperature, recent_avg, rounding_factor)
+
+
+def matches_scalar(humidity, gas, humidity_baseline, gas_baseline, quality_weighting, quality):
+    """Checks an array of quality scores from iaq_index against the scalar calculation, reading by reading."""
+    expected = [sensor.calculate_iaq_index(h, g, humidity_baseline, gas_baseline, quality_weighting)
+                for h, g in zip(humidity, gas)]
+    return np.array_equal(np.asarray(expected, dtype=np.float64), np.asarray(quality, dtype=np.float64))
@@ -0,0 +1,128 @@
+import itertools
+import socket
+
+from sample_batch import NANOSECONDS, SampleBatch
+
+PRECISION_MS = 'ms'
+PRECISION_NS = 'ns'
+# Timestamp divisors, from nanoseconds.
+_PRECISIONS = {PRECISION_MS: NANOSECONDS // 1000, PRECISION_NS: 1}
+# Kept under a typical MTU, so a datagram is never fragmented (and so never lost whole for one lost fragment).
+UDP_MAX_PAYLOAD = 1400
+WRITE_HEADERS = {'Content-Type': 'application/octet-stream', 'Accept': 'text/plain'}
+GZIP_WRITE_HEADERS = {**WRITE_HEADERS, 'Content-Encoding': 'gzip'}
+_KEY_ESCAPES = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ '})
+_MEASUREMENT_ESCAPES = str.maketrans({',': r'\,', ' ': r'\ '})
+# Reading attribute, and the field it is written as.
+READING_FIELDS = (('temperature', 'temperature'),
+                  ('humidity', 'humidity'),
+                  ('pressure', 'pressure'),
+                  ('gas', 'gas'),
+                  ('iaq_index', 'quality'))
+
+
+def _escape_key(value):
+    return str(value).translate(_KEY_ESCAPES)
+
+
+def _format_value(value):
+    # Keeps the field types the influxdb client gave them, so points written either way land in the same fields.
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    return repr(float(value))
+
+
+def render_line(measurement, tags, fields, timestamp):
+    """Renders any single point, skipping fields without a value. The timestamp is an integer in the precision used."""
+    tag_set = ''.join(f',{_escape_key(key)}={_escape_key(value)}' for key, value in sorted(tags.items())
+                      if value not in (None, ''))
+    field_set = ','.join(f'{_escape_key(key)}={_format_value(value)}' for key, value in fields.items()
+                         if value is not None)
+    return f'{measurement.translate(_MEASUREMENT_ESCAPES)}{tag_set} {field_set} {timestamp}'
+
+
+class LineEncoder:
+    """
+    Turns readings into InfluxDB line protocol.
+
+    The measurement and the tags which never change are rendered once, as is the tag set of each sensor the first
+    time it is seen, so each point only costs formatting its own field values and integer timestamp.
+    """
+
+    def __init__(self, measurement, tags, precision=PRECISION_MS):
+        self._prefix = measurement.translate(_MEASUREMENT_ESCAPES) + \
+            ''.join(f',{_escape_key(key)}={_escape_key(value)}' for key, value in sorted(tags.items()))
+        self._divisor = _PRECISIONS[precision]
+        self.precision = precision
+        self._sensor_prefixes = {}
+        self._buffer = bytearray()
+
+    def _sensor_prefix(self, sensor):
+        prefix = self._sensor_prefixes.get(sensor)
+        if prefix is None:
+            # Tags stay in key order, which InfluxDB handles fastest.
+            prefix = self._sensor_prefixes[sensor] = f'{self._prefix},sensor={_escape_key(sensor)} '
+        return prefix
+
+    def encode(self, batch):
+        """
+        Returns the batch (a SampleBatch, or a list of readings) as line protocol, in a buffer which is re-used by the
+        next call, so it has to be sent (or copied) before then.
+        """
+        if not isinstance(batch, SampleBatch):
+            batch = SampleBatch.from_readings(list(batch))
+        buffer = self._buffer
+        del buffer[:]
+        prefixes = [self._sensor_prefix(sensor) for sensor in batch.sensors]
+        timestamps = batch.timestamps
+        if self._divisor > 1:
+            timestamps = (timestamps + (self._divisor // 2)) // self._divisor
+        # Whole columns are turned into python values at once, rather than a value at a time.
+        rows = zip(timestamps.tolist(), *batch.values.tolist(), batch.calibrating.tolist(), batch.partial.tolist(),
+                   batch.sensor_ids.tolist(), batch.stats if batch.stats is not None else itertools.repeat(None))
+        for timestamp, temperature, humidity, pressure, gas, iaq_index, calibrating, partial, sensor, stats in rows:
+            if not partial:
+                line = f'{prefixes[sensor]}temperature={temperature!r},humidity={humidity!r},' \
+                       f'pressure={pressure!r},gas={gas!r},quality={iaq_index!r},' \
+                       f'calibrating={_format_value(calibrating)}'
+            else:
+                # Only some of the values are being sent, the rest were dropped by compression (and are NaN).
+                values = (temperature, humidity, pressure, gas, iaq_index)
+                line = prefixes[sensor] + \
+                    ''.join(f'{field}={value!r},' for (_, field), value in zip(READING_FIELDS, values)
+                            if value == value) + \
+                    f'calibrating={_format_value(calibrating)}'
+            if stats:
+                line += ''.join(f',{_escape_key(key)}={_format_value(value)}' for key, value in stats.items())
+            buffer += f'{line} {timestamp}\n'.encode('utf-8')
+        return buffer
+
+
+class UdpTransport:
+    """Sends line protocol to an InfluxDB UDP listener, split into datagrams on line boundaries."""
+
+    def __init__(self, host, port, max_payload=UDP_MAX_PAYLOAD):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.connect((host, port))
+        self._max_payload = max_payload
+
+    def send(self, body):
+        # The view has to be released even if a send fails, or the encoder can't re-use its buffer.
+        with memoryview(body) as view:
+            start = 0
+            while start < len(body):
+                end = len(body)
+                if end - start > self._max_payload:
+                    # Split after the last whole line which fits, or after the first line if even that doesn't.
+                    end = body.rfind(b'\n', start, start + self._max_payload) + 1
+                    if end <= start:
+                        end = body.index(b'\n', start) + 1
+                self._socket.send(view[start:end])
+                start = end
+
+    def close(self):
+        self._socket.close()
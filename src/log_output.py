@@ -0,0 +1,135 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import utils
+
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+LOG_FORMATS = [LOG_FORMAT_TEXT, LOG_FORMAT_JSON]
+LOG_ROTATE_SIZE = 'size'
+LOG_ROTATE_HOURLY = 'hourly'
+LOG_ROTATE_DAILY = 'daily'
+LOG_ROTATIONS = [LOG_ROTATE_SIZE, LOG_ROTATE_HOURLY, LOG_ROTATE_DAILY]
+LOG_MAX_MB = 10
+LOG_BACKUPS = 5
+# The shortest time between two messages with the same rate limit key.
+RATE_LIMIT_SECS = 60
+_ROTATE_WHEN = {LOG_ROTATE_HOURLY: 'H', LOG_ROTATE_DAILY: 'midnight'}
+_TEXT_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+_listener = None
+_rate_limit = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a message logged with a rate limit key (see utils.rate_limited) through at most once per interval, so e.g. a
+    failure repeated on every reading is only logged once a minute. The next one let through says how many were held
+    back, so none go unmentioned.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_SECS):
+        super().__init__()
+        self._interval = interval
+        self._lock = threading.Lock()
+        # When each key was last let through, and how many have been held back since.
+        self._windows = {}
+
+    def filter(self, record):
+        key = getattr(record, 'rate_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and now - window[0] < self._interval:
+                window[1] += 1
+                return False
+            held_back = window[1] if window is not None else 0
+            self._windows[key] = [now, 0]
+        if held_back:
+            record.msg = f'{record.getMessage()} ({held_back} more like this in the last {now - window[0]:.0f}s)'
+            record.args = None
+        return True
+
+    def held_back(self):
+        with self._lock:
+            return {key: window[1] for key, window in self._windows.items() if window[1]}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each message as a single JSON object, for a log which is to be parsed rather than read."""
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _BelowLevel(logging.Filter):
+    def __init__(self, level):
+        super().__init__()
+        self._level = level
+
+    def filter(self, record):
+        return record.levelno < self._level
+
+
+def configure(path=None, log_format=LOG_FORMAT_TEXT, rotate=LOG_ROTATE_SIZE, max_mb=LOG_MAX_MB,
+              backups=LOG_BACKUPS):
+    """
+    Sends everything logged through a queue to a thread of its own, so logging never waits on the console or the SD
+    card. Messages go to the console, as before, unless a path is given, in which case they go to that file (rotated
+    by size or time, with the given number of old files kept) and only warnings and errors go to the console.
+    """
+    global _listener, _rate_limit
+    stop()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    console.addFilter(_BelowLevel(logging.WARNING))
+    errors = logging.StreamHandler(sys.stderr)
+    errors.setFormatter(logging.Formatter('%(message)s'))
+    errors.setLevel(logging.WARNING)
+    handlers = [console, errors]
+    if path is not None:
+        if rotate == LOG_ROTATE_SIZE:
+            log_file = logging.handlers.RotatingFileHandler(path, maxBytes=int(max_mb * 1024 * 1024),
+                                                            backupCount=backups, encoding='utf-8')
+        else:
+            log_file = logging.handlers.TimedRotatingFileHandler(path, when=_ROTATE_WHEN[rotate],
+                                                                 backupCount=backups, encoding='utf-8')
+        log_file.setFormatter(JsonFormatter() if log_format == LOG_FORMAT_JSON else logging.Formatter(_TEXT_FORMAT))
+        handlers = [log_file, errors]
+
+    # Held back messages are dropped before they are queued, so they cost the caller as little as possible.
+    _rate_limit = RateLimitFilter()
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(_rate_limit)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    # Other libraries' messages only when something is wrong, all of the application's own.
+    root.setLevel(logging.WARNING)
+    utils.log.setLevel(logging.INFO)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Writes out everything still queued, along with how many messages are still being held back."""
+    global _listener
+    # Taken first, so a second signal arriving while this waits on the listener doesn't wait on it again.
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+    for key, count in _rate_limit.held_back().items():
+        utils.log.info(f'{count} more \'{key}\' messages were held back by the rate limit.')
+    listener.stop()
@@ -1,14 +1,76 @@
 #!/usr/bin/env python3
 import argparse
-import sched
+import math
+import re
 import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
+import drivers
+import log_output
+import metrics
 import utils
-from data_logging import DataLogging
-from sensor import Sensor
+from aggregation import WindowAggregator
+from compression import Compressor, COMPRESSION_MODES, DEFAULT_TOLERANCES, HEARTBEAT_SECS
+from data_logging import DataLogging, DB_BATCH_SIZE, DB_BATCH_MAX_AGE
+from gateway import Gateway, GATEWAY_BATCH_SIZE, GATEWAY_BATCH_MAX_AGE, GATEWAY_PORT
+from profiling import Profiler, PROFILE_INTERVAL_SECS
+from replay import REPLAY_BATCH_SIZE, REPLAY_RATE
+from rollups import RETENTION_NAMES, is_duration
+from scheduler import DeadlineScheduler
+from sensor import Sensor, SensorTimeout
+from writer import BackgroundWriter, OVERFLOW_BLOCK, OVERFLOW_POLICIES, OVERFLOW_SPILL, WRITER_QUEUE_SIZE
 
 logger = DataLogging()
-sensor = Sensor
+scheduler = DeadlineScheduler()
+writer = None
+gateway = None
+profiler = None
+sensors = []
+aggregators = {}
+read_pool = None
+_MAX_SAMPLE_RATE = 10  # Per second
+_DEFAULT_SENSOR = (utils.DEFAULT_SENSOR_NAME, 0x76, 1)
+
+
+def parse_sensor(value):
+    # NAME[:ADDRESS[:BUS]], e.g. 'secondary:0x77' or 'attic:0x76:3'.
+    parts = value.split(':')
+    if not (1 <= len(parts) <= 3) or not re.fullmatch(r'[A-Za-z0-9_-]+', parts[0]):
+        raise argparse.ArgumentTypeError(f'\'{value}\' should be NAME[:ADDRESS[:BUS]], where the name only uses '
+                                         f'letters, numbers, \'-\' and \'_\'.')
+    try:
+        address = int(parts[1], 0) if len(parts) > 1 else _DEFAULT_SENSOR[1]
+        bus = int(parts[2], 0) if len(parts) > 2 else _DEFAULT_SENSOR[2]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'The address and bus of \'{value}\' must be numbers.')
+    return parts[0], address, bus
+
+
+def parse_tolerance(value):
+    # FIELD=TOLERANCE, e.g. 'pressure=0.1'.
+    field, _, tolerance = value.partition('=')
+    if field not in DEFAULT_TOLERANCES:
+        raise argparse.ArgumentTypeError(f'\'{field}\' is not a field which can be compressed, choose from '
+                                         f'{", ".join(DEFAULT_TOLERANCES)}.')
+    try:
+        tolerance = float(tolerance)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'The tolerance of \'{value}\' must be a number.')
+    if tolerance < 0:
+        raise argparse.ArgumentTypeError(f'The tolerance of \'{value}\' must not be negative.')
+    return field, tolerance
+
+
+def parse_retention(value):
+    # NAME=DURATION, e.g. 'raw=30d' or '1d=INF'.
+    name, _, duration = value.partition('=')
+    if name not in RETENTION_NAMES:
+        raise argparse.ArgumentTypeError(f'\'{name}\' is not a retention policy, choose from '
+                                         f'{", ".join(RETENTION_NAMES)}.')
+    if not is_duration(duration):
+        raise argparse.ArgumentTypeError(f'\'{duration}\' is not an influxDB duration, e.g. 30d, 12w or INF.')
+    return name, duration
 
 
 def get_commandline_args():
@@ -27,6 +89,53 @@ def get_commandline_args():
                                  action="store_true",
                                  default=False)
 
+    # Allow the output to go to a rotated file, rather than growing without limit on the console.
+    argument_parser.add_argument("--log-file",
+                                 type=str,
+                                 help="Write the application's messages to this file, rather than the console, which "
+                                      "then only shows warnings and errors.",
+                                 default=None)
+    argument_parser.add_argument("--log-format",
+                                 choices=log_output.LOG_FORMATS,
+                                 help="How messages are written to the log file, as text or as JSON lines.",
+                                 default=log_output.LOG_FORMAT_TEXT)
+    argument_parser.add_argument("--log-rotate",
+                                 choices=log_output.LOG_ROTATIONS,
+                                 help="Start a new log file once it reaches --log-max-mb, or every hour or day.",
+                                 default=log_output.LOG_ROTATE_SIZE)
+    argument_parser.add_argument("--log-max-mb",
+                                 type=float,
+                                 help="How large the log file may grow before a new one is started.",
+                                 default=log_output.LOG_MAX_MB)
+    argument_parser.add_argument("--log-backups",
+                                 type=int,
+                                 help="How many old log files to keep.",
+                                 default=log_output.LOG_BACKUPS)
+    argument_parser.add_argument("--echo-every",
+                                 type=int,
+                                 help="Log every Nth reading. 0 for none.",
+                                 default=1)
+
+    # Allow the sensor to be swapped for a stand in, for testing off the Pi.
+    argument_parser.add_argument("--driver",
+                                 choices=drivers.DRIVERS,
+                                 help="Where readings come from. The real sensor, a simulated one, or a replayed file.",
+                                 default=drivers.DRIVER_BME680)
+    argument_parser.add_argument("--replay-file",
+                                 type=str,
+                                 help="CSV file of temperature,humidity,pressure,gas(,cpu_temperature) readings to "
+                                      "play back, for use with '--driver replay'.",
+                                 default=None)
+
+    # Allow several sensors to be read by the one process.
+    argument_parser.add_argument("--sensor",
+                                 type=parse_sensor,
+                                 action="append",
+                                 metavar="NAME[:ADDRESS[:BUS]]",
+                                 help="A sensor to read from, e.g. 'secondary:0x77'. Repeat for each sensor. Defaults "
+                                      "to a single sensor called 'primary' at 0x76 on I2C bus 1.",
+                                 default=None)
+
     # Add a group to make the user choose between local and persistence.
     mode_group = argument_parser.add_mutually_exclusive_group(required=True)
     mode_group.add_argument("-l", "--local",
@@ -39,6 +148,11 @@ def get_commandline_args():
                                  "remote database.)",
                             action="store_true",
                             default=False)
+    mode_group.add_argument("-g", "--gateway",
+                            help="Choose to run the program as a gateway. (Will collect readings from other nodes, "
+                                 "and forward them to the remote database, rather than reading a sensor.)",
+                            action="store_true",
+                            default=False)
 
     # Add arguments for the remote logging server.
     argument_parser.add_argument("-db", "--database",
@@ -49,74 +163,396 @@ def get_commandline_args():
                                  type=int,
                                  help="The port of your influxDB instance. (1024-65535)",
                                  default=8086)
+    argument_parser.add_argument("--via-gateway",
+                                 help="The database given is a gateway (see --gateway) rather than influxDB, which "
+                                      "provisions the database itself.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--listen-port",
+                                 type=int,
+                                 help="The port a gateway takes readings from nodes on, over both HTTP and UDP.",
+                                 default=GATEWAY_PORT)
+    argument_parser.add_argument("--gzip",
+                                 help="Compress the readings sent to influxDB.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--udp-port",
+                                 type=int,
+                                 help="Send readings to the UDP listener of your influxDB instance on this port, "
+                                      "rather than over HTTP. Nothing confirms UDP writes arrived, so none are kept "
+                                      "in the local backup.",
+                                 default=None)
+    argument_parser.add_argument("--retention",
+                                 type=parse_retention,
+                                 action="append",
+                                 metavar="NAME=DURATION",
+                                 help="How long influxDB keeps the raw readings, or one of the 1m/1h/1d rollups, "
+                                      "e.g. 'raw=30d'. Repeat for each to change. Defaults to 1m=90d, 1h=730d and "
+                                      "1d=INF, leaving the raw readings as they are.",
+                                 default=[])
+    argument_parser.add_argument("-b", "--batch-size",
+                                 type=int,
+                                 help=f"How many readings to collect before sending them to influxDB in one write. "
+                                      f"Defaults to {DB_BATCH_SIZE}, or {GATEWAY_BATCH_SIZE} for a gateway.",
+                                 default=None)
+    argument_parser.add_argument("--batch-age",
+                                 type=int,
+                                 help=f"The maximum number of seconds a reading may wait before its batch is sent. "
+                                      f"Defaults to {DB_BATCH_MAX_AGE}, or {GATEWAY_BATCH_MAX_AGE} for a gateway.",
+                                 default=None)
+
+    # Control how quickly the local backup is caught up on once the connection is back.
+    argument_parser.add_argument("--replay-rate",
+                                 type=int,
+                                 help="The most readings per second to send from the local backup, alongside the live "
+                                      "readings. 0 for no limit.",
+                                 default=REPLAY_RATE)
+    argument_parser.add_argument("--replay-batch",
+                                 type=int,
+                                 help="How many readings from the local backup to send in each write.",
+                                 default=REPLAY_BATCH_SIZE)
+
+    # Allow readings which add nothing to be left out of the database.
+    argument_parser.add_argument("--compress",
+                                 choices=COMPRESSION_MODES,
+                                 help="Only send the values of each field which can't be recreated, to within its "
+                                      "tolerance, from the values already sent.",
+                                 default=None)
+    argument_parser.add_argument("--tolerance",
+                                 type=parse_tolerance,
+                                 action="append",
+                                 metavar="FIELD=TOLERANCE",
+                                 help="How far a compressed field may be from its real value, e.g. 'pressure=0.1'. "
+                                      "Repeat for each field to change.",
+                                 default=[])
+    argument_parser.add_argument("--heartbeat",
+                                 type=int,
+                                 help="The most seconds a compressed field may go without a value being sent.",
+                                 default=HEARTBEAT_SECS)
+
+    # Keep recent readings on the device, whether or not they also go to the database.
+    argument_parser.add_argument("--history-days",
+                                 type=float,
+                                 help="Keep this many days of readings in a local history store, which can be queried "
+                                      "with query_history.py. Disabled by default.",
+                                 default=0)
+
+    # Allow the application's own performance to be watched.
+    argument_parser.add_argument("--metrics-port",
+                                 type=int,
+                                 help="Serve Prometheus metrics about the application on this port, at /metrics. "
+                                      "Disabled by default.",
+                                 default=None)
+
+    # Allow the application to be profiled where it runs.
+    argument_parser.add_argument("--profile",
+                                 type=str,
+                                 metavar="DIRECTORY",
+                                 help="Profile the application by sampling what each thread is doing, dumping where "
+                                      "they spent their time to this directory periodically, and a summary of the time "
+                                      "spent in the busiest functions on shutdown.",
+                                 default=None)
+    argument_parser.add_argument("--profile-memory",
+                                 action="store_true",
+                                 help="Also trace memory allocations while profiling, dumping the top allocations and "
+                                      "their growth. This slows the application down considerably.")
+    argument_parser.add_argument("--profile-interval",
+                                 type=int,
+                                 help="How many seconds between each profile dump.",
+                                 default=PROFILE_INTERVAL_SECS)
+
+    # Allow the database writes to happen away from the sampling loop.
+    argument_parser.add_argument("-w", "--writer-thread",
+                                 help="Send readings to the database from a background thread, so sampling never "
+                                      "waits on the network.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--queue-size",
+                                 type=int,
+                                 help="How many readings the background writer may hold before the overflow policy "
+                                      "applies.",
+                                 default=WRITER_QUEUE_SIZE)
+    argument_parser.add_argument("--overflow",
+                                 choices=OVERFLOW_POLICIES,
+                                 help="What to do with a new reading when the background writer queue is full.",
+                                 default=OVERFLOW_BLOCK)
 
     # Add an argument to set the frequency of polling
     argument_parser.add_argument("-f", "--freq",
                                  type=int,
                                  help="How many times PER HOUR, new values will be polled from the sensor.",
                                  default=60)  # Once per minute
+    argument_parser.add_argument("-r", "--sample-rate",
+                                 type=float,
+                                 help="Sample the sensor this many times PER SECOND, and only log the min/max/mean/"
+                                      "stddev of each polling period (see --freq).",
+                                 default=None)
 
     parsed_arguments = argument_parser.parse_args()
     utils.verbose = parsed_arguments.verbose
     return parsed_arguments
 
 
+def configure_logging(parsed_arguments):
+    if parsed_arguments.log_max_mb <= 0 or parsed_arguments.log_backups < 0:
+        print('Log max MB must be more than 0, and log backups must not be negative.')
+        return False
+    if parsed_arguments.echo_every < 0:
+        print('Echo every must not be negative.')
+        return False
+    if parsed_arguments.log_file is not None:
+        utils.validate_can_write_file(parsed_arguments.log_file)
+    log_output.configure(parsed_arguments.log_file, log_format=parsed_arguments.log_format,
+                         rotate=parsed_arguments.log_rotate, max_mb=parsed_arguments.log_max_mb,
+                         backups=parsed_arguments.log_backups)
+    return True
+
+
 def validate_commandline_args(parsed_arguments):
     # Validate the port number
     if not (1024 < parsed_arguments.port <= 65535):
         print('Command line port number must be between 1025 and 65535.')
         return False
 
+    # Validate the sensor driver
+    if parsed_arguments.driver == drivers.DRIVER_REPLAY and not parsed_arguments.replay_file:
+        print('A replay file must be given when using the replay driver.')
+        return False
+
+    # Validate the sensors
+    if parsed_arguments.sensor is None:
+        parsed_arguments.sensor = [_DEFAULT_SENSOR]
+    names = [name for name, _, _ in parsed_arguments.sensor]
+    if len(set(names)) != len(names):
+        print('Every sensor must have a different name.')
+        return False
+    places = [(address, bus) for _, address, bus in parsed_arguments.sensor]
+    if parsed_arguments.driver == drivers.DRIVER_BME680 and len(set(places)) != len(places):
+        print('Every sensor must have a different address/bus.')
+        return False
+
+    # Validate the gateway settings
+    if parsed_arguments.via_gateway and not parsed_arguments.save:
+        print('Writing via a gateway needs persistence mode.')
+        return False
+    if not (1024 < parsed_arguments.listen_port <= 65535):
+        print('Gateway listen port number must be between 1025 and 65535.')
+        return False
+
+    # Validate the write batching
+    if parsed_arguments.batch_size is None:
+        parsed_arguments.batch_size = GATEWAY_BATCH_SIZE if parsed_arguments.gateway else DB_BATCH_SIZE
+    if parsed_arguments.batch_age is None:
+        parsed_arguments.batch_age = GATEWAY_BATCH_MAX_AGE if parsed_arguments.gateway else DB_BATCH_MAX_AGE
+    if parsed_arguments.batch_size < 1 or parsed_arguments.batch_age < 0:
+        print('Batch size must be at least 1, and batch age must not be negative.')
+        return False
+
+    # Validate the backlog replay
+    if parsed_arguments.replay_rate < 0 or parsed_arguments.replay_batch < 1:
+        print('Replay rate must not be negative, and replay batch must be at least 1.')
+        return False
+
+    # Validate the compression
+    if parsed_arguments.heartbeat < 1:
+        print('Heartbeat must be at least 1 second.')
+        return False
+
+    # Validate the UDP port number
+    if parsed_arguments.udp_port is not None and not (1024 < parsed_arguments.udp_port <= 65535):
+        print('UDP port number must be between 1025 and 65535.')
+        return False
+
+    # Validate the local history
+    if parsed_arguments.history_days < 0:
+        print('History days must not be negative.')
+        return False
+
+    # Validate the background writer
+    if parsed_arguments.queue_size < 1:
+        print('Writer queue size must be at least 1.')
+        return False
+    if parsed_arguments.overflow == OVERFLOW_SPILL and not parsed_arguments.save:
+        print('The spill overflow policy needs persistence mode, as there is no local backup in local mode.')
+        return False
+
     # Validate frequency is sensible
     if not (1 <= parsed_arguments.freq <= 3600):
         print('Polling Frequency must be at least 1 (1/Hour), and at most 3600 (1/Second)')
         return False
+    if parsed_arguments.sample_rate is not None and not (0 < parsed_arguments.sample_rate <= _MAX_SAMPLE_RATE):
+        print(f'Sample rate must be more than 0, and at most {_MAX_SAMPLE_RATE} (per Second)')
+        return False
+
+    # Validate and start the metrics endpoint, before anything is done which it should count.
+    if parsed_arguments.metrics_port is not None:
+        if not (1024 < parsed_arguments.metrics_port <= 65535):
+            print('Metrics port number must be between 1025 and 65535.')
+            return False
+        try:
+            metrics.serve(parsed_arguments.metrics_port)
+        except OSError as err:
+            print(f'Unable to serve metrics on port {parsed_arguments.metrics_port}, {err}.')
+            return False
+
+    # Validate and set up the profiling.
+    global profiler
+    if parsed_arguments.profile_memory and parsed_arguments.profile is None:
+        print('Memory profiling needs --profile.')
+        return False
+    if parsed_arguments.profile is not None:
+        if parsed_arguments.gateway:
+            print('Profiling is not available in gateway mode.')
+            return False
+        if parsed_arguments.profile_interval < 1:
+            print('Profile interval must be at least 1 second.')
+            return False
+        profiler = Profiler(parsed_arguments.profile, memory=parsed_arguments.profile_memory)
+        # Only whole stages are timed, what goes on within them is left to the sampling.
+        profiler.instrument(Sensor, 'read')
+        profiler.instrument(DataLogging, 'log_sensor_output', '_write_remote', '_write_locals')
+
+    # Size the history to hold the requested days at the polling frequency.
+    history_capacity = math.ceil(parsed_arguments.history_days * 24 * parsed_arguments.freq)
+
+    compressor = None
+    if parsed_arguments.compress is not None:
+        compressor = Compressor(parsed_arguments.compress, tolerances=dict(parsed_arguments.tolerance),
+                                heartbeat_secs=parsed_arguments.heartbeat)
+
+    # Start listening for nodes, in place of reading any sensors.
+    global gateway
+    if parsed_arguments.gateway:
+        try:
+            gateway = Gateway(parsed_arguments.database, port=parsed_arguments.port,
+                              listen_port=parsed_arguments.listen_port, batch_size=parsed_arguments.batch_size,
+                              batch_max_age=parsed_arguments.batch_age, gzip_writes=parsed_arguments.gzip,
+                              retention=dict(parsed_arguments.retention))
+        except OSError as err:
+            print(f'Unable to listen for nodes on port {parsed_arguments.listen_port}, {err}.')
+            return False
+        return True
 
     # Validate the database connection
     global logger
     if parsed_arguments.save:
-        logger = DataLogging(hostname=parsed_arguments.database, port=parsed_arguments.port)
+        logger = DataLogging(hostname=parsed_arguments.database, port=parsed_arguments.port,
+                             batch_size=parsed_arguments.batch_size, batch_max_age=parsed_arguments.batch_age,
+                             history_capacity=history_capacity, gzip_writes=parsed_arguments.gzip,
+                             udp_port=parsed_arguments.udp_port, compressor=compressor,
+                             retention=dict(parsed_arguments.retention),
+                             provision=not parsed_arguments.via_gateway,
+                             replay_batch_size=parsed_arguments.replay_batch, replay_rate=parsed_arguments.replay_rate,
+                             echo_every=parsed_arguments.echo_every)
     else:
-        logger = DataLogging()
+        logger = DataLogging(history_capacity=history_capacity, echo_every=parsed_arguments.echo_every)
+
+    global writer
+    if parsed_arguments.writer_thread:
+        writer = BackgroundWriter(logger, max_size=parsed_arguments.queue_size, overflow=parsed_arguments.overflow)
 
     # Everything was successfully validated so respond True.
     return True
 
 
-def execute(freq):
+def execute(freq, sample_rate=None, batch_age=DB_BATCH_MAX_AGE, profile_interval=PROFILE_INTERVAL_SECS):
     # Calculate the work delay based on the polling frequency
     one_hour = 3600
-    polling_frequency = one_hour // freq  # Floor division to get the nearest int.
-    print(f'Calculated Polling to run every {polling_frequency} seconds')
+    polling_frequency = one_hour / freq
+    print(f'Calculated Polling to run every {polling_frequency:.2f} seconds')
 
-    # Do a 'Run-Once'
-    work()
+    if profiler is not None:
+        # Times each scheduled run as a whole, as well as the functions within it.
+        profiler.instrument(sys.modules[__name__], 'work', 'sample', 'log_window')
 
-    # Begin perpetual execution.
-    scheduler = sched.scheduler()
-    while True:
-        scheduler.enter(delay=polling_frequency, priority=1, action=work)
-        scheduler.run()
+    # Runs are kept to absolute deadlines, so the time spent reading/sending doesn't add to the period.
+    if sample_rate is None:
+        scheduler.every(polling_frequency, work)
+    else:
+        print(f'Sampling {sample_rate} times per second, logging the summary of each polling period')
+        scheduler.every(1 / sample_rate, sample)
+        scheduler.every(polling_frequency, log_window, delay=polling_frequency, priority=0)
+    if writer is None and batch_age > 0:
+        # Otherwise the batch's age is only checked as each reading arrives, which could be long after it is due.
+        flush_period = min(batch_age, polling_frequency)
+        scheduler.every(flush_period, logger.flush_if_due, delay=flush_period, priority=2)
+    if profiler is not None:
+        scheduler.every(profile_interval, profiler.dump, delay=profile_interval, priority=2)
+        profiler.start()
+
+    # Runs until a signal stops it.
+    scheduler.run()
+
+
+def read_sensor(sensor):
+    try:
+        return sensor.read()
+    except SensorTimeout as err:
+        # Skip this reading, rather than hold up the rest, the next one may well be fine.
+        utils.log.warning(err, extra=utils.rate_limited(f'timeout-{sensor.name}'))
+        return None
+
+
+def read_all():
+    # Sensors spend most of a read waiting on the sensor, so read them all at once.
+    if read_pool is None:
+        readings = [read_sensor(sensor) for sensor in sensors]
+    else:
+        readings = read_pool.map(read_sensor, sensors)
+    return [reading for reading in readings if reading is not None]
 
 
 def work():
-    # Get data from sensor
-    sensor_output = sensor.read()
+    # Get data from sensors, and send it to the logger
+    for sensor_output in read_all():
+        log(sensor_output)
 
-    # Send data to logger
-    logger.log_sensor_output(data=sensor_output)
 
+def sample():
+    for sensor_output in read_all():
+        aggregators[sensor_output.sensor].add(sensor_output)
 
-def clean_shutdown(sig, frame):
+
+def log_window():
+    for aggregator in aggregators.values():
+        if len(aggregator):
+            log(aggregator.emit())
+
+
+def log(data):
+    if writer is not None:
+        writer.log_sensor_output(data=data)
+    else:
+        logger.log_sensor_output(data=data)
+
+
+def request_shutdown(sig, frame):
+    # Only stops the scheduler, the main thread may have been interrupted part way through anything, even while
+    # holding a lock the shutdown would need, so it is left to shut down in order once the scheduler returns.
+    scheduler.stop()
+
+
+def shutdown():
+    if gateway is not None:
+        gateway.shutdown()
+    if writer is not None:
+        writer.shutdown()
     logger.shutdown()
-    exit(0)
+    for sensor in sensors:
+        sensor.shutdown()
+        utils.v_print(f'[{sensor.name}] {sensor.cpu_compensation.summary()}')
+    if profiler is not None:
+        profiler.shutdown()
+    log_output.stop()
 
 
-signal.signal(signal.SIGINT, clean_shutdown)
-signal.signal(signal.SIGTERM, clean_shutdown)
+signal.signal(signal.SIGINT, request_shutdown)
+signal.signal(signal.SIGTERM, request_shutdown)
 if __name__ == '__main__':
     print('Checking command line arguments...')
     parsed_args = get_commandline_args()
+    if not configure_logging(parsed_args):
+        exit(1)
     utils.v_print('> Got command line arguments successfully.\n')
 
     utils.v_print('Validating command line arguments...')
@@ -124,9 +560,30 @@ if __name__ == '__main__':
         exit(1)
     utils.v_print('> Validated the command line arguments are okay.\n')
 
-    utils.v_print('Setup Sensor...')
-    sensor = Sensor()
-    utils.v_print('> Sensor Initialised.\n')
+    if gateway is not None:
+        print('-- Operational --')
+        gateway.start()
+        # Everything happens on the gateway's own threads, so this only waits for a signal to shut it down.
+        scheduler.run()
+        shutdown()
+        exit(0)
+
+    utils.v_print('Setup Sensors...')
+    for sensor_name, sensor_address, sensor_bus in parsed_args.sensor:
+        sensors.append(Sensor(name=sensor_name, i2c_addr=sensor_address, i2c_bus=sensor_bus,
+                              driver=parsed_args.driver, replay_file=parsed_args.replay_file))
+        aggregators[sensor_name] = WindowAggregator()
+    if parsed_args.sample_rate is not None and parsed_args.driver == drivers.DRIVER_BME680:
+        # Sampling any faster than the sensor can be read would overrun every deadline.
+        slowest = max(sensor.read_secs for sensor in sensors)
+        if 1 / parsed_args.sample_rate < slowest:
+            print(f'Sample rate must be at most {1 / slowest:.2f} (per Second), as a reading takes at least '
+                  f'{slowest * 1000:.0f}ms with the sensor config.')
+            exit(1)
+    if len(sensors) > 1:
+        read_pool = ThreadPoolExecutor(max_workers=len(sensors), thread_name_prefix='sensor-read')
+    utils.v_print(f'> {len(sensors)} Sensor(s) Initialised.\n')
 
     print('-- Operational --')
-    execute(parsed_args.freq)
+    execute(parsed_args.freq, parsed_args.sample_rate, parsed_args.batch_age, parsed_args.profile_interval)
+    shutdown()
@@ -0,0 +1,174 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+# Instrumented code checks this before recording anything, so metrics cost a single lookup while disabled.
+enabled = False
+METRICS_PORT = 9680
+# Upper bounds, in seconds, of the latency histogram buckets.
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_REGISTRY = []
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """A metric is either recorded as things happen, or worked out by a function each time it is scraped."""
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=(), function=None):
+        self.name = name
+        self._description = description
+        self._labels = labels
+        self._function = function
+        self._lock = threading.Lock()
+        self._values = {}
+        _REGISTRY.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self._labels, labels)} {value}' for labels, value in values]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self._description}', f'# TYPE {self.name} {self.kind}']
+        if self._function is not None:
+            lines.append(f'{self.name} {self._function()}')
+        else:
+            lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels, function)
+        # Report zero from the start, rather than only once something has happened.
+        if not labels:
+            self._values[()] = 0
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=_LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self._buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            # Per label set: the count in each bucket (plus one for +Inf), the sum, and the total count.
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self._buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        lines = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self._labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self._labels, labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self._labels, labels)} {count}')
+        return lines
+
+
+reading = Gauge('aq_reading', 'The latest value read from each sensor.', labels=('sensor', 'field'))
+stage_seconds = Histogram('aq_stage_seconds', 'Time spent in each stage of taking and logging a reading.',
+                          labels=('stage',))
+sensor_not_ready = Counter('aq_sensor_not_ready_total', 'Times a sensor had to be waited on for its data.',
+                           labels=('sensor',))
+sensor_read_seconds = Histogram('aq_sensor_read_seconds', 'Time each sensor took to have a reading ready.',
+                                labels=('sensor',))
+schedule_lag_seconds = Histogram('aq_schedule_lag_seconds', 'How late each scheduled run started.')
+schedule_missed = Counter('aq_schedule_missed_total', 'Scheduled runs skipped because the previous run overran.')
+points_written = Counter('aq_points_written_total', 'Readings written to influxDB.')
+write_failures = Counter('aq_write_failures_total', 'Writes to influxDB which failed.')
+points_spooled = Counter('aq_points_spooled_total', 'Readings kept in the local backup to be sent later.')
+points_replayed = Counter('aq_points_replayed_total', 'Readings sent to influxDB from the local backup.')
+points_dropped = Counter('aq_points_dropped_total', 'Readings dropped because the writer queue was full, or '
+                                                  'influxDB rejected them.')
+reconnect_attempts = Counter('aq_reconnect_attempts_total', 'Attempts to connect to influxDB.')
+compression_ratio = Gauge('aq_compression_ratio', 'Readings taken per value sent, for each compressed field.',
+                          labels=('sensor', 'field'))
+compression_max_error = Gauge('aq_compression_max_error', 'The furthest a dropped value was from what is recreated '
+                                                          'from the values sent.', labels=('sensor', 'field'))
+writer_queue_depth = Gauge('aq_writer_queue_depth', 'Readings waiting for the background writer.',
+                           function=lambda: 0)
+spool_depth = Gauge('aq_spool_depth', 'Readings waiting in the local backup.', function=lambda: 0)
+gateway_points_received = Counter('aq_gateway_points_received_total', 'Readings received by the gateway from nodes.',
+                                  labels=('transport',))
+gateway_duplicates = Counter('aq_gateway_duplicates_total', 'Readings the gateway had already received, and dropped.')
+_process = psutil.Process()
+Gauge('process_resident_memory_bytes', 'Resident memory size in bytes.',
+      function=lambda: _process.memory_info().rss)
+Counter('process_cpu_seconds_total', 'Total user and system CPU time spent in seconds.',
+        function=lambda: sum(_process.cpu_times()[:2]))
+
+
+def record_reading(data):
+    for field in ('temperature', 'humidity', 'pressure', 'gas'):
+        reading.set(getattr(data, field), data.sensor, field)
+    reading.set(data.iaq_index, data.sensor, 'quality')
+
+
+def render():
+    return '\n'.join(metric.render() for metric in _REGISTRY) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise fill the console.
+        pass
+
+
+def serve(port=METRICS_PORT, address=''):
+    """Starts serving /metrics from a background thread, and turns on recording."""
+    global enabled
+    enabled = True
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
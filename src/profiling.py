@@ -0,0 +1,185 @@
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+import utils
+
+PROFILE_INTERVAL_SECS = 900
+# Dumps of each kind kept in the directory, the oldest are removed beyond this.
+PROFILE_KEEP_DUMPS = 96
+# How often every thread's stack is sampled, cheap enough to leave running on a node in production.
+PROFILE_SAMPLE_RATE = 50  # Per second
+# Only the allocating line is recorded, rather than the whole stack, to keep tracing cheap.
+_TRACE_FRAMES = 1
+_TOP_ALLOCATIONS = 25
+_TOP_FUNCTIONS = 15
+_CPU_PREFIX = 'cpu-'
+_STACKS_PREFIX = 'stacks-'
+_MEMORY_PREFIX = 'memory-'
+_TIMINGS_FILE_NAME = 'timings.txt'
+
+
+def _describe(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Profiler:
+    """
+    Profiles the running application, for finding hot spots and leaks on a node in production.
+
+    Every thread's stack is sampled from a thread of its own, so the application itself runs at full speed. Whenever
+    dump() is called, what was sampled since the last dump is written to the directory: the functions each thread
+    spent the most time in, and every stack seen, in the collapsed format flame graph tools read. The samples are of
+    wall clock time, so a thread waiting on the sensor or the network shows where it waits.
+
+    With memory tracing, tracemalloc traces every allocation (which slows down the whole application), and the top
+    allocations are dumped along with what has grown most since the last dump. Functions can also be timed
+    individually with instrument(), which are summarised by shutdown().
+    """
+
+    def __init__(self, directory, memory=False, sample_rate=PROFILE_SAMPLE_RATE, keep_dumps=PROFILE_KEEP_DUMPS):
+        utils.validate_can_write_dir(directory)
+        self._directory = directory
+        self._memory = memory
+        self._sample_interval = 1 / sample_rate
+        self._keep_dumps = keep_dumps
+        self._last_snapshot = None
+        # Samples of each thread name and stack (as code objects, innermost first) since the last dump.
+        self._stacks = Counter()
+        self._window_started = time.monotonic()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        # Calls, total seconds and the longest call of each instrumented function, by name.
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._memory:
+            tracemalloc.start(_TRACE_FRAMES)
+        self._window_started = time.monotonic()
+        self._sampler.start()
+
+    def instrument(self, owner, *names):
+        """Replaces each named function of owner (a class or module) with one which times every call."""
+        prefix = f'{owner.__name__}.' if isinstance(owner, type) else ''
+        for name in names:
+            setattr(owner, name, self._timed(prefix + name, getattr(owner, name)))
+
+    def _timed(self, name, function):
+        timings = self._timings[name] = [0, 0.0, 0.0]
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    timings[0] += 1
+                    timings[1] += elapsed
+                    if elapsed > timings[2]:
+                        timings[2] = elapsed
+        return timed
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                samples.append((names.get(thread_id, str(thread_id)), tuple(codes)))
+            with self._lock:
+                self._stacks.update(samples)
+
+    def dump(self):
+        self._dump(datetime.now().strftime('%Y%m%d-%H%M%S'))
+        utils.v_print(f'Profile dumped to {self._directory}.')
+
+    def _dump(self, stamp):
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+        now = time.monotonic()
+        seconds, self._window_started = now - self._window_started, now
+
+        self._write(f'{_CPU_PREFIX}{stamp}.txt', self._cpu_report(stacks, seconds))
+        # e.g. for flamegraph.pl or speedscope, outermost function first.
+        self._write(f'{_STACKS_PREFIX}{stamp}.txt', [
+            ';'.join([name] + [_describe(code) for code in reversed(codes)]) + f' {count}'
+            for (name, codes), count in stacks.items()])
+        if self._memory:
+            self._write(f'{_MEMORY_PREFIX}{stamp}.txt', self._memory_report())
+
+        for prefix in (_CPU_PREFIX, _STACKS_PREFIX, _MEMORY_PREFIX):
+            dumps = sorted(name for name in os.listdir(self._directory) if name.startswith(prefix))
+            for name in dumps[:-self._keep_dumps]:
+                os.remove(os.path.join(self._directory, name))
+
+    def _write(self, file_name, lines):
+        with open(os.path.join(self._directory, file_name), 'w') as dump_file:
+            dump_file.write('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _cpu_report(stacks, seconds):
+        # Samples each function was running in (self), or anywhere in the stack below (total), by thread.
+        threads = {}
+        for (name, codes), count in stacks.items():
+            thread = threads.setdefault(name, [0, Counter(), Counter()])
+            thread[0] += count
+            thread[1][codes[0]] += count
+            for code in set(codes):
+                thread[2][code] += count
+
+        lines = [f'{sum(stacks.values()):,} samples over {seconds:,.0f} seconds.']
+        for name, (samples, own, total) in sorted(threads.items()):
+            lines.extend(['', f'Thread {name}, top {_TOP_FUNCTIONS} functions of {samples:,} samples:',
+                          f'{"Self %":>8} {"Total %":>8}  Function'])
+            for code, count in total.most_common(_TOP_FUNCTIONS):
+                lines.append(f'{own[code] / samples:>8.1%} {count / samples:>8.1%}  {_describe(code)}')
+        return lines
+
+    def _memory_report(self):
+        # Leaves out what the profiling itself holds on to.
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                              tracemalloc.Filter(False, __file__)])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'Traced memory: {current / 1024:,.1f} KiB now, {peak / 1024:,.1f} KiB at peak.', '',
+                 f'Top {_TOP_ALLOCATIONS} allocations:']
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:_TOP_ALLOCATIONS])
+        if self._last_snapshot is not None:
+            lines.extend(['', f'Top {_TOP_ALLOCATIONS} changes since the last dump:'])
+            lines.extend(str(stat) for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:_TOP_ALLOCATIONS])
+        self._last_snapshot = snapshot
+        return lines
+
+    def summary(self):
+        with self._lock:
+            timings = sorted(self._timings.items(), key=lambda item: item[1][1], reverse=True)
+        lines = [f'{"Function":<32} {"Calls":>10} {"Total s":>10} {"Mean ms":>10} {"Max ms":>10}']
+        for name, (calls, total, longest) in timings:
+            mean = (total / calls) * 1000 if calls else 0.0
+            lines.append(f'{name:<32} {calls:>10,} {total:>10.3f} {mean:>10.3f} {longest * 1000:>10.3f}')
+        return '\n'.join(lines)
+
+    def shutdown(self):
+        self._stop.set()
+        if self._sampler.is_alive():
+            self._sampler.join()
+        self._dump(datetime.now().strftime('%Y%m%d-%H%M%S'))
+        if self._memory:
+            tracemalloc.stop()
+        summary = self.summary()
+        with open(os.path.join(self._directory, _TIMINGS_FILE_NAME), 'w') as timings_file:
+            timings_file.write(summary + '\n')
+        utils.log.info(f'Time spent in each profiled function:\n{summary}')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import log_output
+import utils
+from ring_store import FIELDS, HISTORY_DIR, RingStore, store_path
+
+
+def get_commandline_args():
+    """
+    Collects various arguments from the command line to decide which readings to fetch, and how to summarise them.
+    :return: An object containing the accepted, parsed, arguments.
+    """
+    argument_parser = argparse.ArgumentParser(description="Query the readings kept in the local history store, "
+                                                          "without needing influxDB.")
+    argument_parser.add_argument("-v", "--verbose",
+                                 help="Display verbose console output.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--sensor",
+                                 type=str,
+                                 help="The name of the sensor to query.",
+                                 default=utils.DEFAULT_SENSOR_NAME)
+    argument_parser.add_argument("--dir",
+                                 type=str,
+                                 help="The directory the history stores are kept in.",
+                                 default=HISTORY_DIR)
+    argument_parser.add_argument("--start",
+                                 type=str,
+                                 help="Only include readings from this UTC time on, e.g. 2020-06-01T00:00:00. "
+                                      "Defaults to one hour before the end.",
+                                 required=False)
+    argument_parser.add_argument("--end",
+                                 type=str,
+                                 help="Only include readings before this UTC time. Defaults to now.",
+                                 required=False)
+    argument_parser.add_argument("--bucket",
+                                 type=float,
+                                 help="Summarise the readings into the mean/min/max of each period of this many "
+                                      "seconds, rather than listing every reading.",
+                                 default=None)
+    argument_parser.add_argument("--fields",
+                                 nargs='+',
+                                 choices=FIELDS,
+                                 help="The fields to include. Defaults to all of them.",
+                                 default=list(FIELDS))
+    argument_parser.add_argument("--format",
+                                 choices=['csv', 'json'],
+                                 help="How to write the results to stdout.",
+                                 default='csv')
+    parsed_arguments = argument_parser.parse_args()
+    utils.verbose = parsed_arguments.verbose
+    return parsed_arguments
+
+
+def _parse_time(value, default):
+    if value is None:
+        return default
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _rows(columns):
+    names = [name for name in columns if name != 'timestamp']
+    for timestamp, *values in zip(columns['timestamp'].tolist(), *(columns[name].tolist() for name in names)):
+        yield {'time': datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat(), **dict(zip(names, values))}
+
+
+def write_results(columns, output_format, out=sys.stdout):
+    rows = _rows(columns)
+    if output_format == 'json':
+        json.dump(list(rows), out)
+        out.write('\n')
+        return
+    writer = csv.DictWriter(out, fieldnames=['time'] + [name for name in columns if name != 'timestamp'])
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parsed_args = get_commandline_args()
+    log_output.configure()
+    if parsed_args.bucket is not None and parsed_args.bucket <= 0:
+        utils.early_quit('Bucket size must be more than 0 seconds, quitting.')
+    end = _parse_time(parsed_args.end, time.time())
+    start = _parse_time(parsed_args.start, end - 3600)
+
+    path = store_path(parsed_args.sensor, parsed_args.dir)
+    if not utils.validate_file_exists(path):
+        utils.early_quit(f'No history found for sensor {parsed_args.sensor} at {path}, quitting.')
+    store = RingStore(path, read_only=True)
+    started = time.perf_counter()
+    if parsed_args.bucket is None:
+        results = store.query(start, end, parsed_args.fields)
+    else:
+        results = store.aggregate(start, end, parsed_args.bucket, parsed_args.fields)
+    if utils.verbose:
+        # Kept off stdout, so the results can be piped straight into something else.
+        print(f'Found {len(results["timestamp"])} rows of {len(store)} stored readings in '
+              f'{(time.perf_counter() - started) * 1000:.1f} ms.', file=sys.stderr)
+    write_results(results, parsed_args.format)
+    store.close()
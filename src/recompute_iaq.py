@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from influxdb import InfluxDBClient
+
+import iaq
+import log_output
+import sensor
+import utils
+from data_logging import DB_FAILED_WRITES, DB_TABLE, DB_USER, DB_PASS
+from spool import Spool
+
+_MEASUREMENT = 'AQ'
+_WRITE_BATCH_SIZE = 5000
+_SPOOL_CHUNK = 10000
+
+
+def get_commandline_args():
+    """
+    Collects various arguments from the command line to decide what to recompute, and where from.
+    :return: An object containing the accepted, parsed, arguments.
+    """
+    argument_parser = argparse.ArgumentParser(description="Recompute the stored air quality score of past readings, "
+                                                          "using the baselines currently in the sensor config file.")
+    argument_parser.add_argument("-v", "--verbose",
+                                 help="Display verbose console output.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--source",
+                                 choices=['influx', 'spool'],
+                                 help="Recompute readings already in influxDB, or those waiting in the local backup.",
+                                 default='influx')
+    argument_parser.add_argument("--config",
+                                 type=str,
+                                 help="The sensor config file to take the baselines from. Defaults to the config file "
+                                      "of the chosen sensor.",
+                                 default=None)
+    argument_parser.add_argument("--sensor",
+                                 type=str,
+                                 help="Only recompute readings from the sensor with this name.",
+                                 default=utils.DEFAULT_SENSOR_NAME)
+    argument_parser.add_argument("-db", "--database",
+                                 type=str,
+                                 help="The hostname/URL/IP Address of your influxDB instance.",
+                                 default="localhost")
+    argument_parser.add_argument("-p", "--port",
+                                 type=int,
+                                 help="The port of your influxDB instance. (1024-65535)",
+                                 default=8086)
+    argument_parser.add_argument("--start",
+                                 type=str,
+                                 help="Only recompute readings from this UTC time on, e.g. 2020-06-01T00:00:00.",
+                                 required=False)
+    argument_parser.add_argument("--end",
+                                 type=str,
+                                 help="Only recompute readings before this UTC time. Defaults to now.",
+                                 required=False)
+    argument_parser.add_argument("--hours-per-chunk",
+                                 type=int,
+                                 help="How many hours of readings to fetch from influxDB at a time.",
+                                 default=6)
+    argument_parser.add_argument("--host",
+                                 type=str,
+                                 help="Only recompute readings logged by this hostname. Defaults to this machine.",
+                                 default=utils.HOST_NAME)
+    argument_parser.add_argument("--dry-run",
+                                 help="Work out the new scores, but don't write anything back.",
+                                 action="store_true",
+                                 default=False)
+    argument_parser.add_argument("--verify",
+                                 help="Check every chunk against the scalar calculation used while sampling.",
+                                 action="store_true",
+                                 default=False)
+    parsed_arguments = argument_parser.parse_args()
+    if parsed_arguments.config is None:
+        parsed_arguments.config = sensor.sensor_file_name(sensor._CONFIG_FILE_NAME, parsed_arguments.sensor)
+    utils.verbose = parsed_arguments.verbose
+    return parsed_arguments
+
+
+def _parse_time(value, default):
+    if value is None:
+        return default
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+class Recomputer:
+    def __init__(self, config, verify=False):
+        self.humidity_baseline = config['humidity']['baseline']
+        self.quality_weighting = config['humidity']['quality_weighting']
+        self.gas_baseline = config['gas']['ambient_background']
+        self._verify = verify
+        self.total = 0
+        self.changed = 0
+
+    def quality(self, humidity, gas, old_quality):
+        quality = iaq.iaq_index(humidity, gas, self.humidity_baseline, self.gas_baseline, self.quality_weighting)
+        if self._verify and not iaq.matches_scalar(humidity, gas, self.humidity_baseline, self.gas_baseline,
+                                                   self.quality_weighting, quality):
+            utils.early_quit('Vectorised quality scores did not match the scalar calculation, quitting.')
+        self.total += len(quality)
+        self.changed += int(np.count_nonzero(quality != np.asarray(old_quality, dtype=np.float64)))
+        return quality
+
+
+def _sensor_condition(sensor_name):
+    # Readings logged before there could be more than one sensor have no sensor tag, and all came from the primary.
+    if sensor_name == utils.DEFAULT_SENSOR_NAME:
+        return '("sensor" = $sensor OR "sensor" = \'\')'
+    return '"sensor" = $sensor'
+
+
+def recompute_influx(parsed_args, recomputer):
+    client = InfluxDBClient(host=parsed_args.database, port=parsed_args.port, username=DB_USER, password=DB_PASS,
+                            database=DB_TABLE)
+    end = _parse_time(parsed_args.end, datetime.now(timezone.utc))
+    if parsed_args.start is None:
+        # Start from the oldest reading of this host.
+        first = list(client.query(f'SELECT first("quality") FROM "{_MEASUREMENT}" '
+                                  f'WHERE "hostname" = $host AND {_sensor_condition(parsed_args.sensor)}',
+                                  bind_params={'host': parsed_args.host, 'sensor': parsed_args.sensor},
+                                  epoch='ms').get_points())
+        if not first:
+            print(f'No readings found for host {parsed_args.host}.')
+            return
+        start = datetime.fromtimestamp(first[0]['time'] / 1000, tz=timezone.utc)
+    else:
+        start = _parse_time(parsed_args.start, None)
+
+    # Work through the range a window at a time, so only one window of readings is ever held in memory.
+    step = timedelta(hours=parsed_args.hours_per_chunk)
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + step, end)
+        result = client.query(f'SELECT "humidity", "gas", "quality" FROM "{_MEASUREMENT}" '
+                              f'WHERE "hostname" = $host AND {_sensor_condition(parsed_args.sensor)} '
+                              f'AND time >= $start AND time < $end GROUP BY *',
+                              bind_params={'host': parsed_args.host,
+                                           'sensor': parsed_args.sensor,
+                                           'start': window_start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                                           'end': window_end.strftime('%Y-%m-%dT%H:%M:%S.%fZ')},
+                              epoch='ms')
+        for (_, tags), points in result.items():
+            # Compression may have left some readings without the values needed.
+            points = [point for point in points
+                      if point['humidity'] is not None and point['gas'] is not None and point['quality'] is not None]
+            if not points:
+                continue
+            times = [point['time'] for point in points]
+            quality = recomputer.quality([point['humidity'] for point in points],
+                                         [point['gas'] for point in points],
+                                         [point['quality'] for point in points])
+            if not parsed_args.dry_run:
+                # Writing the same series and timestamp again replaces just the given field.
+                client.write_points([{"measurement": _MEASUREMENT, "tags": tags, "time": timestamp,
+                                      "fields": {"quality": float(value)}}
+                                     for timestamp, value in zip(times, quality)],
+                                    time_precision='ms', batch_size=_WRITE_BATCH_SIZE)
+        utils.v_print(f'Recomputed readings up to {window_end.isoformat()}, {recomputer.total} so far.')
+        window_start = window_end
+    client.close()
+
+
+def recompute_spool(parsed_args, recomputer):
+    def transform(records):
+        # Other sensors' readings are passed through untouched, as they have their own baselines, as are readings
+        # which compression left without the values needed (stored as NaN).
+        if parsed_args.sensor not in records.sensors:
+            return records
+        humidity, gas, old_quality = (records.column(attribute) for attribute in ('humidity', 'gas', 'iaq_index'))
+        matching = (records.sensor_ids == records.sensors.index(parsed_args.sensor)) & \
+            ~(np.isnan(humidity) | np.isnan(gas) | np.isnan(old_quality))
+        if not matching.any():
+            return records
+        quality = recomputer.quality(humidity[matching], gas[matching], old_quality[matching])
+        if not parsed_args.dry_run:
+            old_quality[matching] = quality
+        return records
+
+    Spool(DB_FAILED_WRITES).rewrite(transform, chunk_records=_SPOOL_CHUNK)
+
+
+if __name__ == '__main__':
+    parsed_args = get_commandline_args()
+    log_output.configure()
+    if not utils.validate_file_exists(parsed_args.config):
+        utils.early_quit(f'No sensor config file found at {parsed_args.config}, quitting.')
+    calculator = Recomputer(utils.get_json_from_file(parsed_args.config), verify=parsed_args.verify)
+
+    if parsed_args.source == 'spool':
+        recompute_spool(parsed_args, calculator)
+    else:
+        recompute_influx(parsed_args, calculator)
+    print(f'Recomputed {calculator.total} readings, {calculator.changed} of which had a different score'
+          f'{" (dry run, nothing written)" if parsed_args.dry_run else ""}.')
@@ -0,0 +1,47 @@
+import random
+import time
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+RECONNECT_BASE_DELAY = 5  # Seconds
+RECONNECT_MAX_DELAY = 300  # Seconds
+
+
+class ReconnectBackoff:
+    """
+    A circuit breaker for the database connection.
+
+    Closed while the connection is healthy. Each failure opens the circuit for an exponentially growing, jittered
+    delay, during which no attempt should be made. Once the delay has passed the circuit is half-open, allowing a
+    single trial attempt, whose result either closes the circuit or opens it again for longer.
+    """
+
+    def __init__(self, base_delay=RECONNECT_BASE_DELAY, max_delay=RECONNECT_MAX_DELAY):
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._failures = 0
+        self._retry_at = 0.0
+        self.state = CIRCUIT_CLOSED
+
+    @property
+    def failures(self):
+        return self._failures
+
+    def allows_attempt(self):
+        if self.state == CIRCUIT_OPEN and time.monotonic() >= self._retry_at:
+            self.state = CIRCUIT_HALF_OPEN
+        return self.state != CIRCUIT_OPEN
+
+    def succeeded(self):
+        self._failures = 0
+        self.state = CIRCUIT_CLOSED
+
+    def failed(self):
+        delay = min(self._max_delay, self._base_delay * (2 ** min(self._failures, 16)))
+        # Spread retries out, so a fleet of nodes doesn't hit a recovering server all at once.
+        delay = (delay / 2) + random.uniform(0, delay / 2)
+        self._failures += 1
+        self._retry_at = time.monotonic() + delay
+        self.state = CIRCUIT_OPEN
+        return delay
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import metrics
+import utils
+from reconnect import ReconnectBackoff
+from spool import Spool
+
+REPLAY_BATCH_SIZE = 5000
+REPLAY_RATE = 5000  # Readings per second
+_PROGRESS_SECS = 30
+
+
+class BacklogReplayer:
+    """
+    Sends the readings waiting in the local backup on to the database from a background thread, oldest first, in large
+    batches and no faster than the given rate, so catching up after an outage never holds up the live readings.
+
+    Nothing is sent until resume() is called, once the connection is known to be up. If a batch fails, the replay
+    stops where it is, and tries again from there after a backoff for as long as the live connection stays up, or
+    once resume() is called again. Once the backlog is empty, replayed(start, end) is called with the nanosecond times
+    of the oldest and newest readings sent since it was last called, if any were.
+    """
+
+    def __init__(self, spool: Spool, send, connected=lambda: True, replayed=None, batch_size=REPLAY_BATCH_SIZE,
+                 rate=REPLAY_RATE):
+        self._spool = spool
+        # Takes a SampleBatch of readings, and returns whether they were written.
+        self._send = send
+        # Whether the live connection is up, so whether a failed replay is worth retrying.
+        self._connected = connected
+        self._replayed = replayed
+        # The oldest and newest readings sent, until replayed() is called with them.
+        self._span = None
+        self._batch_size = batch_size
+        self._rate = rate
+        self._backoff = ReconnectBackoff()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.replaying = False
+        self._thread = threading.Thread(target=self._run, name='backlog-replay', daemon=True)
+        self._thread.start()
+
+    def resume(self):
+        self._wake.set()
+
+    def _run(self):
+        retry_in = None
+        while not self._stop.is_set():
+            # Woken by resume(), or once the backoff after a failed batch has passed.
+            self._wake.wait(retry_in)
+            self._wake.clear()
+            retry_in = None
+            if self._stop.is_set() or not self._connected():
+                continue
+            if not self._catch_up():
+                retry_in = self._backoff.failed()
+                utils.log.info(f'Retrying the backlog in {retry_in:.0f} seconds.',
+                               extra=utils.rate_limited('replay-retry'))
+
+    def _catch_up(self):
+        """Sends the backlog until it is empty, or replay is stopped, returning False if a batch failed."""
+        total = len(self._spool)
+        if not total:
+            return True
+        self.replaying = True
+        utils.log.info(f'Had {total} values which were not successfully sent, sending them in the background.')
+        started = last_report = time.monotonic()
+        sent = 0
+        try:
+            while not self._stop.is_set():
+                batch = self._spool.peek(self._batch_size)
+                if not batch:
+                    utils.log.info(f'Successfully pushed, all previously failed db writes, to server '
+                                   f'({sent} in {time.monotonic() - started:.0f} seconds).')
+                    self._finish()
+                    return True
+                if not self._send(batch):
+                    utils.log.info(f'Stopped sending the backlog after {sent} readings.')
+                    return False
+                self._backoff.succeeded()
+                self._spool.commit(len(batch))
+                oldest, newest = int(batch.timestamps.min()), int(batch.timestamps.max())
+                if self._span is not None:
+                    oldest, newest = min(oldest, self._span[0]), max(newest, self._span[1])
+                self._span = (oldest, newest)
+                sent += len(batch)
+                if metrics.enabled:
+                    metrics.points_replayed.inc(amount=len(batch))
+
+                now = time.monotonic()
+                if now - last_report >= _PROGRESS_SECS:
+                    last_report = now
+                    utils.v_print(f'Sent {sent} backlogged readings at {sent / (now - started):.0f}/s, '
+                                  f'{len(self._spool)} still to send.')
+                if self._rate:
+                    # Hold back until the average rate since starting is back under the limit.
+                    self._stop.wait(started + (sent / self._rate) - now)
+            return True
+        finally:
+            self.replaying = False
+
+    def _finish(self):
+        span, self._span = self._span, None
+        if span is not None and self._replayed is not None:
+            self._replayed(*span)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=timeout)
@@ -0,0 +1,161 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+import utils
+
+_STORE_MAGIC = b'AQRS'
+_STORE_VERSION = 1
+_HEADER = struct.Struct('<4sHHQQQ')  # Magic, version, column count, capacity, next write index, record count.
+# Room for the header to grow, which also keeps every column 8 byte aligned.
+_HEADER_SIZE = 64
+# Every column is a float64, in this order, each holding capacity values back to back.
+COLUMNS = ('timestamp', 'temperature', 'humidity', 'pressure', 'gas', 'quality', 'calibrating')
+FIELDS = COLUMNS[1:]
+# The reading attribute each column is filled from.
+_ATTRIBUTES = ('timestamp', 'temperature', 'humidity', 'pressure', 'gas', 'iaq_index', 'calibrating')
+_SYNC_SECS = 60
+HISTORY_DIR = 'history'
+_STORE_SUFFIX = '.ring'
+
+
+def store_path(sensor_name, directory=HISTORY_DIR):
+    return os.path.join(directory, f'{sensor_name}{_STORE_SUFFIX}')
+
+
+class RingStore:
+    """
+    A fixed-size, memory-mapped file of the most recent readings, which overwrites the oldest once full.
+
+    Values are stored by column, so a query over one field only touches that field's pages, and whole ranges can be
+    handed to numpy without copying them out first. Readings are expected to be appended in time order, which lets a
+    time range be found by binary search rather than a scan.
+    """
+
+    def __init__(self, path, capacity=None, read_only=False):
+        self._path = path
+        self._read_only = read_only
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        if read_only:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f'No history store found at {path}.')
+        else:
+            utils.validate_can_write_dir(os.path.dirname(path) or '.')
+            if not os.path.isfile(path):
+                if not capacity:
+                    raise ValueError('A capacity is needed to create a new history store.')
+                self._create(path, capacity)
+        self._open()
+        if capacity and capacity != self.capacity and not read_only:
+            self._resize(capacity)
+
+    @staticmethod
+    def _create(path, capacity):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as store_file:
+            store_file.write(_HEADER.pack(_STORE_MAGIC, _STORE_VERSION, len(COLUMNS), capacity, 0, 0))
+            # Sparse where the filesystem allows it, so a long history costs nothing until it is filled.
+            store_file.truncate(_HEADER_SIZE + (len(COLUMNS) * capacity * 8))
+        os.replace(temp_path, path)
+
+    def _open(self):
+        with open(self._path, 'rb' if self._read_only else 'r+b') as store_file:
+            self._map = mmap.mmap(store_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ if self._read_only else mmap.ACCESS_WRITE)
+        magic, version, columns, capacity, _, _ = _HEADER.unpack_from(self._map)
+        if magic != _STORE_MAGIC or version != _STORE_VERSION or columns != len(COLUMNS) or \
+                len(self._map) != _HEADER_SIZE + (columns * capacity * 8):
+            self._map.close()
+            utils.early_quit(f'History store {self._path} is not in a recognised format, quitting.')
+        self.capacity = capacity
+        self._columns = np.ndarray((len(COLUMNS), capacity), dtype='<f8', buffer=self._map, offset=_HEADER_SIZE)
+
+    def _resize(self, capacity):
+        # Keep as many of the newest readings as fit in the new size.
+        utils.v_print(f'Resizing history store {self._path} from {self.capacity} to {capacity} readings.')
+        kept = self.query()
+        self.close()
+        os.remove(self._path)
+        self._create(self._path, capacity)
+        self._open()
+        count = min(len(kept['timestamp']), capacity)
+        if count:
+            for column, name in enumerate(COLUMNS):
+                self._columns[column, :count] = kept[name][-count:]
+        self._set_position(count % capacity, count)
+
+    def _position(self):
+        _, _, _, _, head, count = _HEADER.unpack_from(self._map)
+        return head, count
+
+    def _set_position(self, head, count):
+        _HEADER.pack_into(self._map, 0, _STORE_MAGIC, _STORE_VERSION, len(COLUMNS), self.capacity, head, count)
+
+    def __len__(self):
+        return self._position()[1]
+
+    def append(self, readings: [utils.DataCapture]):
+        with self._lock:
+            head, count = self._position()
+            for data in readings:
+                for column, attribute in enumerate(_ATTRIBUTES):
+                    self._columns[column, head] = getattr(data, attribute)
+                head = (head + 1) % self.capacity
+                count = min(count + 1, self.capacity)
+            # The position only moves once the values are in place, so a reader never sees a half written reading.
+            self._set_position(head, count)
+            if time.monotonic() - self._last_sync >= _SYNC_SECS:
+                self._map.flush()
+                self._last_sync = time.monotonic()
+
+    def _runs(self):
+        # The stored readings as (up to) two runs of column indexes, oldest first.
+        head, count = self._position()
+        if count < self.capacity:
+            return [(0, count)]
+        return [(head, self.capacity), (0, head)]
+
+    def query(self, start=None, end=None, fields=FIELDS):
+        """Returns the readings timestamped from start up to (not including) end, as a dict of column arrays."""
+        wanted = [COLUMNS.index(name) for name in ('timestamp',) + tuple(fields)]
+        pieces = []
+        for first, last in self._runs():
+            timestamps = self._columns[0, first:last]
+            low = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+            high = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='left'))
+            if low < high:
+                pieces.append(self._columns[wanted, first + low:first + high])
+        values = np.concatenate(pieces, axis=1) if pieces else np.empty((len(wanted), 0))
+        return {COLUMNS[column]: values[i] for i, column in enumerate(wanted)}
+
+    def aggregate(self, start, end, bucket_secs, fields=FIELDS):
+        """
+        Summarises the readings from start up to end into buckets of bucket_secs, returning the start time and
+        number of readings of each non-empty bucket, along with the mean, min and max of each field.
+        """
+        values = self.query(start, end, fields)
+        timestamps = values['timestamp']
+        if not len(timestamps):
+            return {'timestamp': timestamps, 'samples': np.empty(0, dtype=np.int64)}
+        buckets = np.floor_divide(timestamps - start, bucket_secs).astype(np.int64)
+        # The readings are in time order, so each bucket is one contiguous run.
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        samples = np.diff(np.append(starts, len(timestamps)))
+        result = {'timestamp': start + (buckets[starts] * bucket_secs), 'samples': samples}
+        for name in fields:
+            result[f'{name}_mean'] = np.add.reduceat(values[name], starts) / samples
+            result[f'{name}_min'] = np.minimum.reduceat(values[name], starts)
+            result[f'{name}_max'] = np.maximum.reduceat(values[name], starts)
+        return result
+
+    def close(self):
+        # Views onto the map have to go before it can be closed.
+        self._columns = None
+        if not self._read_only:
+            self._map.flush()
+        self._map.close()
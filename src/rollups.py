@@ -0,0 +1,125 @@
+import re
+from datetime import datetime, timezone
+
+import utils
+
+RP_RAW = 'autogen'
+# Holds the dashboard's rollup table, which must never expire.
+RP_FOREVER = 'forever'
+_RP_CONFIG_MEASUREMENT = 'rp_config'
+# Name, the retention policy it is kept in, the interval it is averaged over, the policy it is built from, and how
+# far back the continuous query recalculates, to take in readings which arrive late.
+ROLLUPS = (('1m', 'rollup_1m', '1m', RP_RAW, '10m'),
+           ('1h', 'rollup_1h', '1h', 'rollup_1m', '2h'),
+           ('1d', 'rollup_1d', '1d', 'rollup_1h', '2d'))
+RETENTION_NAMES = ['raw'] + [name for name, _, _, _, _ in ROLLUPS]
+_INTERVAL_NS = {'1m': 60 * 10 ** 9, '1h': 3600 * 10 ** 9, '1d': 86400 * 10 ** 9}
+# Readings written once they are this old have missed the continuous queries, and need backfill_rollups().
+LATE_READING_NS = 9 * 60 * 10 ** 9
+# How long each policy keeps its points for. The raw policy is left as it is unless one is given.
+DEFAULT_RETENTION = {'raw': None, '1m': '90d', '1h': '730d', '1d': 'INF'}
+_DURATION = re.compile(r'INF|(\d+(ns|us|u|ms|s|m|h|d|w))+')
+_DURATION_PART = re.compile(r'(\d+)(ns|us|u|ms|s|m|h|d|w)')
+_UNIT_MS = {'ns': 1e-6, 'us': 1e-3, 'u': 1e-3, 'ms': 1, 's': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000,
+            'd': 24 * 60 * 60 * 1000, 'w': 7 * 24 * 60 * 60 * 1000}
+_FIELDS = ('temperature', 'humidity', 'pressure', 'gas', 'quality')
+# Which policy the dashboard reads from, for time ranges up to this many milliseconds wide, unless the policy doesn't
+# keep its points that long.
+_DAY_MS = 24 * 60 * 60 * 1000
+_DASHBOARD_WIDEST = ((RP_RAW, _DAY_MS),
+                     ('rollup_1m', 30 * _DAY_MS),
+                     ('rollup_1h', 730 * _DAY_MS),
+                     ('rollup_1d', 2 ** 62))
+
+
+def is_duration(value):
+    return _DURATION.fullmatch(value) is not None
+
+
+def _duration_ms(duration):
+    # Either as given, or as influxDB lists it, e.g. '168h0m0s'. None for forever, which influxDB lists as '0s'.
+    if duration == 'INF':
+        return None
+    milliseconds = sum(int(count) * _UNIT_MS[unit] for count, unit in _DURATION_PART.findall(duration))
+    return milliseconds or None
+
+
+def dashboard_ranges(durations):
+    """
+    Which policy the dashboard reads from for each width of time range, as (policy, from, up to and including) in
+    milliseconds, given how long each policy keeps its points for. A policy is only read from for ranges it still has
+    all of the points for, with the next rollup taking over from there, so one which keeps its points for less time
+    than the one before is given an empty range.
+    """
+    ranges = []
+    start = 0
+    for index, (policy, widest) in enumerate(_DASHBOARD_WIDEST):
+        kept = _duration_ms(durations[policy]) if durations.get(policy) is not None else None
+        # The longest rollup is read from for anything wider, whether it still has it all or not.
+        end = widest if kept is None or index == len(_DASHBOARD_WIDEST) - 1 else min(widest, int(kept))
+        end = max(end, start)
+        ranges.append((policy, start, end))
+        start = end
+    return ranges
+
+
+def _rollup_query(database, measurement, policy, source, interval, where=''):
+    means = ', '.join(f'mean("{field}") AS "{field}"' for field in _FIELDS)
+    return f'SELECT {means} INTO "{database}"."{policy}"."{measurement}" ' \
+           f'FROM "{database}"."{source}"."{measurement}" {where}GROUP BY time({interval}), "hostname", "sensor"'
+
+
+def _format_ns(timestamp_ns):
+    return datetime.fromtimestamp(timestamp_ns // 10 ** 9, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def provision_rollups(client, database, measurement, retention=None):
+    """
+    Creates (or updates the durations of) the retention policies, and the continuous queries which fill the rollups
+    from the raw readings. Also records which policy the dashboard should read from, for each width of time range.
+    """
+    retention = dict(DEFAULT_RETENTION, **(retention or {}))
+    existing = {policy['name']: policy['duration'] for policy in client.get_list_retention_policies(database)}
+
+    durations = {RP_FOREVER: 'INF'}
+    if retention['raw'] is not None:
+        durations[RP_RAW] = retention['raw']
+    for name, policy, _, _, _ in ROLLUPS:
+        durations[policy] = retention[name]
+    for policy, duration in durations.items():
+        if policy in existing:
+            client.alter_retention_policy(policy, database=database, duration=duration)
+        else:
+            utils.v_print(f'Creating retention policy {policy}, keeping points for {duration}...')
+            client.create_retention_policy(policy, duration, 1, database=database)
+
+    queries = {query['name'] for listing in client.get_list_continuous_queries()
+               for query in listing.get(database, [])}
+    for name, policy, interval, source, resample_for in ROLLUPS:
+        query_name = f'{measurement}_rollup_{name}'
+        if query_name not in queries:
+            utils.v_print(f'Creating continuous query {query_name}...')
+            client.create_continuous_query(query_name, _rollup_query(database, measurement, policy, source, interval),
+                                           database=database, resample_opts=f'FOR {resample_for}')
+
+    client.write_points([{"measurement": _RP_CONFIG_MEASUREMENT,
+                          "tags": {"idx": index},
+                          "time": 0,
+                          "fields": {"rp": policy, "start": start, "end": end}}
+                         for index, (policy, start, end) in enumerate(dashboard_ranges(dict(existing, **durations)))],
+                        time_precision='ms', database=database, retention_policy=RP_FOREVER)
+
+
+def backfill_rollups(client, database, measurement, start_ns, end_ns, host=None):
+    """
+    Rolls up the readings between the two nanosecond times (inclusive), e.g. those sent on from a backup after an
+    outage, which arrived too late for the continuous queries to take them in. Each rollup is recalculated over whole
+    intervals, from the one before, so it has to be done in order.
+    """
+    conditions = 'time >= $start AND time < $end' + (' AND "hostname" = $host' if host is not None else '')
+    for _, policy, interval, source, _ in ROLLUPS:
+        step = _INTERVAL_NS[interval]
+        client.query(_rollup_query(database, measurement, policy, source, interval, f'WHERE {conditions} '),
+                     bind_params={'start': _format_ns((start_ns // step) * step),
+                                  'end': _format_ns(((end_ns // step) + 1) * step), 'host': host},
+                     database=database, method='POST')
@@ -0,0 +1,166 @@
+import itertools
+import math
+
+import numpy as np
+
+import utils
+
+# The value attributes of a reading, in the order of SampleBatch's value columns.
+VALUE_ATTRIBUTES = ('temperature', 'humidity', 'pressure', 'gas', 'iaq_index')
+NANOSECONDS = 1000000000
+_INITIAL_CAPACITY = 16
+
+
+class SampleBatch:
+    """
+    Readings held as parallel columns, rather than as an object each: a float64 column per value, int64 nanosecond
+    timestamps, and columns of flags and sensor numbers. Values dropped by compression are NaN, in rows marked partial.
+
+    Rows are appended one at a time, with the columns growing as needed, or whole columns are given at once, e.g. when
+    read back from the spool. Iterating gives each row back as a DataCapture.
+    """
+
+    def __init__(self, capacity=_INITIAL_CAPACITY):
+        self._length = 0
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty((len(VALUE_ATTRIBUTES), capacity), dtype=np.float64)
+        self._calibrating = np.empty(capacity, dtype=np.bool_)
+        self._partial = np.empty(capacity, dtype=np.bool_)
+        self._sensor_ids = np.empty(capacity, dtype=np.uint16)
+        # Sensor names, by their number in the sensor column.
+        self.sensors = []
+        self._sensor_numbers = {}
+        # The extra fields of each row (e.g. window aggregates), only kept once a row has some, as few ever do.
+        self._stats = None
+
+    @classmethod
+    def from_readings(cls, readings):
+        batch = cls(max(len(readings), 1))
+        batch.extend(readings)
+        return batch
+
+    @classmethod
+    def from_columns(cls, timestamps, values, calibrating, partial, sensor_ids, sensors, stats=None):
+        batch = cls(0)
+        batch._length = len(timestamps)
+        batch._timestamps = timestamps
+        batch._values = values
+        batch._calibrating = calibrating
+        batch._partial = partial
+        batch._sensor_ids = sensor_ids
+        batch.sensors = list(sensors)
+        batch._sensor_numbers = {name: number for number, name in enumerate(batch.sensors)}
+        batch._stats = stats
+        return batch
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        combined = cls(0)
+        sensor_ids = []
+        for batch in batches:
+            # Each batch numbers its sensors in its own order.
+            numbers = np.array([combined._sensor_number(name) for name in batch.sensors], dtype=np.uint16)
+            sensor_ids.append(numbers[batch.sensor_ids])
+        stats = None
+        if any(batch._stats is not None for batch in batches):
+            stats = [row for batch in batches for row in (batch._stats or [None] * len(batch))]
+        return cls.from_columns(np.concatenate([batch.timestamps for batch in batches]),
+                                np.concatenate([batch.values for batch in batches], axis=1),
+                                np.concatenate([batch.calibrating for batch in batches]),
+                                np.concatenate([batch.partial for batch in batches]),
+                                np.concatenate(sensor_ids) if sensor_ids else np.empty(0, dtype=np.uint16),
+                                combined.sensors, stats)
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self._length]
+
+    @property
+    def values(self):
+        return self._values[:, :self._length]
+
+    @property
+    def calibrating(self):
+        return self._calibrating[:self._length]
+
+    @property
+    def partial(self):
+        return self._partial[:self._length]
+
+    @property
+    def sensor_ids(self):
+        return self._sensor_ids[:self._length]
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def column(self, attribute):
+        return self._values[VALUE_ATTRIBUTES.index(attribute), :self._length]
+
+    def _sensor_number(self, name):
+        number = self._sensor_numbers.get(name)
+        if number is None:
+            number = self._sensor_numbers[name] = len(self.sensors)
+            self.sensors.append(name)
+        return number
+
+    def _grow(self):
+        capacity = max(len(self._timestamps) * 2, _INITIAL_CAPACITY)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        values = np.empty((len(VALUE_ATTRIBUTES), capacity), dtype=np.float64)
+        values[:, :self._length] = self.values
+        self._values = values
+        self._calibrating = np.resize(self._calibrating, capacity)
+        self._partial = np.resize(self._partial, capacity)
+        self._sensor_ids = np.resize(self._sensor_ids, capacity)
+
+    def append(self, data: utils.DataCapture):
+        index = self._length
+        if index == len(self._timestamps):
+            self._grow()
+        self._timestamps[index] = round(data.timestamp * NANOSECONDS)
+        if data.fields is None:
+            self._values[:, index] = (data.temperature, data.humidity, data.pressure, data.gas, data.iaq_index)
+        else:
+            self._values[:, index] = [getattr(data, attribute) if attribute in data.fields else math.nan
+                                      for attribute in VALUE_ATTRIBUTES]
+        self._calibrating[index] = data.calibrating
+        self._partial[index] = data.fields is not None
+        self._sensor_ids[index] = self._sensor_number(data.sensor)
+        if data.stats is not None and self._stats is None:
+            self._stats = [None] * index
+        if self._stats is not None:
+            self._stats.append(data.stats)
+        self._length += 1
+
+    def extend(self, readings):
+        for data in readings:
+            self.append(data)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('SampleBatch only supports slicing, iterate it for single readings.')
+        return SampleBatch.from_columns(self.timestamps[key].copy(), self.values[:, key].copy(),
+                                        self.calibrating[key].copy(), self.partial[key].copy(),
+                                        self.sensor_ids[key].copy(), self.sensors,
+                                        self._stats[:self._length][key] if self._stats is not None else None)
+
+    def __iter__(self):
+        rows = zip((self.timestamps / NANOSECONDS).tolist(), *(self.values.tolist()), self.calibrating.tolist(),
+                   self.partial.tolist(), self.sensor_ids.tolist(),
+                   self._stats if self._stats is not None else itertools.repeat(None))
+        for timestamp, temperature, humidity, pressure, gas, iaq_index, calibrating, partial, sensor, stats in rows:
+            fields = None
+            if partial:
+                fields = frozenset(attribute for attribute, value in
+                                   zip(VALUE_ATTRIBUTES, (temperature, humidity, pressure, gas, iaq_index))
+                                   if not math.isnan(value))
+            yield utils.DataCapture(temperature, humidity, pressure, gas, iaq_index, timestamp=timestamp,
+                                    sensor=self.sensors[sensor], calibrating=calibrating, stats=stats, fields=fields)
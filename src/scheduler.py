@@ -0,0 +1,83 @@
+import sched
+import signal
+import time
+
+import metrics
+import utils
+
+
+class _Stopped(Exception):
+    pass
+
+
+class DeadlineScheduler:
+    """
+    Runs actions periodically against absolute deadlines on the monotonic clock, until stop() is called.
+
+    The time an action takes does not push back the next run, so a job keeps to its period without drifting.
+    If an action overruns one or more whole periods, those deadlines are skipped and counted as missed.
+    """
+
+    def __init__(self):
+        self._scheduler = sched.scheduler(time.monotonic, self._sleep)
+        self.missed = 0
+        self.last_lag = 0.0
+        self._stopping = False
+        self._sleeping = False
+
+    def every(self, period, action, delay=0.0, priority=1):
+        self._enter(time.monotonic() + delay, period, action, priority)
+
+    def _enter(self, deadline, period, action, priority):
+        self._scheduler.enterabs(deadline, priority, self._run_job, argument=(deadline, period, action, priority))
+
+    def _run_job(self, deadline, period, action, priority):
+        if self._stopping:
+            return
+        self.last_lag = time.monotonic() - deadline
+        if metrics.enabled:
+            metrics.schedule_lag_seconds.observe(self.last_lag)
+        action()
+
+        next_deadline = deadline + period
+        overrun = time.monotonic() - next_deadline
+        if overrun > 0:
+            missed = int(overrun // period)
+            if missed:
+                self.missed += missed
+                if metrics.enabled:
+                    metrics.schedule_missed.inc(amount=missed)
+                utils.log.warning(f'Missed {missed} scheduled run(s) of {action.__name__}, '
+                                  f'{self.missed} missed in total.', extra=utils.rate_limited('schedule-missed'))
+                next_deadline += missed * period
+        self._enter(next_deadline, period, action, priority)
+
+    def _sleep(self, seconds):
+        self._sleeping = True
+        try:
+            if self._stopping:
+                return
+            if seconds is None:
+                # Nothing is scheduled, so wait for a signal to stop it.
+                signal.pause()
+            else:
+                time.sleep(seconds)
+        finally:
+            self._sleeping = False
+
+    def run(self):
+        """Runs the jobs until stop() is called, returning once the action running then (if any) has finished."""
+        try:
+            while not self._stopping:
+                self._sleep(self._scheduler.run(blocking=False))
+        except _Stopped:
+            pass
+
+    def stop(self):
+        """
+        Stops run(), which is safe to call from a signal handler: nothing is waited on or locked, and only a sleep
+        between runs is interrupted, never an action.
+        """
+        self._stopping = True
+        if self._sleeping:
+            raise _Stopped()
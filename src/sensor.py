@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 import bme680
+import copy
 import json
-import psutil
-import sys
 import time
-from datetime import datetime
 
+import cpu_temp
+from baseline import BaselineEstimator, BURN_IN_MINS
+import drivers
+import metrics
 import utils
 
-_FIRST_TIME_RUN_TIME_MINS = 20
+READ_TIMEOUT_SECS = 10
+# Waits between asking again for data which wasn't ready, doubling from the shortest up to the longest.
+_READ_POLL_MIN_SECS = 0.002
+_READ_POLL_MAX_SECS = 0.1
+# Measurement cycles taken by each oversampling setting, from bme680.OS_NONE to bme680.OS_16X.
+_OVERSAMPLE_CYCLES = (0, 1, 2, 4, 8, 16)
+# How long the bme680 library itself polls for a measurement (10 times) before saying it isn't ready.
+_DRIVER_POLL_SECS = (10 * bme680.POLL_PERIOD_MS) / 1000
 _CONFIG_FILE_NAME = 'sensor_config.json'
+_BASELINE_STATE_FILE_NAME = 'baseline_state.json'
 _DEFAULT_SENSOR_CONFIG = {
     "pressure_oversample": bme680.OS_4X,
     "temperature_oversample": bme680.OS_8X,
     "temperature_offset": 0.000,
     "cpu": {
         "rounding_factor": 0.7,
-        "smoothing_strength": 10
+        "smoothing_strength": 10,
+        "smoothing_mode": cpu_temp.SMOOTHING_WINDOW
     },
     "filter_size": bme680.FILTER_SIZE_7,
     "humidity": {
@@ -33,72 +44,108 @@ _DEFAULT_SENSOR_CONFIG = {
 }
 
 
+class SensorTimeout(Exception):
+    pass
+
+
+def measurement_seconds(config):
+    """
+    How long the sensor takes to make a measurement with the given config, the same way Bosch's own driver works it
+    out. The filter smooths each value with those before it, so it doesn't add to the time any one measurement takes.
+    """
+    cycles = sum(_OVERSAMPLE_CYCLES[oversample] for oversample in (config['temperature_oversample'],
+                                                                    config['pressure_oversample'],
+                                                                    config['humidity']['oversample']))
+    # Each cycle, switching between temperature, pressure and humidity, measuring gas, then 1ms to wake up.
+    microseconds = (cycles * 1963) + (477 * 4) + (477 * 5) + 1000
+    return (microseconds / 1000000) + (config['gas']['heater_duration'] / 1000)
+
+
+def sensor_file_name(file_name, sensor_name):
+    # The primary sensor keeps the original file names, any others get their own copies alongside.
+    if sensor_name == utils.DEFAULT_SENSOR_NAME:
+        return file_name
+    base, extension = file_name.rsplit('.', 1)
+    return f'{base}_{sensor_name}.{extension}'
+
+
 class Sensor:
-    def __init__(self):
+    def __init__(self, name=utils.DEFAULT_SENSOR_NAME, i2c_addr=bme680.I2C_ADDR_PRIMARY, i2c_bus=1,
+                 driver=drivers.DRIVER_BME680, replay_file=None, read_timeout=READ_TIMEOUT_SECS):
+        self.name = name
+        self._read_timeout = read_timeout
+        self._i2c_addr = i2c_addr
+        self._i2c_bus = i2c_bus
+        self._driver = driver
+        self._replay_file = replay_file
+        self._config_file_name = sensor_file_name(_CONFIG_FILE_NAME, name)
+
         # Configure
-        if utils.validate_file_exists(_CONFIG_FILE_NAME):
-            config = utils.get_json_from_file(_CONFIG_FILE_NAME)
+        self._baseline = None
+        if utils.validate_file_exists(self._config_file_name):
+            config = utils.get_json_from_file(self._config_file_name)
         else:
-            utils.validate_can_write_file(_CONFIG_FILE_NAME, should_del_after=True)
-            self._configure_sensor(_DEFAULT_SENSOR_CONFIG)
-            config = self.first_time_setup(_DEFAULT_SENSOR_CONFIG)
+            # No burn-in has finished yet, so work out the gas baseline from live readings as they come in.
+            utils.validate_can_write_file(self._config_file_name, should_del_after=True)
+            config = copy.deepcopy(_DEFAULT_SENSOR_CONFIG)
+            self._baseline = BaselineEstimator(sensor_file_name(_BASELINE_STATE_FILE_NAME, name))
+            utils.log.info(f'No config found for sensor \'{name}\', calibrating the gas baseline from the first '
+                           f'{BURN_IN_MINS}+ minutes of readings ({self._baseline.progress:.0%} done already). '
+                           f'Readings are flagged until then.')
+        self._config = config
         self._configure_sensor(config)
+        self._measurement_secs = measurement_seconds(config)
 
         # Populate properties based on config
-        self._data = utils.DataCapture()
         self.humidity_baseline = config['humidity']['baseline']
         self.humidity_gas_quality_ratio = config['humidity']['quality_weighting']
         self.gas_baseline = config['gas']['ambient_background']
-        self.__cpu = config['cpu']
-        self.__cpu['smoothing'] = []
-
-    def first_time_setup(self, config):
-        # Define burn-in variables
-        total_burn_in_time = 60 * _FIRST_TIME_RUN_TIME_MINS  # == 1MinuteInSeconds * DefaultBurnInTime
-        percent_complete_increment = total_burn_in_time / 10
-        next_milestone_marker = 0
-        percent_complete = 0
-        burn_in_data = []
-
-        # Let the user know what is about to happen
-        print(f'Collecting sensor first-time-run \'burn-in\' data for {_FIRST_TIME_RUN_TIME_MINS} minutes.')
-        print(f'Approximate completion time: '
-              f'{datetime.fromtimestamp(time.time() + total_burn_in_time).strftime("%d/%m/%Y %H:%M")}:00')
-
-        # Capture Data for pre-determined minutes
-        start_time = time.time()
-        current_time = time.time()
-        while current_time - start_time < total_burn_in_time:
-            # Decide if it's time for an update on progress.
-            if current_time - start_time >= next_milestone_marker:
-                print(f'Collecting Data... {percent_complete}% complete')
-                next_milestone_marker += percent_complete_increment
-                percent_complete = int((next_milestone_marker / total_burn_in_time) * 100)
-
-            # Capture more sensor data.
-            if self.sensor.get_sensor_data() and self.sensor.data.heat_stable:
-                ambient_gas_reading = self.sensor.data.gas_resistance
-                burn_in_data.append(ambient_gas_reading)
-                utils.v_print('Gas: {0} Ohms'.format(ambient_gas_reading))
-                # Rest for a second to save pounding the sensor / CPU unnecessarily.
-                time.sleep(1)
-
-            # Update the current time so while loop can progress.
-            current_time = time.time()
-
-        # Gather an average of the last 50 data points for smoothing and save as background readings.
-        config['gas']['ambient_background'] = sum(burn_in_data[-50:]) / 50.0
-
-        # Write data to config file.
-        with open(_CONFIG_FILE_NAME, 'w') as json_file:
-            json.dump(config, indent=4, fp=json_file)
-
-        # return new data.
-        return utils.get_json_from_file(_CONFIG_FILE_NAME)
+        if self._baseline is not None and self._baseline.estimate is not None:
+            self.gas_baseline = self._baseline.estimate
+        self.cpu_compensation = cpu_temp.CpuCompensation(self._cpu_temperature,
+                                                         config['cpu']['smoothing_strength'],
+                                                         config['cpu']['rounding_factor'],
+                                                         mode=config['cpu'].get('smoothing_mode',
+                                                                                cpu_temp.SMOOTHING_WINDOW),
+                                                         ewma_alpha=config['cpu'].get('ewma_alpha'))
+
+    @property
+    def read_secs(self):
+        # The least a read takes. Any measurement longer than the library's own polling isn't ready in time, and is
+        # then waited for in full.
+        if self._measurement_secs <= _DRIVER_POLL_SECS:
+            return self._measurement_secs
+        return _DRIVER_POLL_SECS + self._measurement_secs
+
+    @property
+    def calibrating(self):
+        return self._baseline is not None
+
+    def _update_baseline(self, gas):
+        self._baseline.update(gas)
+        self.gas_baseline = self._baseline.estimate
+        if not self._baseline.converged:
+            return
+
+        # Calibrated, so save the baseline to the config file, where it will be picked up on every future run.
+        self._config['gas']['ambient_background'] = self.gas_baseline
+        with open(self._config_file_name, 'w') as json_file:
+            json.dump(self._config, indent=4, fp=json_file)
+        self._baseline.discard()
+        self._baseline = None
+        utils.log.info(f'Gas baseline of sensor \'{self.name}\' calibrated at {self.gas_baseline:.2f} Ohms, '
+                       f'saved to {self._config_file_name}.')
+
+    def shutdown(self):
+        if self._baseline is not None:
+            self._baseline.checkpoint()
 
     def _configure_sensor(self, config):
         # Set necessities
-        self.sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
+        self.sensor = drivers.create_driver(self._driver, self._i2c_addr, self._replay_file, i2c_bus=self._i2c_bus,
+                                            seed=self._i2c_addr + (self._i2c_bus << 8),
+                                            rounding_factor=config['cpu']['rounding_factor'])
+        self._cpu_temperature = drivers.create_cpu_reader(self._driver, self.sensor)
         self.sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
         # Set Temp & Misc
         self.sensor.set_pressure_oversample(config['pressure_oversample'])
@@ -113,61 +160,78 @@ class Sensor:
         self.sensor.select_gas_heater_profile(config['gas']['heater_profile'])
 
     def read(self):
-        # Update the time taken for the next readings.
-        self._data.tick()
+        started = time.perf_counter()
+        # The time taken for the next readings.
+        timestamp = time.time()
 
-        # Wait until sensor is ready to be read from.
-        while (not self.sensor.get_sensor_data()) or (not self.sensor.data.heat_stable):
-            print(f'Sensor data not ready yet, waiting...', file=sys.stderr)
-            time.sleep(1)
+        self._wait_for_data(started)
 
         # Capture 'simple' data.
-        self._data.humidity = self.sensor.data.humidity
-        self._data.pressure = self.sensor.data.pressure
-        self._data.gas = self.sensor.data.gas_resistance
+        humidity = self.sensor.data.humidity
+        pressure = self.sensor.data.pressure
+        gas = self.sensor.data.gas_resistance
+
+        # Refine the gas baseline, if it's still being worked out.
+        calibrating = self.calibrating
+        if calibrating:
+            self._update_baseline(gas)
 
         # Capture current temperature - removing the CPU ambient temp
-        self._data.temperature = self._calculate_temperature()
+        temperature = self._calculate_temperature()
 
         # Capture Air Quality Score.
-        self._data.iaq_index = self._calculate_iaq_index()
+        iaq_index = self._calculate_iaq_index(humidity, gas)
 
-        # Return results to caller.
-        return self._data
-
-    def _calculate_iaq_index(self):
-        humidity_offset = self._data.humidity - self.humidity_baseline
-        gas_offset = self._data.gas - self.gas_baseline
-        if humidity_offset > 0:
-            hum_score = (100 - self.humidity_baseline - humidity_offset)
-            hum_score /= (100 - self.humidity_baseline)
-            hum_score *= (self.humidity_gas_quality_ratio * 100)
-        else:
-            hum_score = (self.humidity_baseline + humidity_offset)
-            hum_score /= self.humidity_baseline
-            hum_score *= (self.humidity_gas_quality_ratio * 100)
+        data = utils.DataCapture(temperature, humidity, pressure, gas, iaq_index, timestamp=timestamp, sensor=self.name,
+                                 calibrating=calibrating)
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, 'read')
+            metrics.record_reading(data)
 
-        if gas_offset > 0:
-            gas_score = (self._data.gas / self.gas_baseline)
-            gas_score *= (100 - (self.humidity_gas_quality_ratio * 100))
-        else:
-            gas_score = 100 - (self.humidity_gas_quality_ratio * 100)
+        # Return results to caller.
+        return data
 
-        return hum_score + gas_score
+    def _wait_for_data(self, started):
+        # Asking for data starts a measurement, so if it isn't ready, wait as long as one takes, then ask again more
+        # and more slowly, e.g. while the heater is still settling.
+        wait, poll = self._measurement_secs, _READ_POLL_MIN_SECS
+        while (not self.sensor.get_sensor_data()) or (not self.sensor.data.heat_stable):
+            if metrics.enabled:
+                metrics.sensor_not_ready.inc(self.name)
+            remaining = started + self._read_timeout - time.perf_counter()
+            if remaining <= 0:
+                raise SensorTimeout(f'Sensor \'{self.name}\' had no data ready within {self._read_timeout} seconds.')
+            time.sleep(min(wait, remaining))
+            wait, poll = poll, min(poll * 2, _READ_POLL_MAX_SECS)
+        if metrics.enabled:
+            metrics.sensor_read_seconds.observe(time.perf_counter() - started, self.name)
+
+    def _calculate_iaq_index(self, humidity, gas):
+        return calculate_iaq_index(humidity, gas, self.humidity_baseline, self.gas_baseline,
+                                   self.humidity_gas_quality_ratio)
 
     def _calculate_temperature(self):
-        # Get the current cpu temperature and record it
-        current_cpu_temp = psutil.sensors_temperatures()['cpu_thermal'][0][1]
-        self.__cpu['smoothing'].append(current_cpu_temp)
-        smoothing = self.__cpu['smoothing']
-
-        # Roll the list on to the most recent values.
-        if len(smoothing) > self.__cpu['smoothing_strength']:
-            self.__cpu['smoothing'] = smoothing[1:]
-
-        # Average the list of CPU temps
-        recent_avg = sum(smoothing) / float(len(smoothing))
-        snapshot = self.sensor.data.temperature
-
         # Offset the recorded value based on nearby CPU temps.
-        return snapshot - ((recent_avg - snapshot) / self.__cpu['rounding_factor'])
+        return self.cpu_compensation.compensate(self.sensor.data.temperature)
+
+
+# The scalar calculation, kept outside of the class so iaq.py can be checked against it.
+def calculate_iaq_index(humidity, gas, humidity_baseline, gas_baseline, quality_weighting):
+    humidity_offset = humidity - humidity_baseline
+    gas_offset = gas - gas_baseline
+    if humidity_offset > 0:
+        hum_score = (100 - humidity_baseline - humidity_offset)
+        hum_score /= (100 - humidity_baseline)
+        hum_score *= (quality_weighting * 100)
+    else:
+        hum_score = (humidity_baseline + humidity_offset)
+        hum_score /= humidity_baseline
+        hum_score *= (quality_weighting * 100)
+
+    if gas_offset > 0:
+        gas_score = (gas / gas_baseline)
+        gas_score *= (100 - (quality_weighting * 100))
+    else:
+        gas_score = 100 - (quality_weighting * 100)
+
+    return hum_score + gas_score
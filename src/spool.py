@@ -0,0 +1,461 @@
+import io
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+import utils
+from aggregation import STATS
+from sample_batch import NANOSECONDS, VALUE_ATTRIBUTES, SampleBatch
+
+# Every segment starts with a small header so the record layout can be checked on load.
+_SEGMENT_MAGIC = b'AQSP'
+_SEGMENT_HEADER = struct.Struct('<4sHH')  # Magic, version, record size.
+_SEGMENT_SUFFIX = '.seg'
+# The record layout of each segment version, so segments written before an upgrade can still be replayed.
+_RECORDS = {
+    1: struct.Struct('<dddddd'),  # timestamp, temperature, humidity, pressure, gas, iaq_index
+    2: struct.Struct('<ddddddH6x'),  # As 1, plus flags.
+    3: struct.Struct('<ddddddHH4x'),  # As 2, plus the sensor's number in the sensor name table.
+    # As 3, plus a window's stats (see aggregation.STATS), the sample count then the rest.
+    4: struct.Struct(f'<ddddddHHI{len(STATS) - 1}d'),
+}
+_SEGMENT_VERSION = 4
+_RECORD = _RECORDS[_SEGMENT_VERSION]
+_FLAG_CALIBRATING = 0x1
+# Only some values were kept by compression, the others are stored as NaN.
+_FLAG_PARTIAL = 0x2
+# The reading summarises a window, and has stats.
+_FLAG_STATS = 0x4
+# Sensor names, in the order they were first seen, so records only need to hold a number.
+_SENSORS_FILE_NAME = 'sensors.json'
+# The committed read position: segment number, record index within that segment.
+_OFFSET_FILE_NAME = 'read.offset'
+_OFFSET = struct.Struct('<QQ')
+SEGMENT_RECORDS = 10000
+_LINE_SEGMENT_SUFFIX = '.lines'
+LINE_SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+def _record_dtype(version):
+    # The same layout as the version's struct, so a whole chunk of records converts to or from columns at once.
+    names, formats, offsets = ['timestamp', *VALUE_ATTRIBUTES], ['<f8'] * 6, [0, 8, 16, 24, 32, 40]
+    if version >= 2:
+        names, formats, offsets = names + ['flags'], formats + ['<u2'], offsets + [48]
+    if version >= 3:
+        names, formats, offsets = names + ['sensor'], formats + ['<u2'], offsets + [50]
+    if version >= 4:
+        names, formats = names + list(STATS), formats + ['<u4'] + ['<f8'] * (len(STATS) - 1)
+        offsets = offsets + [52] + list(range(56, 56 + (8 * (len(STATS) - 1)), 8))
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': _RECORDS[version].size})
+
+
+_RECORD_DTYPES = {version: _record_dtype(version) for version in _RECORDS}
+
+
+def _list_segments(directory, suffix):
+    return sorted(int(name[:-len(suffix)]) for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def _load_offset(path):
+    try:
+        with open(path, 'rb') as offset_file:
+            return _OFFSET.unpack(offset_file.read(_OFFSET.size))
+    except (FileNotFoundError, struct.error):
+        return 0, 0
+
+
+def _save_offset(path, segment, position):
+    # Write then rename, so the committed position is never seen half written.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as offset_file:
+        offset_file.write(_OFFSET.pack(segment, position))
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+    os.replace(temp_path, path)
+
+
+class Spool:
+    """
+    An append-only, on-disk queue of readings which could not be sent to the database.
+
+    Readings are stored as fixed-width binary records, split over numbered segment files within a directory.
+    Consumers read from the committed position with peek(), and only move that position on with commit() once the
+    records have been handled, so a crash or a new failure part way through a replay resumes from the same place.
+    Fully consumed segments are deleted as the position moves past them.
+
+    Opened read only, e.g. to look at the backup while the logger is still writing to it, nothing on disk is changed
+    or created, and a partially written record at the end is left as it is and skipped.
+    """
+
+    def __init__(self, directory, segment_records=SEGMENT_RECORDS, read_only=False):
+        self._read_only = read_only
+        if not read_only:
+            utils.validate_can_write_dir(directory)
+        self._directory = directory
+        self._segment_records = segment_records
+        self._offset_path = os.path.join(directory, _OFFSET_FILE_NAME)
+        self._sensors_path = os.path.join(directory, _SENSORS_FILE_NAME)
+        # Readings may be spooled from the sampling loop and the writer thread at once.
+        self._lock = threading.RLock()
+        # Record layout of each segment, by segment number.
+        self._formats = {}
+        self._sensor_names = self._load_sensor_names()
+        self._sensor_ids = {name: number for number, name in enumerate(self._sensor_names)}
+
+        segments = self._list_segments()
+        # Where the next record will be read from.
+        self._read_segment, self._read_index = _load_offset(self._offset_path)
+        if segments and not (segments[0] <= self._read_segment <= segments[-1]):
+            # The segments it was in are gone (or were never written to), so start from the oldest there is.
+            self._read_segment, self._read_index = segments[0], 0
+        # Where the next appended record will go, numbered on from the read position when everything has been read,
+        # so new records are never behind it.
+        self._write_segment = segments[-1] if segments else max(self._read_segment, 1)
+        if not segments:
+            self._write_count = 0
+        elif read_only:
+            self._write_count = self._segment_length(self._write_segment)
+        else:
+            self._write_count = self._repair_segment(self._write_segment)
+        if self._segment_format(self._write_segment) != _SEGMENT_VERSION:
+            # Never mix record layouts within a segment, start a fresh one for anything new.
+            self._write_segment += 1
+            self._write_count = 0
+        if not segments:
+            self._read_segment, self._read_index = self._write_segment, 0
+
+    def __len__(self):
+        with self._lock:
+            return self._pending()
+
+    def _pending(self):
+        pending = 0
+        for segment in self._list_segments():
+            if segment >= self._read_segment:
+                pending += self._segment_length(segment)
+        return max(pending - self._read_index, 0)
+
+    def _segment_path(self, segment):
+        return os.path.join(self._directory, f'{segment:08d}{_SEGMENT_SUFFIX}')
+
+    def _list_segments(self):
+        if self._read_only and not os.path.isdir(self._directory):
+            return []
+        return _list_segments(self._directory, _SEGMENT_SUFFIX)
+
+    def _check_writable(self):
+        if self._read_only:
+            raise io.UnsupportedOperation(f'Spool {self._directory} is open read only.')
+
+    def _segment_format(self, segment):
+        # Segments which don't exist yet will be written in the current layout.
+        if segment not in self._formats:
+            path = self._segment_path(segment)
+            try:
+                with open(path, 'rb') as segment_file:
+                    header = segment_file.read(_SEGMENT_HEADER.size)
+            except FileNotFoundError:
+                return _SEGMENT_VERSION
+            if len(header) < _SEGMENT_HEADER.size:
+                return _SEGMENT_VERSION
+            magic, version, record_size = _SEGMENT_HEADER.unpack(header)
+            if magic != _SEGMENT_MAGIC or version not in _RECORDS or record_size != _RECORDS[version].size:
+                utils.early_quit(f'Spool segment {path} is not in a recognised format, quitting.')
+            self._formats[segment] = version
+        return self._formats[segment]
+
+    def _segment_length(self, segment):
+        try:
+            size = os.path.getsize(self._segment_path(segment))
+        except FileNotFoundError:
+            return 0
+        return max(size - _SEGMENT_HEADER.size, 0) // _RECORDS[self._segment_format(segment)].size
+
+    def _repair_segment(self, segment):
+        # Drop any partially written record left behind by a crash, so new appends stay aligned.
+        path = self._segment_path(segment)
+        if os.path.getsize(path) < _SEGMENT_HEADER.size:
+            os.remove(path)
+            return 0
+        count = self._segment_length(segment)
+        size = _SEGMENT_HEADER.size + (count * _RECORDS[self._segment_format(segment)].size)
+        if os.path.getsize(path) != size:
+            os.truncate(path, size)
+        return count
+
+    def _load_sensor_names(self):
+        try:
+            with open(self._sensors_path, 'r') as sensors_file:
+                return json.load(sensors_file)
+        except FileNotFoundError:
+            return [utils.DEFAULT_SENSOR_NAME]
+        except ValueError:
+            utils.early_quit(f'Spool sensor table {self._sensors_path} is damaged, quitting.')
+
+    def _sensor_id(self, name):
+        if name not in self._sensor_ids:
+            self._sensor_ids[name] = len(self._sensor_names)
+            self._sensor_names.append(name)
+            temp_path = self._sensors_path + '.tmp'
+            with open(temp_path, 'w') as sensors_file:
+                json.dump(self._sensor_names, sensors_file)
+            os.replace(temp_path, self._sensors_path)
+        return self._sensor_ids[name]
+
+    def append(self, data):
+        """Appends a SampleBatch, or a list of readings."""
+        if not isinstance(data, SampleBatch):
+            data = SampleBatch.from_readings(list(data))
+        self._check_writable()
+        with self._lock:
+            self._append(data)
+
+    def _append(self, data):
+        while data:
+            if self._write_count >= self._segment_records:
+                self._write_segment += 1
+                self._write_count = 0
+            room = self._segment_records - self._write_count
+            chunk, data = data[:room], data[room:]
+            path = self._segment_path(self._write_segment)
+            with open(path, 'ab') as segment_file:
+                if self._write_count == 0:
+                    segment_file.write(_SEGMENT_HEADER.pack(_SEGMENT_MAGIC, _SEGMENT_VERSION, _RECORD.size))
+                    self._formats[self._write_segment] = _SEGMENT_VERSION
+                segment_file.write(self._encode(chunk))
+            self._write_count += len(chunk)
+
+    def peek(self, max_records) -> SampleBatch:
+        """Reads up to max_records from the committed position, without moving it."""
+        with self._lock:
+            return self._peek(max_records)
+
+    def _peek(self, max_records):
+        chunks = []
+        found = 0
+        segment, index = self._read_segment, self._read_index
+        while found < max_records and segment <= self._write_segment:
+            available = self._segment_length(segment) - index
+            if available > 0:
+                count = min(available, max_records - found)
+                chunks.append(self._read(segment, index, count))
+                found += count
+            segment, index = segment + 1, 0
+        return SampleBatch.concatenate(chunks) if chunks else SampleBatch(0)
+
+    def commit(self, count):
+        """
+        Moves the committed position on by count records (or as many as there are), deleting any segments which are now
+        fully consumed.
+        """
+        self._check_writable()
+        with self._lock:
+            self._commit(count)
+
+    def _commit(self, count):
+        # Never past the last record, which would number the next segment on past records not yet written.
+        index = self._read_index + min(count, self._pending())
+        while index > 0 and self._read_segment <= self._write_segment:
+            length = self._segment_length(self._read_segment)
+            if index < length:
+                break
+            # Everything in this segment has been handled.
+            index -= length
+            if self._read_segment == self._write_segment:
+                self._write_segment += 1
+                self._write_count = 0
+            os.remove(self._segment_path(self._read_segment))
+            self._formats.pop(self._read_segment, None)
+            self._read_segment += 1
+        self._read_index = index
+        _save_offset(self._offset_path, self._read_segment, self._read_index)
+
+    def iterate(self, chunk_records=SEGMENT_RECORDS):
+        """Yields every pending record, a SampleBatch at a time, without moving the committed position."""
+        for segment in self._list_segments():
+            index = self._read_index if segment == self._read_segment else 0
+            while True:
+                with self._lock:
+                    if segment < self._read_segment or not os.path.exists(self._segment_path(segment)):
+                        break
+                    count = min(self._segment_length(segment) - index, chunk_records)
+                    if count <= 0:
+                        break
+                    records = self._read(segment, index, count)
+                index += count
+                yield records
+
+    def rewrite(self, transform, chunk_records=SEGMENT_RECORDS):
+        """
+        Replaces every pending record, in place, with the result of transform(records) for each SampleBatch of
+        records. The transform must give back the same number of records it was given, in the same order.
+        """
+        self._check_writable()
+        rewritten = 0
+        for segment in self._list_segments():
+            index = self._read_index if segment == self._read_segment else 0
+            while True:
+                with self._lock:
+                    if segment < self._read_segment or not os.path.exists(self._segment_path(segment)):
+                        break
+                    count = min(self._segment_length(segment) - index, chunk_records)
+                    if count <= 0:
+                        break
+                    version = self._segment_format(segment)
+                    records = transform(self._read(segment, index, count))
+                    with open(self._segment_path(segment), 'r+b') as segment_file:
+                        segment_file.seek(_SEGMENT_HEADER.size + (index * _RECORDS[version].size))
+                        segment_file.write(self._encode(records, version))
+                index += count
+                rewritten += count
+        return rewritten
+
+    def _read(self, segment, index, count):
+        version = self._segment_format(segment)
+        record = _RECORDS[version]
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            segment_file.seek(_SEGMENT_HEADER.size + (index * record.size))
+            raw = segment_file.read(count * record.size)
+        return self._decode(raw, version)
+
+    def _encode(self, data: SampleBatch, version=_SEGMENT_VERSION):
+        records = np.zeros(len(data), dtype=_RECORD_DTYPES[version])
+        records['timestamp'] = data.timestamps / NANOSECONDS
+        for attribute in VALUE_ATTRIBUTES:
+            records[attribute] = data.column(attribute)
+        if version >= 2:
+            records['flags'] = np.where(data.calibrating, _FLAG_CALIBRATING, 0)
+        if version >= 3:
+            records['flags'] |= np.where(data.partial, _FLAG_PARTIAL, 0).astype(np.uint16)
+            sensor_ids = np.array([self._sensor_id(name) for name in data.sensors], dtype=np.uint16)
+            records['sensor'] = sensor_ids[data.sensor_ids]
+        if version >= 4 and data.stats is not None:
+            rows = [index for index, stats in enumerate(data.stats) if stats is not None]
+            records['flags'][rows] |= _FLAG_STATS
+            for name in STATS:
+                records[name][rows] = [data.stats[index][name] for index in rows]
+        return records.tobytes()
+
+    def _decode(self, raw, version=_SEGMENT_VERSION):
+        records = np.frombuffer(raw, dtype=_RECORD_DTYPES[version])
+        count = len(records)
+        flags = records['flags'] if version >= 2 else np.zeros(count, dtype=np.uint16)
+        stats = None
+        if version >= 4 and (flags & _FLAG_STATS).any():
+            stats = [dict(zip(STATS, row)) if flag & _FLAG_STATS else None
+                     for row, flag in zip(records[list(STATS)].tolist(), flags.tolist())]
+        return SampleBatch.from_columns(np.rint(records['timestamp'] * NANOSECONDS).astype(np.int64),
+                                        np.stack([records[attribute] for attribute in VALUE_ATTRIBUTES]),
+                                        (flags & _FLAG_CALIBRATING) != 0,
+                                        (flags & _FLAG_PARTIAL) != 0 if version >= 3 else np.zeros(count, dtype=bool),
+                                        records['sensor'].astype(np.uint16) if version >= 3 else
+                                        np.zeros(count, dtype=np.uint16), self._sensor_names, stats)
+
+
+class LineSpool:
+    """
+    An append-only, on-disk queue of line protocol, for points which arrive already encoded (e.g. at a gateway) and so
+    have no fixed layout to store them in.
+
+    Works as Spool does, with numbered segment files and a committed position, except that segments hold newline
+    separated lines, and the position is a byte offset into its segment.
+    """
+
+    def __init__(self, directory, segment_bytes=LINE_SEGMENT_BYTES):
+        utils.validate_can_write_dir(directory)
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._offset_path = os.path.join(directory, _OFFSET_FILE_NAME)
+        self._lock = threading.RLock()
+
+        segments = _list_segments(directory, _LINE_SEGMENT_SUFFIX)
+        self._read_segment, self._read_offset = _load_offset(self._offset_path)
+        if segments and not (segments[0] <= self._read_segment <= segments[-1]):
+            self._read_segment, self._read_offset = segments[0], 0
+        # As in Spool, numbered on from the read position when everything has been read.
+        self._write_segment = segments[-1] if segments else max(self._read_segment, 1)
+        self._write_size = self._repair_segment(self._write_segment) if segments else 0
+        if not segments:
+            self._read_segment, self._read_offset = self._write_segment, 0
+        # Counted once here, then kept up to date, as counting means reading every pending line.
+        self._pending = sum(len(lines) for lines in self._read_lines())
+
+    def __len__(self):
+        return self._pending
+
+    def _segment_path(self, segment):
+        return os.path.join(self._directory, f'{segment:08d}{_LINE_SEGMENT_SUFFIX}')
+
+    def _repair_segment(self, segment):
+        # Drop any partially written line left behind by a crash, so it isn't glued onto the next one.
+        path = self._segment_path(segment)
+        with open(path, 'rb') as segment_file:
+            contents = segment_file.read()
+        size = contents.rfind(b'\n') + 1
+        if size != len(contents):
+            os.truncate(path, size)
+        return size
+
+    def append(self, lines: [bytes]):
+        """Appends each line, which must end with a newline."""
+        with self._lock:
+            if self._write_size >= self._segment_bytes:
+                self._write_segment += 1
+                self._write_size = 0
+            body = b''.join(lines)
+            with open(self._segment_path(self._write_segment), 'ab') as segment_file:
+                segment_file.write(body)
+            self._write_size += len(body)
+            self._pending += len(lines)
+
+    def _read_lines(self, max_lines=None):
+        # Yields the lines of each segment from the committed position on, a segment at a time.
+        segment, offset = self._read_segment, self._read_offset
+        remaining = max_lines
+        while segment <= self._write_segment and (remaining is None or remaining > 0):
+            try:
+                with open(self._segment_path(segment), 'rb') as segment_file:
+                    segment_file.seek(offset)
+                    lines = []
+                    for line in segment_file:
+                        if remaining is not None and len(lines) >= remaining:
+                            break
+                        lines.append(line)
+            except FileNotFoundError:
+                lines = []
+            if lines:
+                yield lines
+                if remaining is not None:
+                    remaining -= len(lines)
+            segment, offset = segment + 1, 0
+
+    def peek(self, max_lines) -> [bytes]:
+        """Reads up to max_lines from the committed position, without moving it."""
+        with self._lock:
+            return [line for lines in self._read_lines(max_lines) for line in lines]
+
+    def commit(self, lines: [bytes]):
+        """Moves the committed position past the given lines, which must be those last peeked."""
+        with self._lock:
+            offset = self._read_offset + sum(len(line) for line in lines)
+            while self._read_segment <= self._write_segment:
+                try:
+                    size = os.path.getsize(self._segment_path(self._read_segment))
+                except FileNotFoundError:
+                    size = 0
+                if offset < size or (offset == 0 and self._read_segment == self._write_segment):
+                    break
+                # Everything in this segment has been handled.
+                offset -= size
+                if self._read_segment == self._write_segment:
+                    self._write_segment += 1
+                    self._write_size = 0
+                if size:
+                    os.remove(self._segment_path(self._read_segment))
+                self._read_segment += 1
+            self._read_offset = offset
+            self._pending = max(self._pending - len(lines), 0)
+            _save_offset(self._offset_path, self._read_segment, self._read_offset)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBServerError
+from requests.exceptions import ConnectionError as ReqConnectionError, Timeout as ReqTimeout
+
+import log_output
+import utils
+from data_logging import DB_FAILED_WRITES, DB_TABLE, DB_USER, DB_PASS
+from line_protocol import GZIP_WRITE_HEADERS, PRECISION_MS, READING_FIELDS, WRITE_HEADERS, render_line
+from spool import Spool
+
+_MEASUREMENT = 'AQ'
+FORMAT_LINE = 'lp'
+FORMAT_CSV = 'csv'
+_SPOOL_CHUNK = 10000
+_FILE_GZIP_LEVEL = 6
+_UPLOAD_GZIP_LEVEL = 1
+_UPLOAD_TIMEOUT = 30
+_UPLOAD_ATTEMPTS = 4
+# The tags written by the application. Every other column of a CSV file is a field.
+_TAGS = ('hostname', 'runID', 'sensor')
+_FIELD_TYPES = {'float': float, 'integer': int, 'boolean': bool, 'string': str}
+# Readings exported from the spool were never written by any run, so they are tagged with a run of their own.
+_EXPORT_RUN_ID = uuid.uuid4()
+
+
+def get_commandline_args():
+    """
+    Collects various arguments from the command line to decide what to export or import, and where to.
+    :return: An object containing the accepted, parsed, arguments.
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-v", "--verbose",
+                        help="Display verbose console output.",
+                        action="store_true",
+                        default=False)
+    common.add_argument("-db", "--database",
+                        type=str,
+                        help="The hostname/URL/IP Address of your influxDB instance.",
+                        default="localhost")
+    common.add_argument("-p", "--port",
+                        type=int,
+                        help="The port of your influxDB instance. (1024-65535)",
+                        default=8086)
+    common.add_argument("--format",
+                        choices=[FORMAT_LINE, FORMAT_CSV],
+                        help="The file format. Defaults to csv for .csv(.gz) files, and line protocol otherwise.",
+                        default=None)
+
+    argument_parser = argparse.ArgumentParser(description="Export readings to line protocol or CSV files, or bulk "
+                                                          "import such files into influxDB.")
+    commands = argument_parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', parents=[common],
+                                        help="Stream readings from influxDB or the local backup to a file.")
+    export_parser.add_argument("output",
+                               type=str,
+                               help="The file to write. Compressed with gzip if it ends in .gz.")
+    export_parser.add_argument("--source",
+                               choices=['influx', 'spool'],
+                               help="Export readings already in influxDB, or those waiting in the local backup.",
+                               default='influx')
+    export_parser.add_argument("--start",
+                               type=str,
+                               help="Only export readings from this UTC time on, e.g. 2020-06-01T00:00:00. "
+                                    "Defaults to the oldest reading.",
+                               required=False)
+    export_parser.add_argument("--end",
+                               type=str,
+                               help="Only export readings before this UTC time. Defaults to now.",
+                               required=False)
+    export_parser.add_argument("--hours-per-chunk",
+                               type=int,
+                               help="How many hours of readings to fetch from influxDB at a time.",
+                               default=6)
+    export_parser.add_argument("--host",
+                               type=str,
+                               help="Only export readings logged by this hostname. Defaults to every host.",
+                               default=None)
+
+    import_parser = commands.add_parser('import', parents=[common],
+                                        help="Upload a file of readings to influxDB, in parallel chunks.")
+    import_parser.add_argument("input",
+                               type=str,
+                               help="The file to read. Decompressed with gzip if it ends in .gz.")
+    import_parser.add_argument("--chunk-lines",
+                               type=int,
+                               help="How many readings to upload in each request.",
+                               default=5000)
+    import_parser.add_argument("--workers",
+                               type=int,
+                               help="How many chunks to upload at once.",
+                               default=4)
+    import_parser.add_argument("--precision",
+                               choices=['ns', 'u', 'ms', 's'],
+                               help="The precision of the timestamps in a line protocol file. CSV files are always "
+                                    "in milliseconds.",
+                               default=PRECISION_MS)
+    import_parser.add_argument("--gzip",
+                               help="Compress each chunk before uploading it.",
+                               action="store_true",
+                               default=False)
+    import_parser.add_argument("--progress-file",
+                               type=str,
+                               help="Where to keep track of the chunks uploaded, so an interrupted import can be "
+                                    "carried on by running it again. Defaults to the input file name + .progress",
+                               default=None)
+    parsed_arguments = argument_parser.parse_args()
+    utils.verbose = parsed_arguments.verbose
+    return parsed_arguments
+
+
+def _parse_time(value, default):
+    if value is None:
+        return default
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def _file_format(path, chosen):
+    if chosen is not None:
+        return chosen
+    name = path[:-3] if path.endswith('.gz') else path
+    return FORMAT_CSV if name.endswith('.csv') else FORMAT_LINE
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='', compresslevel=_FILE_GZIP_LEVEL)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _spool_points(start, end):
+    # Opened read only, so the backup is left exactly as the logger (which may still be writing to it) will find it.
+    for records in Spool(DB_FAILED_WRITES, read_only=True).iterate(chunk_records=_SPOOL_CHUNK):
+        for data in records:
+            if (start is not None and data.timestamp < start.timestamp()) or data.timestamp >= end.timestamp():
+                continue
+            fields = {field: getattr(data, attribute) for attribute, field in READING_FIELDS
+                      if data.fields is None or attribute in data.fields}
+            fields['calibrating'] = data.calibrating
+            yield ({'hostname': utils.HOST_NAME, 'runID': str(_EXPORT_RUN_ID), 'sensor': data.sensor}, fields,
+                   round(data.timestamp * 1000))
+
+
+def _influx_columns(client):
+    tags = sorted(point['tagKey'] for point in client.query(f'SHOW TAG KEYS FROM "{_MEASUREMENT}"').get_points())
+    field_types = {point['fieldKey']: _FIELD_TYPES[point['fieldType']]
+                   for point in client.query(f'SHOW FIELD KEYS FROM "{_MEASUREMENT}"').get_points()}
+    return tags, field_types
+
+
+def _influx_points(client, field_types, start, end, hours_per_chunk, host):
+    conditions = ['"hostname" = $host'] if host is not None else []
+    if start is None:
+        # Whichever fields it has, as older readings may lack some, e.g. calibrating from before it was added.
+        first = list(client.query(f'SELECT * FROM "{_MEASUREMENT}" '
+                                  f'{"WHERE " + conditions[0] if conditions else ""} LIMIT 1',
+                                  bind_params={'host': host}, epoch='ms').get_points())
+        if not first:
+            return
+        start = datetime.fromtimestamp(first[0]['time'] / 1000, tz=timezone.utc)
+
+    # Work through the range a window at a time, so only one window of readings is ever held in memory.
+    step = timedelta(hours=hours_per_chunk)
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + step, end)
+        result = client.query(f'SELECT * FROM "{_MEASUREMENT}" '
+                              f'WHERE {" AND ".join(conditions + ["time >= $start AND time < $end"])} GROUP BY *',
+                              bind_params={'host': host,
+                                           'start': window_start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                                           'end': window_end.strftime('%Y-%m-%dT%H:%M:%S.%fZ')},
+                              epoch='ms')
+        for (_, tags), points in result.items():
+            for point in points:
+                # JSON results don't tell floats from integers, so each value is given its field's type back.
+                yield tags, {key: field_types[key](value) for key, value in point.items()
+                             if key != 'time' and value is not None}, point['time']
+        utils.v_print(f'Exported readings up to {window_end.isoformat()}.')
+        window_start = window_end
+
+
+def _format_time(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).isoformat(timespec='milliseconds')
+
+
+def write_points(points, out, output_format, tags, fields):
+    """Writes each (tags, fields, millisecond timestamp) point to the file as it comes, returning how many there were."""
+    count = 0
+    if output_format == FORMAT_CSV:
+        writer = csv.DictWriter(out, fieldnames=['time'] + list(tags) + list(fields))
+        writer.writeheader()
+        for point_tags, point_fields, timestamp in points:
+            writer.writerow({'time': _format_time(timestamp), **point_tags, **point_fields})
+            count += 1
+    else:
+        for point_tags, point_fields, timestamp in points:
+            out.write(render_line(_MEASUREMENT, point_tags, point_fields, timestamp) + '\n')
+            count += 1
+    return count
+
+
+def export(parsed_args):
+    output_format = _file_format(parsed_args.output, parsed_args.format)
+    utils.validate_can_write_file(parsed_args.output)
+    end = _parse_time(parsed_args.end, datetime.now(timezone.utc))
+    start = _parse_time(parsed_args.start, None)
+
+    client = None
+    if parsed_args.source == 'spool':
+        tags = _TAGS
+        fields = [field for _, field in READING_FIELDS] + ['calibrating']
+        points = _spool_points(start, end)
+    else:
+        client = InfluxDBClient(host=parsed_args.database, port=parsed_args.port, username=DB_USER,
+                                password=DB_PASS, database=DB_TABLE)
+        tags, field_types = _influx_columns(client)
+        fields = sorted(field_types)
+        points = _influx_points(client, field_types, start, end, parsed_args.hours_per_chunk, parsed_args.host)
+
+    with _open(parsed_args.output, 'w') as out:
+        count = write_points(points, out, output_format, tags, fields)
+    if client is not None:
+        client.close()
+    print(f'Exported {count} readings to {parsed_args.output}.')
+
+
+def _parse_value(text):
+    # Exported values are written the way Python prints them, which is enough to tell their types apart again.
+    if text == 'True' or text == 'False':
+        return text == 'True'
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    # Floats are always printed with a decimal point or an exponent, so anything else was an integer.
+    return int(text) if text.lstrip('-').isdigit() else number
+
+
+def _read_lines(path, input_format):
+    """Yields each reading in the file as a line of line protocol, without reading the whole file in."""
+    with _open(path, 'r') as source:
+        if input_format == FORMAT_LINE:
+            for line in source:
+                if line.strip() and not line.startswith('#'):
+                    yield line if line.endswith('\n') else line + '\n'
+            return
+        for row in csv.DictReader(source):
+            timestamp = round(datetime.fromisoformat(row.pop('time')).timestamp() * 1000)
+            tags = {key: row.pop(key) for key in _TAGS if key in row}
+            fields = {key: _parse_value(value) for key, value in row.items() if value != ''}
+            yield render_line(_MEASUREMENT, tags, fields, timestamp) + '\n'
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ImportProgress:
+    """
+    Which chunks of a file have been uploaded, saved as each one finishes, so an interrupted import skips them when
+    run again. Chunks finish out of order, so only those past the first one still missing are listed.
+    """
+
+    def __init__(self, path, chunk_lines):
+        self._path = path
+        self.chunk_lines = chunk_lines
+        self._complete_below = 0
+        self._done = set()
+        if os.path.exists(path):
+            saved = utils.get_json_from_file(path)
+            # The chunks saved are only the same chunks if the file is split up the same way.
+            self.chunk_lines = saved['chunk_lines']
+            self._complete_below = saved['complete_below']
+            self._done = set(saved['done'])
+
+    def is_done(self, index):
+        return index < self._complete_below or index in self._done
+
+    def mark_done(self, index):
+        self._done.add(index)
+        while self._complete_below in self._done:
+            self._done.remove(self._complete_below)
+            self._complete_below += 1
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as progress_file:
+            json.dump({'chunk_lines': self.chunk_lines, 'complete_below': self._complete_below,
+                       'done': sorted(self._done)}, progress_file)
+        os.replace(temp_path, self._path)
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class Uploader:
+    """Writes chunks of line protocol to influxDB, each thread over its own connection."""
+
+    def __init__(self, hostname, port, precision, gzip_chunks=False):
+        self._hostname = hostname
+        self._port = port
+        self._precision = precision
+        self._gzip = gzip_chunks
+        self._local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = InfluxDBClient(host=self._hostname, port=self._port, username=DB_USER,
+                                                         password=DB_PASS, database=DB_TABLE,
+                                                         timeout=_UPLOAD_TIMEOUT)
+            with self._clients_lock:
+                self._clients.append(client)
+        return client
+
+    def upload(self, index, lines):
+        body = ''.join(lines).encode('utf-8')
+        headers = WRITE_HEADERS
+        if self._gzip:
+            body = gzip.compress(body, compresslevel=_UPLOAD_GZIP_LEVEL)
+            headers = GZIP_WRITE_HEADERS
+        for attempt in range(_UPLOAD_ATTEMPTS):
+            try:
+                self._client().request(url='write', method='POST', data=body, headers=headers,
+                                       params={'db': DB_TABLE, 'precision': self._precision},
+                                       expected_response_code=204)
+                return index, len(lines)
+            except (InfluxDBServerError, ReqConnectionError, ReqTimeout) as err:
+                # Rejected points won't be accepted on a retry, but a busy or restarting server may recover.
+                if attempt == _UPLOAD_ATTEMPTS - 1:
+                    raise
+                utils.v_print(f'Chunk {index} failed, retrying: {err}')
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+
+
+def import_file(parsed_args):
+    if not utils.validate_file_exists(parsed_args.input):
+        utils.early_quit(f'No file found at {parsed_args.input}, quitting.')
+    input_format = _file_format(parsed_args.input, parsed_args.format)
+    precision = PRECISION_MS if input_format == FORMAT_CSV else parsed_args.precision
+    progress = ImportProgress(parsed_args.progress_file or parsed_args.input + '.progress', parsed_args.chunk_lines)
+    if progress.chunk_lines != parsed_args.chunk_lines:
+        utils.v_print(f'Carrying on an earlier import in chunks of {progress.chunk_lines} readings.')
+
+    # Creating a database which already exists does nothing, so a fresh instance can be loaded straight away.
+    admin = InfluxDBClient(host=parsed_args.database, port=parsed_args.port)
+    try:
+        admin.create_database(DB_TABLE)
+    except Exception as err:
+        utils.early_quit(f'Unable to reach influxDB at {parsed_args.database}:{parsed_args.port}, {err}')
+    finally:
+        admin.close()
+
+    uploader = Uploader(parsed_args.database, parsed_args.port, precision, parsed_args.gzip)
+    started = time.perf_counter()
+    written = 0
+    errors = []
+
+    def record(finished):
+        nonlocal written
+        for future in finished:
+            try:
+                finished_index, count = future.result()
+            except Exception as err:
+                errors.append(err)
+                continue
+            progress.mark_done(finished_index)
+            written += count
+
+    # Only a couple of chunks per worker are read ahead of the uploads, so memory stays flat however big the file.
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=parsed_args.workers) as pool:
+        for index, lines in enumerate(_chunks(_read_lines(parsed_args.input, input_format), progress.chunk_lines)):
+            if progress.is_done(index):
+                continue
+            if len(in_flight) >= parsed_args.workers * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                record(finished)
+                if errors:
+                    break
+            in_flight.add(pool.submit(uploader.upload, index, lines))
+        # Whatever is already uploading is seen through, so the progress saved is as far on as it can be.
+        record(wait(in_flight).done)
+    uploader.close()
+
+    elapsed = time.perf_counter() - started
+    if errors:
+        utils.early_quit(f'Import stopped after uploading {written} readings: {errors[0]}\n'
+                         f'Run the same command again to carry on from where it stopped.')
+    progress.remove()
+    print(f'Imported {written} readings in {elapsed:.1f} s ({written / max(elapsed, 1e-9):.0f} readings/s).')
+
+
+if __name__ == '__main__':
+    parsed_args = get_commandline_args()
+    log_output.configure()
+    if parsed_args.command == 'export':
+        if parsed_args.hours_per_chunk < 1:
+            utils.early_quit('Hours per chunk must be at least 1, quitting.')
+        export(parsed_args)
+    else:
+        if parsed_args.chunk_lines < 1 or parsed_args.workers < 1:
+            utils.early_quit('Chunk lines and workers must both be at least 1, quitting.')
+        import_file(parsed_args)
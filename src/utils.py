@@ -1,17 +1,27 @@
 import json
+import logging
 import os.path
 import sys
 import time
+from collections import namedtuple
 from datetime import datetime
 from socket import gethostname
 
 verbose = True
 HOST_NAME = gethostname()
+DEFAULT_SENSOR_NAME = 'primary'
+# Everything the application reports while running goes through here, see log_output.configure().
+log = logging.getLogger('aq')
 
 
 def v_print(content):
     if verbose:
-        print(content)
+        log.info(content)
+
+
+def rate_limited(key):
+    """The extra to log a message with, so it is only logged once per rate limit interval, e.g. a repeated failure."""
+    return {'rate_key': key}
 
 
 def early_quit(reason='An unexpected error occurred and the program had to terminate'):
@@ -36,6 +46,18 @@ def validate_can_write_file(path, should_del_after=False):
         early_quit(f'No write permissions allowed to config file destination, {path}, quitting.')
 
 
+def validate_can_write_dir(path):
+    if os.path.exists(path) and not os.path.isdir(path):
+        early_quit(f'Destination for directory, {path} is marked as a file, quitting.')
+    try:
+        os.makedirs(path, exist_ok=True)
+    except Exception:
+        early_quit(f'Unable to create directory, {path}, quitting.')
+    if not os.access(path, os.W_OK):
+        early_quit(f'No write permissions given for path, {path}, quitting.')
+    return True
+
+
 def validate_file_exists(path):
     if os.path.exists(path):
         if os.path.isfile(path):
@@ -58,21 +80,33 @@ def get_json_from_file(path):
     return config_data
 
 
-class DataCapture:
-    timestamp = time.time()
+_DATA_CAPTURE_FIELDS = ('temperature', 'humidity', 'pressure', 'gas', 'iaq_index', 'timestamp', 'sensor',
+                        'calibrating', 'stats', 'fields')
+
+
+class DataCapture(namedtuple('DataCapture', _DATA_CAPTURE_FIELDS)):
+    """
+    A single reading, made fresh for every read. It can't be changed once made, so it is safe to hold on to while it
+    waits in a batch, queue or spool, with _replace() giving a changed copy.
 
-    def __init__(self, temperature=0.0, humidity=0.0, pressure=0.0, gas=0.0, iaq_index=0.0):
-        self.temperature = temperature
-        self.humidity = humidity
-        self.pressure = pressure
-        self.gas = gas
-        self.iaq_index = iaq_index
+    stats are optional extra fields to store beside the reading, e.g. window aggregates. calibrating is whether the gas
+    baseline the quality index was worked out from was still being calibrated. fields are the names of the only value
+    attributes to store, when compression has dropped the others, or None for all. The timestamp is the time it was
+    made, unless given.
+    """
+    __slots__ = ()
 
-    def tick(self):
-        self.timestamp = time.time()
+    def __new__(cls, temperature=0.0, humidity=0.0, pressure=0.0, gas=0.0, iaq_index=0.0, timestamp=None,
+                sensor=DEFAULT_SENSOR_NAME, calibrating=False, stats=None, fields=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return super().__new__(cls, temperature, humidity, pressure, gas, iaq_index, timestamp, sensor, calibrating,
+                               stats, fields)
 
     def __str__(self):
-        return '{0}: ' 'Temp {1:.2f}°C, Humidity {2:.2f} %RH, Pressure {3:.2f} hPa, ' \
+        # Only name the sensor when there might be more than one.
+        sensor = '' if self.sensor == DEFAULT_SENSOR_NAME else f' [{self.sensor}]'
+        return '{0}{6}: ' 'Temp {1:.2f}°C, Humidity {2:.2f} %RH, Pressure {3:.2f} hPa, ' \
                'Gas Resistance {4:.2f} Ohms, Quality Index: {5:.2f}' \
             .format(datetime.fromtimestamp(self.timestamp).strftime('%d/%m/%Y %T.%f')[:-3],
-                    self.temperature, self.humidity, self.pressure, self.gas, self.iaq_index)
+                    self.temperature, self.humidity, self.pressure, self.gas, self.iaq_index, sensor)
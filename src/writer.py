@@ -0,0 +1,92 @@
+import queue
+import threading
+
+import metrics
+import utils
+from data_logging import DataLogging
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL]
+WRITER_QUEUE_SIZE = 1000
+# How often an idle writer wakes up to check whether a part-filled batch has become due.
+_IDLE_CHECK_SECS = 1
+_SHUTDOWN_TIMEOUT_SECS = 30
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Hands readings from the sampling loop to a dedicated thread, which passes them on to the DataLogging instance.
+    The sampling loop only ever waits on the queue, never on the network.
+    """
+
+    def __init__(self, logger: DataLogging, max_size=WRITER_QUEUE_SIZE, overflow=OVERFLOW_BLOCK):
+        self._logger = logger
+        self._queue = queue.Queue(maxsize=max_size)
+        self._overflow = overflow
+        self._dropped = 0
+        metrics.writer_queue_depth.set_function(self._queue.qsize)
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def log_sensor_output(self, data: utils.DataCapture):
+        try:
+            self._queue.put_nowait(data)
+            return
+        except queue.Full:
+            pass
+
+        if self._overflow == OVERFLOW_SPILL:
+            utils.log.warning('Writer queue full, spilling reading to the local backup.',
+                              extra=utils.rate_limited('writer-spill'))
+            self._logger.spool_sensor_output(data)
+        elif self._overflow == OVERFLOW_DROP_OLDEST:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self._dropped += 1
+                    if metrics.enabled:
+                        metrics.points_dropped.inc()
+                    utils.log.warning(f'Writer queue full, dropped the oldest reading ({self._dropped} dropped in '
+                                      f'total).', extra=utils.rate_limited('writer-drop'))
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(data)
+                    break
+                except queue.Full:
+                    continue
+        else:
+            self._queue.put(data)
+
+    def _run(self):
+        while True:
+            try:
+                data = self._queue.get(timeout=_IDLE_CHECK_SECS)
+            except queue.Empty:
+                self._logger.flush_if_due()
+                continue
+            if data is _STOP:
+                break
+            self._logger.log_sensor_output(data)
+
+    def shutdown(self):
+        # Everything queued ahead of the stop marker is written before the thread exits.
+        try:
+            self._queue.put(_STOP, timeout=_SHUTDOWN_TIMEOUT_SECS)
+            self._thread.join(timeout=_SHUTDOWN_TIMEOUT_SECS)
+        except queue.Full:
+            pass
+        if self._thread.is_alive():
+            # The thread is stuck, so keep anything still queued in the local backup instead.
+            utils.log.warning(f'Writer thread did not finish within {_SHUTDOWN_TIMEOUT_SECS} seconds, spooling the '
+                              f'remaining readings.')
+            while True:
+                try:
+                    data = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if data is not _STOP:
+                    self._logger.spool_sensor_output(data)
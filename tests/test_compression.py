@@ -0,0 +1,126 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import utils
+from compression import COMPRESSION_DEADBAND, COMPRESSION_MODES, COMPRESSION_SWINGING_DOOR, Compressor, \
+    DEFAULT_TOLERANCES
+
+_START = 1600000000.0
+_ATTRIBUTES = list(DEFAULT_TOLERANCES)
+
+
+def _signal(count, seed=680, period=1.0):
+    # A slow daily swing, plus noise and the odd step, roughly as a room's readings go.
+    generator = random.Random(seed)
+    readings = []
+    walk = 0.0
+    for number in range(count):
+        walk += generator.gauss(0, 1)
+        swing = math.sin(number / 200)
+        step = 3 if number > count // 2 else 0
+        readings.append(utils.DataCapture(21 + swing + step + walk * 0.01 + generator.gauss(0, 0.02),
+                                          45 + 5 * swing + walk * 0.05,
+                                          1013 + walk * 0.02,
+                                          120000 + 20000 * swing + walk * 100,
+                                          80 + 10 * swing + generator.gauss(0, 0.3),
+                                          timestamp=_START + number * period))
+    return readings
+
+
+def _compress(compressor, readings):
+    points = []
+    for data in readings:
+        points.extend(compressor.process(data))
+    points.extend(compressor.finish())
+    return points
+
+
+def _kept(points, attribute):
+    # Each field's kept values, in time order.
+    kept = sorted((data.timestamp, getattr(data, attribute)) for data in points
+                  if data.fields is None or attribute in data.fields)
+    return np.array([timestamp for timestamp, _ in kept]), np.array([value for _, value in kept])
+
+
+def _reconstruct(mode, times, values, timestamp):
+    if mode == COMPRESSION_DEADBAND:
+        # The last value kept holds until the next.
+        return values[np.searchsorted(times, timestamp, side='right') - 1]
+    # Straight lines between the values kept.
+    return np.interp(timestamp, times, values)
+
+
+@pytest.mark.parametrize('mode', COMPRESSION_MODES)
+def test_dropped_values_are_within_tolerance(mode):
+    readings = _signal(3000)
+    compressor = Compressor(mode)
+    points = _compress(compressor, readings)
+    assert len(points) < len(readings)
+
+    timestamps = np.array([data.timestamp for data in readings])
+    for attribute in _ATTRIBUTES:
+        times, values = _kept(points, attribute)
+        original = np.array([getattr(data, attribute) for data in readings])
+        errors = np.abs(_reconstruct(mode, times, values, timestamps) - original)
+        tolerance = DEFAULT_TOLERANCES[attribute]
+        assert errors.max() <= tolerance * (1 + 1e-9), attribute
+        # What is reported as the worst error is what was actually seen.
+        assert compressor._sensors[utils.DEFAULT_SENSOR_NAME].fields[attribute].max_error <= tolerance * (1 + 1e-9)
+
+
+@pytest.mark.parametrize('mode', COMPRESSION_MODES)
+def test_tolerances_can_be_changed(mode):
+    readings = _signal(2000)
+    loose = _compress(Compressor(mode, tolerances={'temperature': 1.0}), readings)
+    tight = _compress(Compressor(mode, tolerances={'temperature': 0.001}), readings)
+    assert len(_kept(loose, 'temperature')[0]) < len(_kept(tight, 'temperature')[0])
+
+
+@pytest.mark.parametrize('mode', COMPRESSION_MODES)
+def test_heartbeat_forces_a_point(mode):
+    # Nothing changes, so only the heartbeat ever sends anything.
+    readings = [utils.DataCapture(21.0, 45.0, 1013.0, 120000.0, 80.0, timestamp=_START + number * 10)
+                for number in range(200)]
+    points = _compress(Compressor(mode, heartbeat_secs=300), readings)
+    for attribute in _ATTRIBUTES:
+        times, _ = _kept(points, attribute)
+        assert times[0] == _START
+        assert np.diff(times).max() <= 300
+    # Every field is sent together with each heartbeat, as the whole reading.
+    assert sum(1 for data in points if data.fields is None) == len(readings) * 10 // 300 + 1
+
+
+def test_calibrating_change_forces_a_point():
+    readings = [utils.DataCapture(21.0, 45.0, 1013.0, 120000.0, 80.0, timestamp=_START + number,
+                                  calibrating=number < 50) for number in range(100)]
+    points = _compress(Compressor(COMPRESSION_DEADBAND), readings)
+    assert [data.timestamp for data in points if data.fields is None] == [_START, _START + 50]
+
+
+def test_finish_ends_each_field_on_its_latest_value():
+    # A steady climb, which the swinging door can draw as a single line, so only finish() sends its end.
+    readings = [utils.DataCapture(20.0 + number * 0.001, 45.0, 1013.0, 120000.0, 80.0, timestamp=_START + number)
+                for number in range(100)]
+    compressor = Compressor(COMPRESSION_SWINGING_DOOR)
+    points = []
+    for data in readings:
+        points.extend(compressor.process(data))
+    assert len(points) == 1
+
+    finished = compressor.finish()
+    assert [(data.timestamp, data.fields) for data in finished] == \
+        [(readings[-1].timestamp, frozenset(_ATTRIBUTES))]
+    # Nothing more to end once it has been.
+    assert compressor.finish() == []
+
+
+def test_sensors_are_compressed_separately():
+    compressor = Compressor(COMPRESSION_DEADBAND)
+    first = compressor.process(utils.DataCapture(21.0, 45.0, 1013.0, 120000.0, 80.0, timestamp=_START))
+    other = compressor.process(utils.DataCapture(21.0, 45.0, 1013.0, 120000.0, 80.0, timestamp=_START + 1,
+                                                 sensor='attic'))
+    # The first reading from each sensor is always sent in full.
+    assert [data.fields for data in first + other] == [None, None]
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import data_logging
+import utils
+from data_logging import DataLogging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+from fake_influx import FakeInfluxServer  # noqa: E402
+
+_START = 1600000000.0
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # The local backup goes in the working directory.
+    monkeypatch.chdir(tmp_path)
+    with FakeInfluxServer() as server:
+        yield server
+
+
+def _readings(count):
+    return [utils.DataCapture(20.0, 40.0, 1000.0, 50000.0, 80.0, timestamp=_START + number) for number in range(count)]
+
+
+def _logger(server):
+    return DataLogging(hostname='127.0.0.1', port=server.port, batch_size=5, replay_rate=0)
+
+
+def test_rejected_batch_is_dropped(server):
+    logger = _logger(server)
+    server.write_status = 400
+    for data in _readings(5):
+        logger.log_sensor_output(data)
+
+    # Sending it again would only be rejected again, and the connection itself is fine.
+    assert len(logger._spool) == 0
+    assert logger._connection_ok
+    assert logger._backoff.allows_attempt()
+    logger.shutdown()
+
+
+@pytest.mark.parametrize('status', [401, 500])
+def test_refused_batch_is_kept(server, status):
+    logger = _logger(server)
+    server.write_status = status
+    for data in _readings(5):
+        logger.log_sensor_output(data)
+
+    assert len(logger._spool) == 5
+    # Only a server error looks like the connection was lost.
+    assert logger._connection_ok == (status == 401)
+    logger._replayer.stop(timeout=1)
+    logger.shutdown()
+
+
+def test_rejected_backlog_is_dropped(server):
+    logger = _logger(server)
+    logger._spool.append(_readings(5))
+    server.write_status = 400
+    assert logger._send_backlog(logger._spool.peek(5))
+    server.write_status = 500
+    assert not logger._send_backlog(logger._spool.peek(5))
+    logger.shutdown()
+
+
+def test_refused_rollups_leave_the_raw_readings(server):
+    server.refused = ['CREATE CONTINUOUS QUERY']
+    logger = _logger(server)
+    assert logger._connection_ok
+    assert not logger._rollups
+    for data in _readings(5):
+        logger.log_sensor_output(data)
+    assert server.points_written == 5
+    logger.shutdown()
+
+
+def test_refused_database_is_retried(server):
+    server.refused = ['CREATE DATABASE']
+    logger = _logger(server)
+    assert not logger._connection_ok
+    assert not logger._backoff.allows_attempt()
+    for data in _readings(5):
+        logger.log_sensor_output(data)
+    assert len(logger._spool) == 5
+    logger.shutdown()
+
+
+def test_history_store_opened_once(server, monkeypatch):
+    opened = []
+
+    class SlowRingStore(data_logging.RingStore):
+        def __init__(self, *args, **kwargs):
+            opened.append(args[0])
+            # Long enough for every thread to get past the check before the first store is in place.
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(data_logging, 'RingStore', SlowRingStore)
+    logger = DataLogging(history_capacity=100)
+    threads = [threading.Thread(target=logger._record_history, args=(data,)) for data in _readings(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == 1
+    assert len(logger._history[utils.DEFAULT_SENSOR_NAME]) == 4
+    logger.shutdown()
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import urllib.request
+
+import pytest
+
+import gateway as gateway_module
+from gateway import Gateway
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+from fake_influx import FakeInfluxServer  # noqa: E402
+
+_NOW_NS = time.time_ns()
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # The gateway's spool goes in the working directory.
+    monkeypatch.chdir(tmp_path)
+    with FakeInfluxServer() as server:
+        yield server
+
+
+@pytest.fixture
+def gateway(server):
+    gateway = Gateway('127.0.0.1', port=server.port, listen_port=0, listen_address='127.0.0.1')
+    yield gateway
+    gateway._http.server_close()
+    gateway._udp.close()
+    gateway._influx.close()
+
+
+def _lines(count, start_ns=_NOW_NS, node='node1'):
+    return b''.join(b'AQ,hostname=%s temperature=%d %d\n' % (node.encode(), number, start_ns + number)
+                    for number in range(count))
+
+
+def _forward_pending(gateway):
+    batch, gateway._pending = gateway._pending, []
+    gateway._forward(batch)
+    return batch
+
+
+def test_duplicates_are_dropped(gateway):
+    assert gateway.receive(_lines(10), 'ns', 'http') == 10
+    # e.g. a node sending a batch again after losing the response to the first attempt.
+    assert gateway.receive(_lines(10), 'ns', 'http') == 0
+    assert gateway.receive(_lines(12), 'ns', 'udp') == 2
+    # The same reading, but sent at a different precision.
+    assert gateway.receive(b'AQ,hostname=node1 temperature=0 %d\n' % (_NOW_NS // 10 ** 6), 'ms', 'http') == 1
+    assert gateway.receive(b'AQ,hostname=node1 temperature=0 %d\n' % ((_NOW_NS // 10 ** 6) * 10 ** 6), 'ns',
+                           'http') == 0
+    # Another node's reading, at the same time, is not a duplicate.
+    assert gateway.receive(_lines(1, node='node2'), 'ns', 'http') == 1
+    assert len(gateway._pending) == 14
+
+
+def test_dedup_window_forgets_the_oldest(gateway):
+    window = gateway_module._DEDUP_WINDOW
+    assert gateway.receive(_lines(window), 'ns', 'http') == window
+    # Still remembered, as the window is full but not yet past it.
+    assert gateway.receive(_lines(1), 'ns', 'http') == 0
+    assert gateway.receive(_lines(1, start_ns=_NOW_NS + window), 'ns', 'http') == 1
+    # Pushed out by the one after the window, so taken as new again, which in turn pushes out the next oldest.
+    first, second, third = _lines(3).splitlines(keepends=True)
+    assert gateway.receive(first, 'ns', 'http') == 1
+    assert gateway.receive(third, 'ns', 'http') == 0
+    assert gateway.receive(second, 'ns', 'http') == 1
+    assert len(gateway._seen) == len(gateway._seen_order) == window
+
+
+def test_forwarded_to_influx(gateway, server):
+    gateway.receive(_lines(10), 'ns', 'http')
+    _forward_pending(gateway)
+    assert server.points_written == 10
+    assert len(gateway._spool) == 0
+
+
+def test_rejected_batch_is_dropped(gateway, server):
+    gateway.receive(_lines(10), 'ns', 'http')
+    server.write_status = 400
+    _forward_pending(gateway)
+    # Sending it again would only be rejected again, and the connection itself is fine.
+    assert len(gateway._spool) == 0
+    assert gateway._connection_ok
+
+
+def test_failed_batch_is_spooled_and_replayed(gateway, server):
+    gateway.receive(_lines(10), 'ns', 'http')
+    server.write_status = 500
+    _forward_pending(gateway)
+    assert len(gateway._spool) == 10
+    assert not gateway._connection_ok
+
+    # Readings which arrive while influxDB can't be reached go straight to the spool.
+    server.available = False
+    gateway.receive(_lines(5, start_ns=_NOW_NS + 100), 'ns', 'http')
+    _forward_pending(gateway)
+    assert len(gateway._spool) == 15
+
+    server.available, server.write_status = True, 204
+    gateway._backoff.succeeded()
+    assert gateway._connected()
+    gateway._replay()
+    assert len(gateway._spool) == 0
+    assert server.points_written == 15
+
+
+def test_late_readings_are_rolled_up(gateway, server):
+    hour_ns = 3600 * 10 ** 9
+    gateway.receive(_lines(5, start_ns=_NOW_NS - hour_ns), 'ns', 'http')
+    gateway.receive(_lines(5), 'ns', 'http')
+    _forward_pending(gateway)
+    # Only the readings too old for the continuous queries.
+    assert gateway._late == (_NOW_NS - hour_ns, _NOW_NS - hour_ns + 4)
+
+    gateway._rollup_late()
+    backfills = [statement for statement in server.statements if statement.startswith('SELECT')]
+    assert [statement.split('INTO ')[1].split(' ')[0] for statement in backfills] == \
+        ['"AQ_MON"."rollup_1m"."AQ"', '"AQ_MON"."rollup_1h"."AQ"', '"AQ_MON"."rollup_1d"."AQ"']
+    assert gateway._late is None
+
+
+def test_late_readings_without_rollups(gateway, server):
+    server.refused = ['CREATE CONTINUOUS QUERY']
+    gateway.receive(_lines(5, start_ns=_NOW_NS - 3600 * 10 ** 9), 'ns', 'http')
+    _forward_pending(gateway)
+    assert server.points_written == 5
+    assert gateway._late is None
+
+
+def test_end_to_end(gateway, server):
+    gateway.start()
+    port = gateway._http.server_address[1]
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/write?precision=ns', data=_lines(20), method='POST')
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 204
+    # Sent on by shutdown, without waiting for the batch to be due.
+    gateway.shutdown()
+    assert server.points_written == 20
@@ -0,0 +1,102 @@
+import math
+import types
+
+import numpy as np
+import pytest
+
+import cpu_temp
+import iaq
+import recompute_iaq
+import sensor
+import utils
+from data_logging import DB_FAILED_WRITES
+from spool import Spool
+
+_SEEDS = range(5)
+
+
+def _scalar_quality(humidity, gas, humidity_baseline, gas_baseline, quality_weighting):
+    return np.array([sensor.calculate_iaq_index(h, g, hb, gb, quality_weighting)
+                     for h, g, hb, gb in zip(humidity, gas, np.broadcast_to(humidity_baseline, len(humidity)),
+                                             np.broadcast_to(gas_baseline, len(humidity)))])
+
+
+@pytest.mark.parametrize('seed', _SEEDS)
+def test_iaq_index_matches_scalar(seed):
+    generator = np.random.default_rng(seed)
+    count = 2000
+    humidity = generator.uniform(0.0, 100.0, count)
+    gas = generator.uniform(1000.0, 500000.0, count)
+    humidity_baseline = generator.uniform(20.0, 60.0)
+    gas_baseline = generator.uniform(10000.0, 300000.0)
+    quality_weighting = generator.uniform(0.0, 1.0)
+    # Right on either baseline, where the scalar path switches branch.
+    humidity[:10], gas[10:20] = humidity_baseline, gas_baseline
+
+    quality = iaq.iaq_index(humidity, gas, humidity_baseline, gas_baseline, quality_weighting)
+    expected = _scalar_quality(humidity, gas, humidity_baseline, gas_baseline, quality_weighting)
+    assert np.allclose(quality, expected, rtol=0, atol=1e-9)
+    assert iaq.matches_scalar(humidity, gas, humidity_baseline, gas_baseline, quality_weighting, quality)
+
+
+@pytest.mark.parametrize('seed', _SEEDS)
+def test_iaq_index_matches_scalar_while_calibrating(seed):
+    # The gas baseline moves with every reading until it has been calibrated.
+    generator = np.random.default_rng(seed)
+    count = 500
+    humidity = generator.uniform(0.0, 100.0, count)
+    gas = generator.uniform(1000.0, 500000.0, count)
+    gas_baseline = np.maximum.accumulate(generator.uniform(10000.0, 300000.0, count))
+
+    quality = iaq.iaq_index(humidity, gas, 40.0, gas_baseline, 0.25)
+    assert np.allclose(quality, _scalar_quality(humidity, gas, 40.0, gas_baseline, 0.25), rtol=0, atol=1e-9)
+
+
+def test_recomputed_spool_matches_scalar(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    generator = np.random.default_rng(680)
+    config = {'humidity': {'baseline': 40.0, 'quality_weighting': 0.25}, 'gas': {'ambient_background': 150000.0}}
+    readings = []
+    for number in range(300):
+        data = utils.DataCapture(20.0, generator.uniform(0.0, 100.0), 1000.0, generator.uniform(1000.0, 500000.0),
+                                 -1.0, timestamp=1600000000.0 + number, calibrating=number % 3 == 0,
+                                 sensor='attic' if number % 7 == 0 else utils.DEFAULT_SENSOR_NAME)
+        if number % 5 == 0:
+            # Compression left out the humidity, so there is nothing to recompute the score from.
+            data = data._replace(fields=frozenset({'temperature', 'gas', 'iaq_index'}))
+        readings.append(data)
+    Spool(DB_FAILED_WRITES).append(readings)
+
+    arguments = types.SimpleNamespace(sensor=utils.DEFAULT_SENSOR_NAME, dry_run=False)
+    recompute_iaq.recompute_spool(arguments, recompute_iaq.Recomputer(config, verify=True))
+
+    recomputed = list(Spool(DB_FAILED_WRITES).peek(len(readings)))
+    for before, after in zip(readings, recomputed):
+        if before.sensor != utils.DEFAULT_SENSOR_NAME or before.fields is not None:
+            # Left as they were, other sensors have baselines of their own.
+            assert after.iaq_index == before.iaq_index
+            assert (after.fields is None) == (before.fields is None)
+        else:
+            expected = sensor.calculate_iaq_index(before.humidity, before.gas, 40.0, 150000.0, 0.25)
+            assert math.isclose(after.iaq_index, expected, rel_tol=0, abs_tol=1e-9)
+            assert after.calibrating == before.calibrating
+
+
+@pytest.mark.parametrize('smoothing_strength', [1, 7, 60])
+def test_compensate_temperature_matches_scalar(smoothing_strength):
+    generator = np.random.default_rng(smoothing_strength)
+    count = 1000
+    temperature = generator.uniform(10.0, 35.0, count)
+    cpu_temperature = generator.uniform(30.0, 80.0, count)
+
+    cpu_readings = iter(cpu_temperature.tolist())
+    compensation = cpu_temp.CpuCompensation(lambda: next(cpu_readings), smoothing_strength, 2.0)
+    expected = [compensation.compensate(value) for value in temperature.tolist()]
+
+    # In chunks, each carrying on from the CPU temperatures of the one before.
+    split = count // 3
+    compensated = np.concatenate((
+        iaq.compensate_temperature(temperature[:split], cpu_temperature[:split], smoothing_strength, 2.0),
+        iaq.compensate_temperature(temperature[split:], cpu_temperature[split:], smoothing_strength, 2.0,
+                                   history=cpu_temperature[:split])))
+    assert np.allclose(compensated, expected, rtol=0, atol=1e-9)
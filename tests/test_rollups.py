@@ -0,0 +1,27 @@
+from rollups import dashboard_ranges
+
+_DAY_MS = 24 * 60 * 60 * 1000
+_FOREVER = 2 ** 62
+
+
+def test_default_retention():
+    durations = {'autogen': '0s', 'rollup_1m': '90d', 'rollup_1h': '730d', 'rollup_1d': 'INF'}
+    assert dashboard_ranges(durations) == [('autogen', 0, _DAY_MS), ('rollup_1m', _DAY_MS, 30 * _DAY_MS),
+                                           ('rollup_1h', 30 * _DAY_MS, 730 * _DAY_MS),
+                                           ('rollup_1d', 730 * _DAY_MS, _FOREVER)]
+
+
+def test_shorter_retention_hands_over_sooner():
+    # As influxDB lists them, and as given on the command line.
+    durations = {'autogen': '12h0m0s', 'rollup_1m': '7d', 'rollup_1h': '52w', 'rollup_1d': '730d'}
+    assert dashboard_ranges(durations) == [('autogen', 0, _DAY_MS // 2), ('rollup_1m', _DAY_MS // 2, 7 * _DAY_MS),
+                                           ('rollup_1h', 7 * _DAY_MS, 364 * _DAY_MS),
+                                           ('rollup_1d', 364 * _DAY_MS, _FOREVER)]
+
+
+def test_rollup_kept_for_less_than_the_one_before_is_skipped():
+    durations = {'autogen': 'INF', 'rollup_1m': '6h', 'rollup_1h': '30d', 'rollup_1d': 'INF'}
+    ranges = dashboard_ranges(durations)
+    # Still listed, so the one written before is replaced, but never picked.
+    assert ranges[1] == ('rollup_1m', _DAY_MS, _DAY_MS)
+    assert ranges[2] == ('rollup_1h', _DAY_MS, 30 * _DAY_MS)
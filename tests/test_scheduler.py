@@ -0,0 +1,33 @@
+import signal
+import time
+
+from scheduler import DeadlineScheduler
+
+
+def test_signal_stops_a_sleeping_scheduler():
+    scheduler = DeadlineScheduler()
+    runs = []
+    scheduler.every(60, lambda: runs.append(time.monotonic()))
+    previous = signal.signal(signal.SIGALRM, lambda sig, frame: scheduler.stop())
+    try:
+        started = time.monotonic()
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        scheduler.run()
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+    # Woken from its sleep until the next run, rather than waiting out the period.
+    assert len(runs) == 1
+    assert time.monotonic() - started < 5
+
+
+def test_stop_during_an_action_lets_it_finish():
+    scheduler = DeadlineScheduler()
+    finished = []
+
+    def action():
+        scheduler.stop()
+        finished.append(True)
+
+    scheduler.every(0.01, action)
+    scheduler.run()
+    assert finished == [True]
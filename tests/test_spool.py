@@ -0,0 +1,238 @@
+import collections
+import io
+import os
+import pickle
+import random
+
+import pytest
+
+import data_logging
+import spool
+import utils
+from aggregation import WindowAggregator
+from data_logging import DataLogging
+from spool import LineSpool, Spool
+
+_START = 1600000000.0
+
+
+def _reading(number, sensor=utils.DEFAULT_SENSOR_NAME, calibrating=False, fields=None):
+    return utils.DataCapture(20.0 + number, 40.0 + number, 1000.0 + number, 50000.0 + number, 80.0 + number,
+                             timestamp=_START + number, sensor=sensor, calibrating=calibrating, fields=fields)
+
+
+def _key(data):
+    # Timestamps go through a float number of seconds on disk, so are only compared to the microsecond.
+    values = tuple(getattr(data, attribute) for attribute in data.fields or ())
+    if data.fields is None:
+        values = (data.temperature, data.humidity, data.pressure, data.gas, data.iaq_index)
+    return round(data.timestamp, 6), data.sensor, data.calibrating, data.fields, values
+
+
+def _keys(readings):
+    return [_key(data) for data in readings]
+
+
+def _segment_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.seg'))
+
+
+def _write_old_segment(directory, segment, version, readings):
+    record = spool._RECORDS[version]
+    with open(os.path.join(directory, f'{segment:08d}.seg'), 'wb') as segment_file:
+        segment_file.write(spool._SEGMENT_HEADER.pack(spool._SEGMENT_MAGIC, version, record.size))
+        for data in readings:
+            values = (data.timestamp, data.temperature, data.humidity, data.pressure, data.gas, data.iaq_index)
+            if version >= 2:
+                values += (spool._FLAG_CALIBRATING if data.calibrating else 0,)
+            if version >= 3:
+                values += (0,)
+            segment_file.write(record.pack(*values))
+
+
+def test_round_trip(tmp_path):
+    readings = [_reading(0), _reading(1, sensor='attic', calibrating=True),
+                _reading(2, fields=frozenset({'temperature', 'gas'})), _reading(3)]
+    backup = Spool(str(tmp_path))
+    backup.append(readings)
+
+    assert len(backup) == 4
+    assert _keys(backup.peek(10)) == _keys(readings)
+    # Peeking doesn't move the committed position.
+    assert _keys(backup.peek(2)) == _keys(readings[:2])
+
+
+def test_window_stats_survive(tmp_path):
+    aggregator = WindowAggregator()
+    for number in range(4):
+        aggregator.add(_reading(number, sensor='attic'))
+    window = aggregator.emit()
+    readings = [_reading(0), window, _reading(5)]
+    Spool(str(tmp_path)).append(readings)
+
+    replayed = list(Spool(str(tmp_path)).peek(10))
+    assert _keys(replayed) == _keys(readings)
+    assert [data.stats for data in replayed] == [None, window.stats, None]
+    assert replayed[1].stats['samples'] == 4
+
+
+def test_commit_and_reopen(tmp_path):
+    readings = [_reading(number) for number in range(25)]
+    backup = Spool(str(tmp_path), segment_records=10)
+    backup.append(readings)
+    backup.commit(12)
+
+    # The first segment was fully consumed, so is gone.
+    assert len(_segment_paths(str(tmp_path))) == 2
+    reopened = Spool(str(tmp_path), segment_records=10)
+    assert len(reopened) == 13
+    assert _keys(reopened.peek(100)) == _keys(readings[12:])
+
+
+def test_reopen_after_everything_was_read(tmp_path):
+    backup = Spool(str(tmp_path), segment_records=10)
+    backup.append([_reading(number) for number in range(25)])
+    backup.commit(25)
+    assert not _segment_paths(str(tmp_path))
+
+    # Appended after a restart with no segments left, which must still come after the committed position.
+    readings = [_reading(number) for number in range(25, 30)]
+    Spool(str(tmp_path), segment_records=10).append(readings)
+    reopened = Spool(str(tmp_path), segment_records=10)
+    assert len(reopened) == 5
+    assert _keys(reopened.peek(10)) == _keys(readings)
+
+
+def test_line_spool_reopen_after_everything_was_read(tmp_path):
+    backup = LineSpool(str(tmp_path), segment_bytes=20)
+    backup.append([b'AQ value=%d 1\n' % number for number in range(5)])
+    backup.commit(backup.peek(10))
+
+    LineSpool(str(tmp_path), segment_bytes=20).append([b'AQ value=5 1\n'])
+    assert LineSpool(str(tmp_path), segment_bytes=20).peek(10) == [b'AQ value=5 1\n']
+
+
+def test_commit_past_the_end(tmp_path):
+    backup = Spool(str(tmp_path), segment_records=10)
+    backup.append([_reading(number) for number in range(10)])
+    backup.commit(15)
+    assert len(backup) == 0
+
+    # Appended after the committed position, rather than skipped over.
+    readings = [_reading(number) for number in range(10, 13)]
+    backup.append(readings)
+    assert _keys(backup.peek(10)) == _keys(readings)
+    assert _keys(Spool(str(tmp_path), segment_records=10).peek(10)) == _keys(readings)
+    backup.commit(100)
+    assert len(Spool(str(tmp_path), segment_records=10)) == 0
+
+
+def test_sensor_names_survive_reopen(tmp_path):
+    readings = [_reading(0, sensor='attic'), _reading(1, sensor='cellar'), _reading(2)]
+    Spool(str(tmp_path)).append(readings)
+    assert _keys(Spool(str(tmp_path)).peek(10)) == _keys(readings)
+
+
+def test_random_operations_match_a_queue(tmp_path):
+    generator = random.Random(680)
+    expected = collections.deque()
+    backup = Spool(str(tmp_path), segment_records=7)
+    number = 0
+    for _ in range(300):
+        operation = generator.random()
+        if operation < 0.4:
+            readings = [_reading(number + offset, sensor=generator.choice(['primary', 'attic']),
+                                 calibrating=generator.random() < 0.2) for offset in range(generator.randint(1, 20))]
+            number += len(readings)
+            backup.append(readings)
+            expected.extend(readings)
+        elif operation < 0.7:
+            count = generator.randint(0, len(expected))
+            assert _keys(backup.peek(count)) == _keys(list(expected)[:count])
+            backup.commit(count)
+            for _ in range(count):
+                expected.popleft()
+        elif operation < 0.9:
+            backup = Spool(str(tmp_path), segment_records=7)
+        assert len(backup) == len(expected)
+    assert _keys(record for records in backup.iterate(chunk_records=5) for record in records) == _keys(expected)
+
+
+def test_truncated_record_is_dropped_on_open(tmp_path):
+    readings = [_reading(number) for number in range(5)]
+    Spool(str(tmp_path)).append(readings)
+    path = _segment_paths(str(tmp_path))[-1]
+    with open(path, 'ab') as segment_file:
+        segment_file.write(b'\x01\x02\x03')
+
+    backup = Spool(str(tmp_path))
+    assert len(backup) == 5
+    # New records are appended in line with the old ones, rather than after the partial record.
+    backup.append([_reading(5)])
+    assert _keys(backup.peek(10)) == _keys(readings + [_reading(5)])
+
+
+def test_read_only_leaves_the_files_alone(tmp_path):
+    readings = [_reading(number) for number in range(5)]
+    Spool(str(tmp_path)).append(readings)
+    path = _segment_paths(str(tmp_path))[-1]
+    with open(path, 'ab') as segment_file:
+        segment_file.write(b'\x01\x02\x03')
+    size = os.path.getsize(path)
+
+    backup = Spool(str(tmp_path), read_only=True)
+    assert _keys(record for records in backup.iterate() for record in records) == _keys(readings)
+    assert os.path.getsize(path) == size
+    with pytest.raises(io.UnsupportedOperation):
+        backup.commit(1)
+
+    missing = str(tmp_path / 'missing')
+    assert len(Spool(missing, read_only=True)) == 0
+    assert not os.path.exists(missing)
+
+
+@pytest.mark.parametrize('version', [1, 2, 3])
+def test_old_segment_versions(tmp_path, version):
+    old = [_reading(0, calibrating=True), _reading(1)]
+    _write_old_segment(str(tmp_path), 1, version, old)
+
+    backup = Spool(str(tmp_path))
+    backup.append([_reading(2, sensor='attic')])
+    # Never mixed with the old layout, new records go in a segment of their own.
+    assert len(_segment_paths(str(tmp_path))) == 2
+
+    replayed = list(backup.peek(10))
+    # Version 1 records had no flags, so no calibrating flag either.
+    expected = [old[0]._replace(calibrating=version >= 2), old[1], _reading(2, sensor='attic')]
+    assert _keys(replayed) == _keys(expected)
+    backup.commit(3)
+    assert len(backup) == 0
+
+
+class _PickledCapture:
+    # The mutable reading class older versions pickled into the legacy backup file, as utils.DataCapture, which is
+    # where unpickling will look for it.
+    __module__ = 'utils'
+    __qualname__ = 'DataCapture'
+
+    def __init__(self, data):
+        self.temperature, self.humidity, self.pressure = data.temperature, data.humidity, data.pressure
+        self.gas, self.iaq_index, self.timestamp = data.gas, data.iaq_index, data.timestamp
+
+
+def test_legacy_backup_is_migrated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    readings = [_reading(number) for number in range(3)]
+    # Pickling checks the class can be found where it says it is.
+    with monkeypatch.context() as patched:
+        patched.setattr(utils, 'DataCapture', _PickledCapture)
+        with open(data_logging._DB_FAILED_WRITES_LEGACY, 'wb') as legacy_file:
+            for data in readings:
+                pickle.dump(_PickledCapture(data), legacy_file)
+
+    logger = DataLogging()
+    logger._spool = Spool(data_logging.DB_FAILED_WRITES)
+    logger._migrate_legacy_backups()
+
+    assert not os.path.exists(data_logging._DB_FAILED_WRITES_LEGACY)
+    assert _keys(logger._spool.peek(10)) == _keys(readings)